@@ -0,0 +1,124 @@
+from datetime import datetime
+from functools import wraps
+import random
+import time
+
+from aludel.service import get_request_id
+from twisted.application.service import Service
+from twisted.python.failure import Failure
+from twisted.web.server import Site
+
+from .log_writer import LogWriter, DEFAULT_MAX_QUEUED
+
+
+class QuietSite(Site):
+    """
+    Site that doesn't write Twisted's default access log lines.
+
+    We use this when we have an :class:`AccessLog` instead.
+    """
+
+    def log(self, request):
+        pass
+
+
+class AccessLog(Service):
+    """
+    Writes a line of JSON for each API request to a rotating log file.
+
+    Entries are queued in memory and written by a background thread, so
+    the reactor thread never waits for the disk. If more than
+    ``max_queued`` entries are waiting, new ones are dropped and counted
+    rather than slowing requests down.
+
+    Successful requests are only logged with probability
+    ``success_sample_rate``. Failed requests are always logged.
+    """
+
+    def __init__(self, log_path, success_sample_rate=1.0,
+                 max_queued=DEFAULT_MAX_QUEUED, random=random.random,
+                 now=time.time):
+        self.log_path = log_path
+        self.success_sample_rate = success_sample_rate
+        self._random = random
+        self._now = now
+        self._writer = LogWriter(
+            log_path, max_queued=max_queued,
+            name='airtime-service-access-log')
+
+    @property
+    def dropped(self):
+        return self._writer.dropped
+
+    def startService(self):
+        Service.startService(self)
+        self._writer.start()
+
+    def stopService(self):
+        Service.stopService(self)
+        return self._writer.stop()
+
+    def _sampled(self, entry):
+        if entry['outcome'] != 'success' or self.success_sample_rate >= 1:
+            return True
+        return self._random() < self.success_sample_rate
+
+    def start(self):
+        """
+        Return a token to pass to :meth:`log_request` when the request is
+        done.
+        """
+        return self._now()
+
+    def log_request(self, request, endpoint, start, params,
+                    disconnected=False):
+        """
+        Queue an entry for ``request``, which took from ``start`` until now.
+        """
+        status = request.code
+        if disconnected:
+            outcome = 'disconnected'
+        elif status < 400:
+            outcome = 'success'
+        else:
+            outcome = 'error'
+        entry = {
+            'timestamp': datetime.utcnow().isoformat(),
+            'request_id': get_request_id(request),
+            'endpoint': endpoint,
+            'pool': params.get('voucher_pool'),
+            'operator': params.get('operator'),
+            'status': status,
+            'outcome': outcome,
+            'latency': self._now() - start,
+        }
+        if not self._sampled(entry):
+            return
+        self._writer.write(entry)
+
+
+def _finish_access_log(result, request, access_log, endpoint, start, params):
+    # This fails if the client went away before we could respond.
+    access_log.log_request(
+        request, endpoint, start, params,
+        disconnected=isinstance(result, Failure))
+
+
+def access_logged(func):
+    """
+    Decorator for handlers that writes an access log entry for the request
+    once the response has been sent.
+
+    This does nothing unless ``access_log`` is set on the app.
+    """
+    @wraps(func)
+    def wrapper(self, request, *args, **kw):
+        if self.access_log is not None:
+            # We log on finish so we see the final response code, even if
+            # the error handlers set it.
+            d = request.notifyFinish()
+            d.addBoth(
+                _finish_access_log, request, self.access_log, func.__name__,
+                self.access_log.start(), kw)
+        return func(self, request, *args, **kw)
+    return wrapper
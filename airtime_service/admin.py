@@ -0,0 +1,113 @@
+from aludel.service import (
+    service, handler, get_url_params, format_error, APIError,
+    BadRequestParams,
+)
+
+from twisted.internet.defer import maybeDeferred
+
+from .profiler import (
+    ProfilerBusy, format_stats, dump_stats, format_collapsed,
+)
+
+
+@service
+class _AdminHandlers(object):
+    """
+    The JSON endpoints of :class:`AdminApp`.
+    """
+
+    def __init__(self, api, profiler=None):
+        self.api = api
+        self.profiler = profiler
+
+    @handler('/slow_queries', methods=['GET'])
+    def slow_queries(self, request):
+        get_url_params(request, [], ['request_id'])
+        if self.api.slow_query_log is None:
+            raise APIError('Slow query logging is disabled.', 404)
+        return self.api.slow_query_log.report()
+
+    @handler('/transaction_retries', methods=['GET'])
+    def transaction_retries(self, request):
+        get_url_params(request, [], ['request_id'])
+        return self.api.retrier.stats()
+
+    @handler('/audit_cache', methods=['GET'])
+    def audit_cache(self, request):
+        get_url_params(request, [], ['request_id'])
+        return self.api.audit_cache.stats()
+
+    @handler('/issuance_stats', methods=['GET'])
+    def issuance_stats(self, request):
+        """
+        Return recent issue and export rates for each voucher type, and
+        estimates of when they will run out. This doesn't query the
+        database.
+        """
+        params = get_url_params(request, [], ['pool', 'request_id'])
+        return self.api.issuance_stats.report(params.get('pool'))
+
+
+class AdminApp(_AdminHandlers):
+    """
+    Operational endpoints that shouldn't be exposed to API clients.
+
+    This is served on a separate port, which should only be reachable by
+    operators.
+    """
+
+    # Profiles aren't JSON, so they're served by plain Klein routes on the
+    # same app as the aludel handlers.
+    app = _AdminHandlers.app
+
+    def _get_profile_params(self, request):
+        params = get_url_params(
+            request, [], ['seconds', 'format', 'request_id'])
+        if self.profiler is None:
+            raise APIError('Profiling is disabled.', 404)
+        try:
+            seconds = float(params.get('seconds', 10))
+        except ValueError:
+            raise BadRequestParams('Invalid profile duration.')
+        if not 0 < seconds <= self.profiler.max_duration:
+            raise BadRequestParams(
+                'Profile duration must be between 0 and %s seconds.' % (
+                    self.profiler.max_duration,))
+        profile_format = params.get('format', 'text')
+        if profile_format not in PROFILE_FORMATS:
+            raise BadRequestParams('Invalid profile format.')
+        return seconds, profile_format
+
+    def _profile(self, request):
+        seconds, profile_format = self._get_profile_params(request)
+        capture, formatter, content_type = PROFILE_FORMATS[profile_format]
+        try:
+            d = getattr(self.profiler, capture)(seconds)
+        except ProfilerBusy:
+            raise APIError('A profile is already running.', 409)
+        request.setHeader('Content-Type', content_type)
+        return d.addCallback(formatter)
+
+    @app.route('/profile', methods=['GET'])
+    def profile(self, request):
+        """
+        Profile the process for ``seconds`` seconds and return the result.
+
+        ``format`` is ``text`` or ``pstats`` for a ``cProfile`` capture of
+        the reactor thread, or ``collapsed`` for sampled stacks of all
+        threads suitable for a flamegraph.
+        """
+        d = maybeDeferred(self._profile, request)
+        return d.addErrback(_format_raw_error, request)
+
+
+PROFILE_FORMATS = {
+    'text': ('profile', format_stats, 'text/plain'),
+    'pstats': ('profile', dump_stats, 'application/octet-stream'),
+    'collapsed': ('sample', format_collapsed, 'text/plain'),
+}
+
+
+def _format_raw_error(failure, request):
+    failure.trap(APIError)
+    return format_error(failure.value, request)
@@ -0,0 +1,139 @@
+from collections import deque
+
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
+
+
+DEFAULT_MAX_QUEUED = 100
+DEFAULT_QUEUE_TIMEOUT = 1.0
+DEFAULT_RETRY_AFTER = 1
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after):
+        super(Overloaded, self).__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class _Waiter(object):
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.d = Deferred()
+        self.timeout_call = None
+
+
+class AdmissionController(object):
+    """
+    Limits the number of requests being handled at once.
+
+    Requests are admitted while both the global in-flight count and the
+    in-flight count for their endpoint are below their limits. Otherwise they
+    wait in a bounded FIFO queue until there is room or until
+    ``queue_timeout`` seconds have passed. If the queue is full or the wait
+    times out, :class:`Overloaded` is raised so the client gets a fast
+    response instead of waiting indefinitely.
+
+    A limit of ``None`` means unlimited.
+    """
+
+    def __init__(self, clock, max_in_flight=None, endpoint_limits=None,
+                 max_queued=DEFAULT_MAX_QUEUED,
+                 queue_timeout=DEFAULT_QUEUE_TIMEOUT,
+                 retry_after=DEFAULT_RETRY_AFTER):
+        if endpoint_limits is None:
+            endpoint_limits = {}
+        self.clock = clock
+        self.max_in_flight = max_in_flight
+        self.endpoint_limits = endpoint_limits
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.endpoint_in_flight = {}
+        self.rejected = 0
+        self._queue = deque()
+
+    @property
+    def limited(self):
+        return self.max_in_flight is not None or bool(self.endpoint_limits)
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def _has_room(self, endpoint):
+        if self.max_in_flight is not None:
+            if self.in_flight >= self.max_in_flight:
+                return False
+        limit = self.endpoint_limits.get(endpoint)
+        if limit is not None:
+            if self.endpoint_in_flight.get(endpoint, 0) >= limit:
+                return False
+        return True
+
+    def _acquire(self, endpoint):
+        self.in_flight += 1
+        self.endpoint_in_flight[endpoint] = (
+            self.endpoint_in_flight.get(endpoint, 0) + 1)
+
+    def _release(self, result, endpoint):
+        self.in_flight -= 1
+        self.endpoint_in_flight[endpoint] -= 1
+        if not self.endpoint_in_flight[endpoint]:
+            del self.endpoint_in_flight[endpoint]
+        self._admit_waiters()
+        return result
+
+    def _next_waiter(self):
+        # A waiter for a saturated endpoint shouldn't block waiters for other
+        # endpoints, so we look for the oldest waiter that fits.
+        for waiter in self._queue:
+            if self._has_room(waiter.endpoint):
+                return waiter
+        return None
+
+    def _admit_waiters(self):
+        waiter = self._next_waiter()
+        while waiter is not None:
+            self._queue.remove(waiter)
+            waiter.timeout_call.cancel()
+            self._acquire(waiter.endpoint)
+            waiter.d.callback(None)
+            waiter = self._next_waiter()
+
+    def _reject(self):
+        self.rejected += 1
+        raise Overloaded(self.retry_after)
+
+    def _timeout(self, waiter):
+        self._queue.remove(waiter)
+        self.rejected += 1
+        waiter.d.errback(Overloaded(self.retry_after))
+
+    def _wait(self, endpoint):
+        if len(self._queue) >= self.max_queued:
+            self._reject()
+        waiter = _Waiter(endpoint)
+        waiter.timeout_call = self.clock.callLater(
+            self.queue_timeout, self._timeout, waiter)
+        self._queue.append(waiter)
+        return waiter.d
+
+    def _call(self, _, endpoint, func, args, kw):
+        d = maybeDeferred(func, *args, **kw)
+        return d.addBoth(self._release, endpoint)
+
+    def run(self, endpoint, func, *args, **kw):
+        """
+        Call ``func`` once the request is admitted.
+
+        Returns a Deferred that fires with the result of ``func`` or fails
+        with :class:`Overloaded` if the request could not be admitted.
+        """
+        if not self.limited:
+            return maybeDeferred(func, *args, **kw)
+        if self._has_room(endpoint):
+            self._acquire(endpoint)
+            d = succeed(None)
+        else:
+            d = maybeDeferred(self._wait, endpoint)
+        return d.addCallback(self._call, endpoint, func, args, kw)
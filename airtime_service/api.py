@@ -1,5 +1,6 @@
 from StringIO import StringIO
 import csv
+from functools import wraps
 from hashlib import md5
 
 from aludel.database import get_engine
@@ -8,30 +9,312 @@ from aludel.service import (
     APIError, BadRequestParams,
 )
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, returnValue, gatherResults, succeed,
+    DeferredList, DeferredSemaphore,
+)
+from twisted.python import log
 
+from .access_log import access_logged
+from .admission import AdmissionController, Overloaded
+from .audit_cache import AuditCache
+from .concurrency import PoolLimiter
+from .issuance_stats import IssuanceStats
+from .memory import MemoryEngine, MemoryVoucherPool, is_memory_conn_str
+from .lru import LRUCache
+from .migrations import OfflineMigrationRequired, SchemaOutOfDate
 from .models import (
     VoucherPool, NoVoucherPool, NoVoucherAvailable, AuditMismatch,
+    UnknownExportPage,
 )
+from .rate_limit import RateLimited, source_address
+from .replicas import ReplicaRouter, DEFAULT_MAX_LAG
+from .retry import TransactionRetrier, DEFAULT_DEADLINE
+from .shared import SharedVoucherPool
+from .shutdown import RequestDrainer, ShuttingDown, DEFAULT_DRAIN_TIMEOUT
+from .singleflight import SingleFlight
+from .timing import timed, get_timer
+
+
+DEFAULT_IMPORT_CONCURRENCY = 4
+DEFAULT_MAX_EXPORT_PAGE_SIZE = 1000
+
+# Pools are never downgraded, so we only check the schema version of each
+# recently used pool once.
+MAX_CHECKED_SCHEMAS = 1000
+
+
+def get_backend(conn_str, reactor, shared_tables=False):
+    """
+    Return the engine and voucher pool class for ``conn_str``.
+
+    If ``shared_tables`` is set, all voucher pools are kept in one set of
+    tables.
+    """
+    if is_memory_conn_str(conn_str):
+        return MemoryEngine(), MemoryVoucherPool
+    if shared_tables:
+        return get_engine(conn_str, reactor), SharedVoucherPool
+    return get_engine(conn_str, reactor), VoucherPool
+
+
+def dispose_engine(engine):
+    """
+    Close the idle connections in ``engine``'s connection pool.
+    """
+    if isinstance(engine, MemoryEngine):
+        return succeed(None)
+    return engine._defer_to_thread(engine._engine.dispose)
+
+
+def admission_controlled(func):
+    """
+    Decorator that admits handler calls through the app's admission
+    controller, using the handler name as the endpoint name.
+
+    Calls are also tracked so that shutdown can wait for them to finish.
+    The time spent waiting to be admitted (or rejected) is recorded as the
+    ``admission`` phase of the request's timer, so this must be inside
+    :func:`timed`.
+    """
+    @wraps(func)
+    def wrapper(self, request, *args, **kw):
+        # Set this early so that rejections include it.
+        if 'request_id' in kw:
+            set_request_id(request, kw['request_id'])
+        admitted = Deferred()
+        get_timer(request).measure('admission', admitted)
+
+        def run(*args, **kw):
+            admitted.callback(None)
+            return func(*args, **kw)
+
+        d = self.drainer.run(
+            self.admission.run, func.__name__, run, self, request, *args,
+            **kw)
+        return d.addBoth(_rejected, admitted)
+    return wrapper
+
+
+def _rejected(result, admitted):
+    # If we were never admitted, the wait ends here.
+    if not admitted.called:
+        admitted.callback(None)
+    return result
 
 
 @service
 class AirtimeServiceApp(object):
-    def __init__(self, conn_str, reactor):
-        self.engine = get_engine(conn_str, reactor)
+    def __init__(self, conn_str, reactor, replica_conn_strs=(),
+                 replica_max_lag=DEFAULT_MAX_LAG, pool_concurrency=None,
+                 admission=None, server_timing=False, log_timing=False,
+                 slow_query_log=None, shared_tables=False,
+                 retry_deadline=DEFAULT_DEADLINE, access_log=None,
+                 user_rate_limiter=None, source_rate_limiter=None,
+                 issuance_stats=None, import_chunk_size=None,
+                 import_concurrency=DEFAULT_IMPORT_CONCURRENCY,
+                 max_export_page_size=DEFAULT_MAX_EXPORT_PAGE_SIZE,
+                 trusted_proxies=()):
+        self.engine, self.voucher_pool_class = get_backend(
+            conn_str, reactor, shared_tables)
+        self.replicas = ReplicaRouter(
+            self.engine, [get_engine(replica_conn_str, reactor)
+                          for replica_conn_str in replica_conn_strs],
+            max_lag=replica_max_lag)
+        self.pool_limiter = PoolLimiter(pool_concurrency)
+        self.retrier = TransactionRetrier(
+            reactor, self.engine, deadline=retry_deadline)
+        self.single_flight = SingleFlight()
+        self.audit_cache = AuditCache()
+        self.checked_schemas = LRUCache(MAX_CHECKED_SCHEMAS)
+        if admission is None:
+            admission = AdmissionController(reactor)
+        self.admission = admission
+        self.drainer = RequestDrainer(reactor)
+        self.server_timing = server_timing
+        self.log_timing = log_timing
+        self.slow_query_log = slow_query_log
+        self.access_log = access_log
+        self.user_rate_limiter = user_rate_limiter
+        self.source_rate_limiter = source_rate_limiter
+        self.trusted_proxies = trusted_proxies
+        if issuance_stats is None:
+            issuance_stats = IssuanceStats(reactor)
+        self.issuance_stats = issuance_stats
+        self.import_chunk_size = import_chunk_size
+        self.import_concurrency = import_concurrency
+        self.max_export_page_size = max_export_page_size
+        self.ready = False
+
+    @inlineCallbacks
+    def _open_connections(self, engine, count):
+        conns = yield gatherResults([engine.connect() for _ in range(count)])
+        # Closing returns the connections to the engine's connection pool.
+        yield gatherResults([conn.close() for conn in conns])
+
+    @inlineCallbacks
+    def warm_up(self, connections=1, pools=()):
+        """
+        Do the expensive first-request work before taking traffic.
+
+        This opens ``connections`` database connections (to the primary and
+        any replicas) and builds table metadata and compiled statements for
+        each voucher pool named in ``pools``. When it's done, the app is
+        ready.
+        """
+        yield self._open_connections(self.engine, connections)
+        for replica in self.replicas.replicas:
+            try:
+                yield self._open_connections(replica.engine, connections)
+            except Exception:
+                log.err(None, "Replica warm-up failed.")
+                replica.healthy = False
+
+        conn = yield self.engine.connect()
+        try:
+            for voucher_pool in pools:
+                yield self.voucher_pool_class(
+                    voucher_pool, conn).compile_statements()
+        finally:
+            yield conn.close()
+        self.ready = True
+
+    @inlineCallbacks
+    def shutdown(self, timeout=DEFAULT_DRAIN_TIMEOUT):
+        """
+        Stop taking requests, wait up to ``timeout`` seconds for the ones in
+        progress, and close pooled database connections.
+
+        Transactions of requests that are still in progress after the
+        timeout are rolled back by the database when we exit.
+        """
+        abandoned = yield self.drainer.drain(timeout)
+        if abandoned:
+            log.msg("Shutting down with %s requests still in progress." % (
+                abandoned,))
+        yield dispose_engine(self.engine)
+        for replica in self.replicas.replicas:
+            yield dispose_engine(replica.engine)
 
     def handle_api_error(self, failure, request):
+        if failure.check(Overloaded):
+            request.setHeader('Retry-After', str(failure.value.retry_after))
+            raise APIError('Service overloaded.', 503)
+        if failure.check(RateLimited):
+            request.setHeader('Retry-After', str(failure.value.retry_after))
+            raise APIError('Rate limit exceeded.', 429)
+        if failure.check(ShuttingDown):
+            request.setHeader('Retry-After', str(self.admission.retry_after))
+            raise APIError('Service shutting down.', 503)
         if failure.check(NoVoucherPool):
             raise APIError('Voucher pool does not exist.', 404)
         if failure.check(AuditMismatch):
             raise BadRequestParams(
                 "This request has already been performed with different"
                 " parameters.")
+        if failure.check(UnknownExportPage):
+            raise BadRequestParams("Unknown page_token.")
+        if failure.check(OfflineMigrationRequired):
+            raise APIError(
+                'Voucher pool needs an offline schema upgrade.', 503)
+        if failure.check(SchemaOutOfDate):
+            raise APIError('Voucher pool needs a schema upgrade.', 503)
         return failure
 
+    @handler('/health/live', methods=['GET'])
+    def health_live(self, request):
+        return {'live': True}
+
+    @handler('/health/ready', methods=['GET'])
+    def health_ready(self, request):
+        # We stop being ready when we start shutting down, so load
+        # balancers stop sending us requests.
+        ready = self.ready and not self.drainer.draining
+        if not ready:
+            request.setResponseCode(503)
+        return {'ready': ready}
+
+    @inlineCallbacks
+    def _call_with_pool(self, request, voucher_pool, func, read_only,
+                        check_schema):
+        timer = get_timer(request)
+        if read_only:
+            conn = yield timer.measure('connect', self.replicas.connect())
+        else:
+            conn = yield timer.measure('connect', self.engine.connect())
+        try:
+            pool = self.voucher_pool_class(voucher_pool, conn)
+            pool.timer = timer
+            pool.slow_query_log = self.slow_query_log
+            pool.issuance_stats = self.issuance_stats
+            if check_schema and voucher_pool not in self.checked_schemas:
+                # Older tables would give us SQL errors instead.
+                yield pool.check_schema_version()
+                self.checked_schemas.put(voucher_pool, True)
+            result = yield func(pool)
+        finally:
+            yield conn.close()
+        returnValue(result)
+
+    def _run_with_pool(self, request, voucher_pool, func, read_only=False,
+                       check_schema=True):
+        """
+        Call ``func`` with a :class:`VoucherPool` on a new connection.
+
+        The call waits its turn if the pool is already at its concurrency
+        limit, and the connection is closed when ``func`` is done. Unless
+        ``check_schema`` is false, it fails with :class:`SchemaOutOfDate`
+        if the pool's tables haven't been upgraded yet.
+        """
+        return self.pool_limiter.run(
+            voucher_pool, self._call_with_pool, request, voucher_pool, func,
+            read_only, check_schema)
+
+    def _retry_with_pool(self, request, voucher_pool, operation, func):
+        """
+        Like :meth:`_run_with_pool`, but ``func`` is called again on a new
+        connection if its transaction hits a deadlock or serialization
+        failure. The operations we retry are all audited, so running them
+        again is safe.
+        """
+        return self.retrier.run(
+            operation, self._run_with_pool, request, voucher_pool, func)
+
+    def _run_once(self, request, voucher_pool, operation, request_id,
+                  params, func):
+        """
+        Like :meth:`_retry_with_pool`, but if the same request is already in
+        progress we wait for its result instead of calling ``func``.
+
+        Clients often retry requests that are taking a while, and this
+        saves a connection and a transaction for each retry. A duplicate
+        with different ``params`` fails with :class:`AuditMismatch`.
+        """
+        return self.single_flight.run(
+            (voucher_pool, operation, request_id), params,
+            self._retry_with_pool, request, voucher_pool, operation, func)
+
+    def _check_issue_rate(self, request, user_id):
+        """
+        Raise :class:`RateLimited` if this user or the client sending the
+        request is issuing too fast. This happens before we touch the
+        database, so rejected requests are cheap.
+
+        Clients behind one of ``trusted_proxies`` are told apart by the
+        addresses the proxy puts in ``X-Forwarded-For``.
+        """
+        if self.user_rate_limiter is not None:
+            self.user_rate_limiter.check(user_id)
+        if self.source_rate_limiter is not None:
+            self.source_rate_limiter.check(
+                source_address(request, self.trusted_proxies))
+
     @handler(
         '/<string:voucher_pool>/issue/<string:operator>/<string:request_id>',
         methods=['PUT'])
+    @access_logged
+    @timed
+    @admission_controlled
     @inlineCallbacks
     def issue_voucher(self, request, voucher_pool, operator, request_id):
         set_request_id(request, request_id)
@@ -42,19 +325,22 @@ class AirtimeServiceApp(object):
             'transaction_id': params.pop('transaction_id'),
             'user_id': params.pop('user_id'),
         }
-        conn = yield self.engine.connect()
+        self._check_issue_rate(request, audit_params['user_id'])
         try:
-            pool = VoucherPool(voucher_pool, conn)
-            voucher = yield pool.issue_voucher(
-                operator, params['denomination'], audit_params)
+            voucher = yield self._run_once(
+                request, voucher_pool, 'issue', request_id,
+                (operator, params['denomination'], audit_params),
+                lambda pool: pool.issue_voucher(
+                    operator, params['denomination'], audit_params))
         except NoVoucherAvailable:
             raise APIError('No voucher available.', 500)
-        finally:
-            yield conn.close()
 
         returnValue({'voucher': voucher['voucher']})
 
     @handler('/<string:voucher_pool>/audit_query', methods=['GET'])
+    @access_logged
+    @timed
+    @admission_controlled
     @inlineCallbacks
     def audit_query(self, request, voucher_pool):
         params = get_url_params(
@@ -62,17 +348,20 @@ class AirtimeServiceApp(object):
         if params['field'] not in ['request_id', 'transaction_id', 'user_id']:
             raise BadRequestParams('Invalid audit field.')
 
-        conn = yield self.engine.connect()
-        try:
-            pool = VoucherPool(voucher_pool, conn)
-            query = {
-                'request_id': pool.query_by_request_id,
-                'transaction_id': pool.query_by_transaction_id,
-                'user_id': pool.query_by_user_id,
-            }[params['field']]
-            rows = yield query(params['value'])
-        finally:
-            yield conn.close()
+        if params['field'] == 'request_id':
+            rows = yield self._query_by_request_id(
+                request, voucher_pool, params['value'])
+        else:
+            if_none_match = request.getHeader('If-None-Match')
+            etag, rows = yield self._run_with_pool(
+                request, voucher_pool,
+                lambda pool: self._query_audit_if_modified(
+                    pool, params['field'], params['value'], if_none_match),
+                read_only=True)
+            request.setHeader('ETag', etag)
+            if rows is None:
+                request.setResponseCode(304)
+                returnValue({})
 
         results = [{
             'request_id': row['request_id'],
@@ -85,23 +374,74 @@ class AirtimeServiceApp(object):
         } for row in rows]
         returnValue({'results': results})
 
+    @inlineCallbacks
+    def _query_by_request_id(self, request, voucher_pool, request_id):
+        """
+        Look up the audit row for ``request_id``, which we only need to
+        fetch once because audit rows never change.
+        """
+        key = (voucher_pool, request_id)
+        rows = self.audit_cache.get(key)
+        if rows is None:
+            rows = yield self._run_with_pool(
+                request, voucher_pool,
+                lambda pool: pool.query_by_request_id(request_id),
+                read_only=True)
+            # Nothing found may become something later, so we don't cache
+            # that.
+            if rows:
+                self.audit_cache.put(key, rows)
+        returnValue(rows)
+
+    @inlineCallbacks
+    def _query_audit_if_modified(self, pool, field, value, if_none_match):
+        """
+        Return the ETag for the audit rows with ``field`` set to ``value``
+        and the rows themselves, or ``None`` instead of the rows if the
+        client already has them.
+
+        We get the ETag before the rows, so if rows are added in between
+        the client sees an older ETag and fetches the new rows next time.
+        """
+        etag = '"%s-%s"' % (yield pool.audit_version(field, value))
+        if if_none_match is not None and etag in [
+                tag.strip() for tag in if_none_match.split(',')]:
+            returnValue((etag, None))
+        rows = yield {
+            'transaction_id': pool.query_by_transaction_id,
+            'user_id': pool.query_by_user_id,
+        }[field](value)
+        returnValue((etag, rows))
+
+    @inlineCallbacks
+    def _create_pool(self, pool):
+        already_exists = yield pool.exists()
+        if already_exists:
+            # The pool may be in use, so we can only do online upgrades here.
+            yield pool.upgrade_tables(online=True)
+        else:
+            yield pool.create_tables()
+        returnValue(already_exists)
+
     @handler('/<string:voucher_pool>', methods=['PUT'])
+    @access_logged
+    @timed
+    @admission_controlled
     @inlineCallbacks
     def create_pool(self, request, voucher_pool):
-        conn = yield self.engine.connect()
-        pool = VoucherPool(voucher_pool, conn)
-        try:
-            already_exists = yield pool.exists()
-            if not already_exists:
-                request.setResponseCode(201)
-                yield pool.create_tables()
-        finally:
-            yield conn.close()
+        # Creating a pool is how its tables get upgraded.
+        already_exists = yield self._run_with_pool(
+            request, voucher_pool, self._create_pool, check_schema=False)
+        if not already_exists:
+            request.setResponseCode(201)
 
         returnValue({'created': not already_exists})
 
     @handler(
         '/<string:voucher_pool>/import/<string:request_id>', methods=['PUT'])
+    @access_logged
+    @timed
+    @admission_controlled
     @inlineCallbacks
     def import_vouchers(self, request, voucher_pool, request_id):
         set_request_id(request, request_id)
@@ -114,31 +454,88 @@ class AirtimeServiceApp(object):
             raise BadRequestParams(
                 "Content-MD5 header does not match content.")
 
+        # We need all the rows for each attempt if the import is retried.
         reader = csv.DictReader(StringIO(content))
-        row_iter = lowercase_row_keys(reader)
+        rows = list(lowercase_row_keys(reader))
 
-        conn = yield self.engine.connect()
-        try:
-            pool = VoucherPool(voucher_pool, conn)
-            yield pool.import_vouchers(request_id, content_md5, row_iter)
-        finally:
-            yield conn.close()
+        if (self.import_chunk_size is not None and
+                len(rows) > self.import_chunk_size):
+            # Duplicates share the result, like they do in _run_once().
+            yield self.single_flight.run(
+                (voucher_pool, 'import', request_id), content_md5,
+                self._import_in_chunks, request, voucher_pool, request_id,
+                content_md5, rows)
+        else:
+            yield self._run_once(
+                request, voucher_pool, 'import', request_id, content_md5,
+                lambda pool: pool.import_vouchers(
+                    request_id, content_md5, rows))
 
         request.setResponseCode(201)
         returnValue({'imported': True})
 
+    def _stage_import_chunk(self, request, voucher_pool, request_id,
+                            content_md5, chunk, rows):
+        return self._retry_with_pool(
+            request, voucher_pool, 'import',
+            lambda pool: pool.stage_import_chunk(
+                request_id, content_md5, self.import_chunk_size, chunk,
+                rows))
+
+    @inlineCallbacks
+    def _import_in_chunks(self, request, voucher_pool, request_id,
+                          content_md5, rows):
+        """
+        Import ``rows`` in chunks of ``import_chunk_size``, staging up to
+        ``import_concurrency`` chunks at once on separate connections.
+
+        Nothing is added to the pool until every chunk has been staged, and
+        then all the vouchers are added in one transaction. Chunks staged
+        by an earlier attempt at the same import are skipped, so a failed
+        import can be retried without duplicating vouchers.
+        """
+        chunk_size = self.import_chunk_size
+        already_imported = yield self._retry_with_pool(
+            request, voucher_pool, 'import',
+            lambda pool: pool.prepare_import(
+                request_id, content_md5, chunk_size, rows))
+        if already_imported:
+            return
+
+        chunks = [rows[i:i + chunk_size]
+                  for i in xrange(0, len(rows), chunk_size)]
+        semaphore = DeferredSemaphore(self.import_concurrency)
+        # If a chunk fails we still wait for the others, so nothing is
+        # being staged when we respond and the client retries.
+        results = yield DeferredList([
+            semaphore.run(
+                self._stage_import_chunk, request, voucher_pool, request_id,
+                content_md5, chunk, chunk_rows)
+            for chunk, chunk_rows in enumerate(chunks)
+        ], consumeErrors=True)
+        for success, result in results:
+            if not success:
+                result.raiseException()
+
+        yield self._retry_with_pool(
+            request, voucher_pool, 'import',
+            lambda pool: pool.finish_import(
+                request_id, content_md5, len(chunks), rows))
+
     @handler('/<string:voucher_pool>/voucher_counts', methods=['GET'])
+    @access_logged
+    @timed
+    @admission_controlled
     @inlineCallbacks
     def voucher_counts(self, request, voucher_pool):
         # This sets the request_id on the request object.
         get_url_params(request, [], ['request_id'])
 
-        conn = yield self.engine.connect()
-        try:
-            pool = VoucherPool(voucher_pool, conn)
-            rows = yield pool.count_vouchers()
-        finally:
-            yield conn.close()
+        rows = yield self._run_with_pool(
+            request, voucher_pool, lambda pool: pool.count_vouchers(),
+            read_only=True)
+        # This lets the issuance stats estimate when vouchers will run out.
+        self.issuance_stats.set_available(voucher_pool, rows)
 
         results = [{
             'operator': row['operator'],
@@ -148,27 +545,97 @@ class AirtimeServiceApp(object):
         } for row in rows]
         returnValue({'voucher_counts': results})
 
+    @handler('/<string:voucher_pool>/catalog', methods=['GET'])
+    @access_logged
+    @timed
+    @admission_controlled
+    @inlineCallbacks
+    def catalog(self, request, voucher_pool):
+        # This sets the request_id on the request object.
+        get_url_params(request, [], ['request_id'])
+
+        catalog = yield self._run_with_pool(
+            request, voucher_pool, lambda pool: pool.list_catalog(),
+            read_only=True)
+
+        results = [{
+            'operator': operator,
+            'denomination': denomination,
+        } for operator, denomination in catalog]
+        returnValue({'catalog': results})
+
     @handler(
         '/<string:voucher_pool>/export/<string:request_id>', methods=['PUT'])
+    @access_logged
+    @timed
+    @admission_controlled
     @inlineCallbacks
     def export_vouchers(self, request, voucher_pool, request_id):
         set_request_id(request, request_id)
         params = get_json_params(
-            request, [], ['count', 'operators', 'denominations'])
-        conn = yield self.engine.connect()
-        try:
-            pool = VoucherPool(voucher_pool, conn)
-            response = yield pool.export_vouchers(
+            request, [], ['count', 'operators', 'denominations', 'page_size',
+                          'page_token'])
+        if params.get('page_size') is not None:
+            response = yield self._export_page(
+                request, voucher_pool, request_id, params)
+            returnValue(response)
+        if params.get('page_token') is not None:
+            raise BadRequestParams("page_token requires page_size.")
+
+        response = yield self._run_once(
+            request, voucher_pool, 'export', request_id, params,
+            lambda pool: pool.export_vouchers(
                 request_id, params.get('count'), params.get('operators'),
-                params.get('denominations'))
-        finally:
-            yield conn.close()
+                params.get('denominations')))
 
         returnValue({
             'vouchers': response['vouchers'],
             'warnings': response['warnings'],
         })
 
+    def _export_page(self, request, voucher_pool, request_id, params):
+        """
+        Export one page of a paged export.
+
+        Each page claims at most ``page_size`` vouchers in its own
+        transaction, so a large export doesn't hold one long transaction
+        open, and an interrupted export can carry on from the last page it
+        got. The first page has no ``page_token``, and each page returns
+        the token for the next one, or ``None`` after the last page.
+        Replaying a token returns the same page.
+
+        Pages larger than ``max_export_page_size`` are refused, because each
+        one is claimed and returned in one go.
+        """
+        page_size = params['page_size']
+        if not isinstance(page_size, int) or page_size < 1:
+            raise BadRequestParams("page_size must be a positive integer.")
+        if page_size > self.max_export_page_size:
+            raise BadRequestParams("page_size must be at most %s." % (
+                self.max_export_page_size,))
+        page_token = params.get('page_token')
+        if page_token is None:
+            page = 0
+        elif isinstance(page_token, basestring) and page_token.isdigit():
+            page = int(page_token)
+        else:
+            raise BadRequestParams("Unknown page_token.")
+
+        # Like _run_once(), but each page is a separate request.
+        d = self.single_flight.run(
+            (voucher_pool, 'export', request_id, page), params,
+            self._retry_with_pool, request, voucher_pool, 'export',
+            lambda pool: pool.export_page(
+                request_id, params.get('count'), params.get('operators'),
+                params.get('denominations'), page_size, page))
+        return d.addCallback(lambda response: {
+            'vouchers': response['vouchers'],
+            'warnings': response['warnings'],
+            'next_page_token': (
+                None if response['next_page'] is None
+                else str(response['next_page'])),
+        })
+
 
 def lowercase_row_keys(rows):
     for row in rows:
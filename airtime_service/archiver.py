@@ -0,0 +1,64 @@
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python import log
+
+from .models import VoucherPool
+
+
+DEFAULT_BATCH_SIZE = 500
+
+
+class VoucherArchiver(object):
+    """
+    Moves used vouchers out of the live vouchers table of every pool.
+
+    Vouchers are moved in transactions of at most ``batch_size`` vouchers so
+    that we don't hold locks on the vouchers table for long.
+    """
+
+    def __init__(self, engine, batch_size=DEFAULT_BATCH_SIZE,
+                 voucher_pool_class=VoucherPool):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.voucher_pool_class = voucher_pool_class
+
+    @inlineCallbacks
+    def archive_pool(self, pool):
+        """
+        Archive all used vouchers in ``pool``, one batch at a time.
+
+        Returns a Deferred that fires with the number of vouchers moved.
+        """
+        archived = 0
+        while True:
+            moved = yield pool.archive_used_vouchers(self.batch_size)
+            archived += moved
+            if moved < self.batch_size:
+                returnValue(archived)
+
+    @inlineCallbacks
+    def _archive(self):
+        conn = yield self.engine.connect()
+        try:
+            pool_names = yield self.voucher_pool_class.list_pool_names(conn)
+            for pool_name in pool_names:
+                try:
+                    archived = yield self.archive_pool(
+                        self.voucher_pool_class(pool_name, conn))
+                except Exception:
+                    log.err(None, "Archiving pool %r failed." % (pool_name,))
+                    continue
+                if archived:
+                    log.msg("Archived %s used vouchers from pool %r." % (
+                        archived, pool_name))
+        finally:
+            yield conn.close()
+
+    def archive(self):
+        """
+        Archive used vouchers in all pools.
+
+        Errors are logged rather than returned, so this can be called
+        repeatedly by a :class:`TimerService`.
+        """
+        d = self._archive()
+        return d.addErrback(log.err, "Archiving used vouchers failed.")
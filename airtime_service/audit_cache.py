@@ -0,0 +1,49 @@
+from .lru import LRUCache
+
+
+DEFAULT_MAX_ENTRIES = 10000
+
+
+class AuditCache(LRUCache):
+    """
+    Remembers the results of audit lookups that can't change.
+
+    Once an audit row has been written it is never changed or deleted, so
+    a request_id lookup that found something will always find the same
+    thing. Lookups that found nothing may find something later, so the
+    caller shouldn't cache those.
+
+    When there are more than ``max_entries`` entries, the least recently
+    used ones are forgotten. Hit and miss counts are reported by the admin
+    ``/audit_cache`` endpoint.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        super(AuditCache, self).__init__(max_entries)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Return the cached value for ``key``, or ``None`` if we don't have
+        one.
+        """
+        value = super(AuditCache, self).get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def put(self, key, value):
+        # The value can't have changed, so there's nothing to replace.
+        if key not in self:
+            super(AuditCache, self).put(key, value)
+
+    def stats(self):
+        return {
+            'entries': len(self),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
@@ -0,0 +1,83 @@
+from twisted.application.service import Service
+from twisted.internet.defer import DeferredSemaphore, maybeDeferred
+from twisted.python.threadpool import ThreadPool
+
+
+class DatabaseThreads(Service):
+    """
+    Reactor proxy that gives database engines a dedicated thread pool.
+
+    alchimia runs queries in whatever thread pool ``getThreadPool()`` returns,
+    so an engine created with this as its reactor gets our pool instead of the
+    reactor's shared one. Everything else is delegated to the real reactor.
+
+    The thread pool is started and stopped with the service.
+    """
+
+    def __init__(self, reactor, size):
+        self._reactor = reactor
+        self._threadpool = ThreadPool(minthreads=0, maxthreads=size,
+                                      name='airtime-service-db')
+
+    def __getattr__(self, name):
+        return getattr(self._reactor, name)
+
+    def getThreadPool(self):
+        return self._threadpool
+
+    def startService(self):
+        Service.startService(self)
+        self._threadpool.start()
+
+    def stopService(self):
+        Service.stopService(self)
+        self._threadpool.stop()
+
+
+class PoolLimiter(object):
+    """
+    Limits concurrent database work per voucher pool.
+
+    Work beyond the limit for a pool waits in a FIFO queue for that pool, so
+    a busy pool can't take every database thread and waiting requests are
+    served in order. A ``limit`` of ``None`` disables limiting.
+    """
+
+    def __init__(self, limit=None):
+        self.limit = limit
+        self._semaphores = {}
+
+    def _get_semaphore(self, pool_name):
+        semaphore = self._semaphores.get(pool_name)
+        if semaphore is None:
+            semaphore = DeferredSemaphore(self.limit)
+            self._semaphores[pool_name] = semaphore
+        return semaphore
+
+    def _release_idle(self, result, pool_name, semaphore):
+        # We don't want to keep a semaphore around for every pool we've ever
+        # seen, so we drop them when nothing is using them.
+        idle = semaphore.tokens == semaphore.limit and not semaphore.waiting
+        if idle and self._semaphores.get(pool_name) is semaphore:
+            del self._semaphores[pool_name]
+        return result
+
+    def in_flight(self, pool_name):
+        semaphore = self._semaphores.get(pool_name)
+        if semaphore is None:
+            return 0
+        return semaphore.limit - semaphore.tokens
+
+    def waiting(self, pool_name):
+        semaphore = self._semaphores.get(pool_name)
+        if semaphore is None:
+            return 0
+        return len(semaphore.waiting)
+
+    def run(self, pool_name, func, *args, **kw):
+        if self.limit is None:
+            return maybeDeferred(func, *args, **kw)
+        semaphore = self._get_semaphore(pool_name)
+        d = semaphore.run(func, *args, **kw)
+        d.addBoth(self._release_idle, pool_name, semaphore)
+        return d
@@ -0,0 +1,192 @@
+from collections import defaultdict, deque
+import json
+import os
+
+from twisted.application.service import Service
+from twisted.python import log
+
+
+DEFAULT_BUCKET_SECONDS = 60
+DEFAULT_BUCKETS = 60
+
+EVENTS = ['imported', 'issued', 'exported', 'no_voucher']
+
+
+class _TypeStats(object):
+    """
+    Event counts for one voucher type in one pool, in time buckets.
+    """
+
+    def __init__(self):
+        # Unused vouchers, if we know how many there are.
+        self.available = None
+        # [bucket start, {event: count}], oldest first.
+        self.buckets = deque()
+
+    def add(self, bucket_start, event, count):
+        if not self.buckets or self.buckets[-1][0] != bucket_start:
+            self.buckets.append([bucket_start, defaultdict(int)])
+        self.buckets[-1][1][event] += count
+        if self.available is not None:
+            if event == 'imported':
+                self.available += count
+            elif event in ('issued', 'exported'):
+                self.available = max(0, self.available - count)
+
+    def expire(self, oldest_start):
+        while self.buckets and self.buckets[0][0] < oldest_start:
+            self.buckets.popleft()
+
+    def totals(self):
+        totals = dict((event, 0) for event in EVENTS)
+        for _, counts in self.buckets:
+            for event, count in counts.iteritems():
+                totals[event] += count
+        return totals
+
+
+class IssuanceStats(Service):
+    """
+    Keeps rolling counts of vouchers imported, issued and exported, and of
+    issue requests that found no voucher, for each voucher type in each
+    pool.
+
+    Counts are kept in buckets of ``bucket_seconds`` seconds, and only the
+    last ``buckets`` buckets are kept. Pools record events as they commit
+    them, so reporting rates doesn't touch the database.
+
+    We only know how many vouchers are available once something has told
+    us, which :meth:`set_available` does with the results of a voucher
+    count. After that we keep track of it ourselves, so we can estimate
+    how long until each voucher type runs out.
+
+    Each process only sees its own events, so with several processes
+    serving a pool each reports its share of the rates.
+
+    If ``state_path`` is set, the counts are saved there when the service
+    stops and loaded again when it starts.
+    """
+
+    def __init__(self, clock, bucket_seconds=DEFAULT_BUCKET_SECONDS,
+                 buckets=DEFAULT_BUCKETS, state_path=None):
+        self.clock = clock
+        self.bucket_seconds = bucket_seconds
+        self.window = bucket_seconds * buckets
+        self.state_path = state_path
+        self.started = clock.seconds()
+        self._types = {}
+
+    def _bucket_start(self, now):
+        return now - (now % self.bucket_seconds)
+
+    def _get_type(self, voucher_pool, operator, denomination):
+        key = (voucher_pool, operator, denomination)
+        type_stats = self._types.get(key)
+        if type_stats is None:
+            type_stats = self._types[key] = _TypeStats()
+        return type_stats
+
+    def record(self, voucher_pool, operator, denomination, event, count=1):
+        type_stats = self._get_type(voucher_pool, operator, denomination)
+        type_stats.add(
+            self._bucket_start(self.clock.seconds()), event, count)
+
+    def record_vouchers(self, voucher_pool, event, vouchers):
+        """
+        Record ``event`` for each voucher dict in ``vouchers``.
+        """
+        counts = defaultdict(int)
+        for voucher in vouchers:
+            counts[(voucher['operator'], voucher['denomination'])] += 1
+        for (operator, denomination), count in counts.iteritems():
+            self.record(voucher_pool, operator, denomination, event, count)
+
+    def set_available(self, voucher_pool, voucher_counts):
+        """
+        Set the number of available vouchers from ``voucher_counts`` rows,
+        as returned by :meth:`VoucherPool.count_vouchers`.
+        """
+        for row in voucher_counts:
+            if not row['used']:
+                self._get_type(
+                    voucher_pool, row['operator'], row['denomination'],
+                ).available = row['count']
+
+    def report(self, voucher_pool=None):
+        """
+        Return counts and per-second rates over the window for each voucher
+        type, with the estimated seconds until it runs out if we know how
+        many vouchers it has left and it is being used.
+        """
+        now = self.clock.seconds()
+        oldest_start = self._bucket_start(now - self.window)
+        # Rates are over the part of the window we've been counting for.
+        seconds = float(max(
+            self.bucket_seconds, min(self.window, now - self.started)))
+        results = []
+        for key, type_stats in sorted(self._types.iteritems()):
+            if voucher_pool is not None and key[0] != voucher_pool:
+                continue
+            type_stats.expire(oldest_start)
+            totals = type_stats.totals()
+            used_rate = (totals['issued'] + totals['exported']) / seconds
+            depletion_seconds = None
+            if type_stats.available is not None and used_rate > 0:
+                depletion_seconds = type_stats.available / used_rate
+            result = dict(zip(['pool', 'operator', 'denomination'], key))
+            result.update(totals)
+            result.update({
+                'issue_rate': totals['issued'] / seconds,
+                'export_rate': totals['exported'] / seconds,
+                'no_voucher_rate': totals['no_voucher'] / seconds,
+                'available': type_stats.available,
+                'depletion_seconds': depletion_seconds,
+            })
+            results.append(result)
+        return {'window': self.window, 'stats': results}
+
+    def _dump(self):
+        return [{
+            'pool': voucher_pool,
+            'operator': operator,
+            'denomination': denomination,
+            'available': type_stats.available,
+            'buckets': list(type_stats.buckets),
+        } for (voucher_pool, operator, denomination), type_stats
+            in sorted(self._types.iteritems())]
+
+    def _load(self, state):
+        oldest_start = self._bucket_start(self.clock.seconds() - self.window)
+        for entry in state:
+            type_stats = self._get_type(
+                entry['pool'], entry['operator'], entry['denomination'])
+            type_stats.available = entry['available']
+            for bucket_start, counts in entry['buckets']:
+                if bucket_start >= oldest_start:
+                    # We count rates from the oldest bucket we have.
+                    self.started = min(self.started, bucket_start)
+                    type_stats.buckets.append(
+                        [bucket_start, defaultdict(int, counts)])
+
+    def save(self):
+        # We write to a new file and rename it, so an interrupted save
+        # doesn't lose the previous state.
+        tmp_path = self.state_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._dump(), f)
+        os.rename(tmp_path, self.state_path)
+
+    def startService(self):
+        Service.startService(self)
+        if self.state_path is None or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path) as f:
+                self._load(json.load(f))
+        except Exception:
+            log.err(None, "Loading issuance stats failed.")
+
+    def stopService(self):
+        Service.stopService(self)
+        if self.state_path is not None:
+            self.save()
@@ -0,0 +1,82 @@
+import json
+import os
+import Queue
+import threading
+
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+from twisted.python.logfile import LogFile
+
+
+DEFAULT_MAX_QUEUED = 10000
+DEFAULT_LOG_ROTATE_LENGTH = 10 * 1024 * 1024
+DEFAULT_MAX_ROTATED_FILES = 5
+
+_STOP = object()
+
+
+class LogWriter(object):
+    """
+    Writes entries as lines of JSON to a rotating log file.
+
+    Entries are queued in memory and written by a background thread, so
+    the reactor thread never waits for the disk. If more than
+    ``max_queued`` entries are waiting, new ones are dropped and counted
+    rather than slowing the caller down.
+    """
+
+    def __init__(self, log_path, max_queued=DEFAULT_MAX_QUEUED,
+                 name='airtime-service-log'):
+        self.log_path = log_path
+        self.name = name
+        self.dropped = 0
+        self._queue = Queue.Queue(max_queued)
+        self._thread = None
+
+    def start(self):
+        directory, name = os.path.split(os.path.abspath(self.log_path))
+        logfile = LogFile(
+            name, directory, rotateLength=DEFAULT_LOG_ROTATE_LENGTH,
+            maxRotatedFiles=DEFAULT_MAX_ROTATED_FILES)
+        self._thread = threading.Thread(
+            target=self._write_entries, args=(logfile,), name=self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the writer once everything already queued has been written.
+
+        Returns a Deferred that fires when the log file has been closed. We
+        wait for the writer in another thread so the reactor isn't blocked.
+        """
+        thread, self._thread = self._thread, None
+        return deferToThread(self._stop_writer, thread)
+
+    def _stop_writer(self, thread):
+        # This blocks if the queue is full, until the writer makes room.
+        self._queue.put(_STOP)
+        thread.join()
+
+    def write(self, entry):
+        """
+        Queue ``entry`` to be written, or drop it if the queue is full.
+        """
+        try:
+            self._queue.put_nowait(entry)
+        except Queue.Full:
+            self.dropped += 1
+
+    def _write_entries(self, logfile):
+        try:
+            while True:
+                entry = self._queue.get()
+                if entry is _STOP:
+                    break
+                logfile.write(json.dumps(entry) + '\n')
+                if self._queue.empty():
+                    logfile.flush()
+        except Exception:
+            log.err(None, "%s writer failed." % (self.name,))
+        finally:
+            logfile.close()
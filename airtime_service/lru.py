@@ -0,0 +1,64 @@
+from collections import deque
+
+
+class LRUCache(object):
+    """
+    Maps keys to values, forgetting the least recently used ones when there
+    are more than ``max_entries``.
+
+    Lookups are on hot paths, so recency is tracked with the "clock"
+    approximation of LRU: a lookup only marks its entry as used. When we
+    need room, we go through entries from oldest to newest, and ones that
+    have been used since we last came past them get another chance instead
+    of being forgotten.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        # Values are [value, used since we last came past].
+        self._entries = {}
+        self._order = deque()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def iteritems(self):
+        """
+        Iterate over ``(key, value)`` pairs without marking them as used.
+        """
+        for key, entry in self._entries.iteritems():
+            yield key, entry[0]
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        entry[1] = True
+        return entry[0]
+
+    def put(self, key, value):
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry[:] = [value, True]
+            return
+        # We make room first, so the new entry is never the one forgotten.
+        while len(self._order) >= self.max_entries:
+            oldest = self._order.popleft()
+            entry = self._entries[oldest]
+            if entry[1]:
+                entry[1] = False
+                self._order.append(oldest)
+            else:
+                del self._entries[oldest]
+        self._entries[key] = [value, False]
+        self._order.append(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._order.clear()
@@ -0,0 +1,495 @@
+from collections import defaultdict, deque, namedtuple
+from datetime import datetime
+from functools import wraps
+import json
+
+from twisted.internet.defer import maybeDeferred, succeed
+
+from .models import (
+    NoVoucherPool, NoVoucherAvailable, AuditMismatch, IncompleteImport,
+    UnknownExportPage,
+)
+from .timing import NULL_TIMER
+
+
+MEMORY_SCHEME = 'memory://'
+
+
+def is_memory_conn_str(conn_str):
+    return conn_str.startswith(MEMORY_SCHEME)
+
+
+class MemoryEngine(object):
+    """
+    Stands in for a database engine, but keeps voucher pools in memory.
+
+    Nothing is persisted, so this is only useful for tests and for finding
+    out how fast we could go without a database.
+    """
+
+    def __init__(self):
+        self.pools = {}
+
+    def connect(self):
+        return succeed(MemoryConnection(self))
+
+
+class MemoryConnection(object):
+    def __init__(self, engine):
+        self._engine = engine
+
+    def close(self):
+        return succeed(None)
+
+
+_VoucherCount = namedtuple(
+    'VoucherCount', ['operator', 'denomination', 'used', 'count'])
+
+
+class VoucherCount(_VoucherCount):
+    """
+    A voucher count row that can be indexed by position or by column name,
+    like the rows :meth:`VoucherPool.count_vouchers` returns.
+    """
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            return getattr(self, key)
+        return super(VoucherCount, self).__getitem__(key)
+
+
+class _PoolData(object):
+    def __init__(self):
+        self.next_id = 1
+        # All vouchers by id.
+        self.vouchers = {}
+        # Ids of unused vouchers for each (operator, denomination), oldest
+        # first. Keys are never removed, so this is also the catalog.
+        self.stock = {}
+        # Voucher counts by (operator, denomination, used).
+        self.counts = defaultdict(int)
+        self.audit = {}
+        self.next_audit_id = 1
+        self.audit_by_transaction_id = defaultdict(list)
+        self.audit_by_user_id = defaultdict(list)
+        # Content MD5 by request_id.
+        self.import_audit = {}
+        # (request data, warnings, voucher ids) by request_id.
+        self.export_audit = {}
+        # (warnings, next position, voucher ids) by (request_id, page).
+        self.export_pages = {}
+        # ((content MD5, chunk size), {chunk: voucher dicts}) by request_id.
+        self.staged_imports = {}
+
+
+def _deferred(func):
+    @wraps(func)
+    def wrapper(*args, **kw):
+        return maybeDeferred(func, *args, **kw)
+    return wrapper
+
+
+class MemoryVoucherPool(object):
+    """
+    In-memory implementation of :class:`VoucherPool`'s public interface.
+
+    Requests, responses and errors are the same as with a database, so this
+    can be swapped in anywhere a :class:`VoucherPool` is used.
+    """
+
+    # These are set by the API, but aren't used here.
+    timer = NULL_TIMER
+    slow_query_log = None
+    # Set to an IssuanceStats to record imports, issues and exports.
+    issuance_stats = None
+
+    def __init__(self, name, connection):
+        self.name = name
+        self._conn = connection
+        self._pools = connection._engine.pools
+
+    def _data(self):
+        data = self._pools.get(self.name)
+        if data is None:
+            raise NoVoucherPool(self.name)
+        return data
+
+    def exists(self):
+        return succeed(self.name in self._pools)
+
+    @_deferred
+    def create_tables(self, metadata=None):
+        if self.name not in self._pools:
+            self._pools[self.name] = _PoolData()
+
+    @_deferred
+    def upgrade_tables(self, batch_size=None, online=False):
+        self._data()
+
+    def check_schema_version(self):
+        return succeed(None)
+
+    def compile_statements(self):
+        pass
+
+    @_deferred
+    def archive_used_vouchers(self, batch_size):
+        # Used vouchers are never in the stock queues, so there's nothing to
+        # move.
+        self._data()
+        return 0
+
+    def _previous_import(self, data, request_id, content_md5):
+        if request_id not in data.import_audit:
+            return False
+        previous_md5 = data.import_audit[request_id]
+        if previous_md5 != content_md5:
+            raise AuditMismatch(previous_md5)
+        return True
+
+    @_deferred
+    def import_vouchers(self, request_id, content_md5, voucher_dicts):
+        data = self._data()
+        if self._previous_import(data, request_id, content_md5):
+            return None
+        self._add_vouchers(data, request_id, content_md5, voucher_dicts)
+
+    def _add_vouchers(self, data, request_id, content_md5, voucher_dicts):
+        now = datetime.utcnow()
+        vouchers = [{
+            'operator': voucher_dict['operator'],
+            'denomination': voucher_dict['denomination'],
+            'voucher': voucher_dict['voucher'],
+            'used': False,
+            'created_at': now,
+            'modified_at': now,
+            'reason': None,
+        } for voucher_dict in voucher_dicts]
+
+        data.import_audit[request_id] = content_md5
+        for voucher in vouchers:
+            voucher['id'] = data.next_id
+            data.next_id += 1
+            data.vouchers[voucher['id']] = voucher
+            voucher_type = (voucher['operator'], voucher['denomination'])
+            data.stock.setdefault(voucher_type, deque()).append(voucher['id'])
+            data.counts[voucher_type + (False,)] += 1
+        self._record_issuance('imported', vouchers)
+
+    def _record_issuance(self, event, vouchers):
+        if self.issuance_stats is not None:
+            self.issuance_stats.record_vouchers(self.name, event, vouchers)
+
+    def _staged_chunks(self, data, request_id, content_md5, chunk_size):
+        key, chunks = data.staged_imports.get(request_id, (None, None))
+        if key != (content_md5, chunk_size):
+            chunks = {}
+            data.staged_imports[request_id] = (
+                (content_md5, chunk_size), chunks)
+        return chunks
+
+    @_deferred
+    def prepare_import(self, request_id, content_md5, chunk_size,
+                       voucher_dicts):
+        data = self._data()
+        if self._previous_import(data, request_id, content_md5):
+            return True
+        self._staged_chunks(data, request_id, content_md5, chunk_size)
+        return False
+
+    @_deferred
+    def stage_import_chunk(self, request_id, content_md5, chunk_size, chunk,
+                           voucher_dicts):
+        chunks = self._staged_chunks(
+            self._data(), request_id, content_md5, chunk_size)
+        if chunk in chunks:
+            return False
+        chunks[chunk] = list(voucher_dicts)
+        return True
+
+    @_deferred
+    def finish_import(self, request_id, content_md5, chunk_count,
+                      voucher_dicts):
+        data = self._data()
+        if self._previous_import(data, request_id, content_md5):
+            return None
+        (staged_md5, _), chunks = data.staged_imports.get(
+            request_id, ((None, None), {}))
+        if staged_md5 != content_md5 or len(chunks) != chunk_count:
+            raise IncompleteImport(request_id, len(chunks), chunk_count)
+        del data.staged_imports[request_id]
+        self._add_vouchers(data, request_id, content_md5, [
+            voucher_dict for chunk in sorted(chunks)
+            for voucher_dict in chunks[chunk]])
+
+    def _format_voucher(self, voucher, fields=None):
+        if fields is None:
+            fields = set(f for f in voucher.keys()
+                         if f not in ('created_at', 'modified_at'))
+        return dict((k, v) for k, v in voucher.items() if k in fields)
+
+    def _issue_voucher(self, data, operator, denomination, reason):
+        stock = data.stock.get((operator, denomination))
+        if not stock:
+            return None
+        voucher = data.vouchers[stock.popleft()]
+        # Like the database version, we return the voucher as it was before
+        # we used it.
+        issued = self._format_voucher(voucher)
+        voucher.update(used=True, reason=reason, modified_at=datetime.utcnow())
+        data.counts[(operator, denomination, False)] -= 1
+        data.counts[(operator, denomination, True)] += 1
+        return issued
+
+    def _audit_request(self, audit_params, req_data, resp_data, error=False):
+        return maybeDeferred(
+            self._add_audit, self._data(), audit_params, req_data, resp_data,
+            error)
+
+    def _add_audit(self, data, audit_params, req_data, resp_data, error):
+        row = {
+            'id': data.next_audit_id,
+            'request_id': audit_params['request_id'],
+            'transaction_id': audit_params['transaction_id'],
+            'user_id': audit_params['user_id'],
+            'request_data': json.dumps(req_data),
+            'response_data': json.dumps(resp_data),
+            'error': error,
+            'created_at': datetime.utcnow(),
+        }
+        data.next_audit_id += 1
+        data.audit[row['request_id']] = row
+        data.audit_by_transaction_id[row['transaction_id']].append(row)
+        data.audit_by_user_id[row['user_id']].append(row)
+
+    def _replay_request(self, row, audit_params, req_data):
+        old_audit_params = {
+            'request_id': row['request_id'],
+            'transaction_id': row['transaction_id'],
+            'user_id': row['user_id'],
+        }
+        old_req_data = json.loads(row['request_data'])
+        old_resp_data = json.loads(row['response_data'])
+        if audit_params != old_audit_params or req_data != old_req_data:
+            raise AuditMismatch()
+
+        if row['error']:
+            exc_class = {
+                'no_voucher': NoVoucherAvailable,
+            }[old_resp_data]
+            raise exc_class()
+        return old_resp_data
+
+    @_deferred
+    def issue_voucher(self, operator, denomination, audit_params):
+        data = self._data()
+        audit_req_data = {'operator': operator, 'denomination': denomination}
+
+        row = data.audit.get(audit_params['request_id'])
+        if row is not None:
+            return self._replay_request(row, audit_params, audit_req_data)
+
+        voucher = self._issue_voucher(data, operator, denomination, 'issued')
+        if voucher is None:
+            self._add_audit(
+                data, audit_params, audit_req_data, 'no_voucher', True)
+            self._record_issuance('no_voucher', [audit_req_data])
+            raise NoVoucherAvailable()
+        self._add_audit(data, audit_params, audit_req_data, voucher, False)
+        self._record_issuance('issued', [voucher])
+        return voucher
+
+    @_deferred
+    def count_vouchers(self):
+        data = self._data()
+        return [VoucherCount(*(voucher_type + (count,)))
+                for voucher_type, count in sorted(data.counts.iteritems())
+                if count]
+
+    def _query_audit(self, rows):
+        return sorted([{
+            'request_id': row['request_id'],
+            'transaction_id': row['transaction_id'],
+            'user_id': row['user_id'],
+            'request_data': json.loads(row['request_data']),
+            'response_data': json.loads(row['response_data']),
+            'error': row['error'],
+            'created_at': row['created_at'],
+        } for row in rows], key=lambda row: row['created_at'])
+
+    @_deferred
+    def query_by_request_id(self, request_id):
+        row = self._data().audit.get(request_id)
+        return self._query_audit([] if row is None else [row])
+
+    @_deferred
+    def query_by_transaction_id(self, transaction_id):
+        return self._query_audit(
+            self._data().audit_by_transaction_id.get(transaction_id, []))
+
+    @_deferred
+    def query_by_user_id(self, user_id):
+        return self._query_audit(
+            self._data().audit_by_user_id.get(user_id, []))
+
+    @_deferred
+    def audit_version(self, field, value):
+        data = self._data()
+        if field == 'request_id':
+            row = data.audit.get(value)
+            rows = [] if row is None else [row]
+        else:
+            rows = getattr(data, 'audit_by_%s' % (field,)).get(value, [])
+        return (len(rows), max([row['id'] for row in rows] or [0]))
+
+    @_deferred
+    def list_catalog(self):
+        return sorted(self._data().stock)
+
+    def _list_voucher_types(self, data, operators, denominations):
+        if operators is not None and denominations is not None:
+            return [(operator, denomination)
+                    for operator in operators
+                    for denomination in denominations]
+        return [
+            (operator, denomination)
+            for operator, denomination in sorted(data.stock)
+            if operators is None or operator in operators
+            if denominations is None or denomination in denominations]
+
+    def _replay_export(self, data, request_id, request_data):
+        old_request_data, warnings, voucher_ids = data.export_audit[
+            request_id]
+        if json.loads(old_request_data) != request_data:
+            raise AuditMismatch(old_request_data)
+        fields = ['operator', 'denomination', 'voucher']
+        return {
+            'vouchers': [
+                self._format_voucher(data.vouchers[voucher_id], fields)
+                for voucher_id in voucher_ids],
+            'warnings': json.loads(warnings),
+        }
+
+    @_deferred
+    def export_vouchers(self, request_id, count, operators, denominations):
+        data = self._data()
+        request_data = {
+            'count': count,
+            'operators': operators,
+            'denominations': denominations,
+        }
+        if request_id in data.export_audit:
+            return self._replay_export(data, request_id, request_data)
+
+        vouchers = []
+        warnings = []
+        voucher_types = self._list_voucher_types(
+            data, operators, denominations)
+        for operator, denomination in voucher_types:
+            exported = []
+            while (count is None) or (count > len(exported)):
+                voucher = self._issue_voucher(
+                    data, operator, denomination, 'exported')
+                if voucher is None:
+                    break
+                exported.append(voucher)
+            if (count is not None) and (count > len(exported)):
+                warnings.append(
+                    "Insufficient vouchers available for '%s' '%s'." % (
+                        operator, denomination))
+            vouchers.extend(exported)
+
+        data.export_audit[request_id] = (
+            json.dumps(request_data), json.dumps(warnings),
+            [voucher['id'] for voucher in vouchers])
+        self._record_issuance('exported', vouchers)
+        fields = ['operator', 'denomination', 'voucher']
+        return {
+            'vouchers': [self._format_voucher(v, fields) for v in vouchers],
+            'warnings': warnings,
+        }
+
+    def _claim_export_page(self, data, count, page_size, position):
+        voucher_types, exported = position
+        vouchers = []
+        warnings = []
+        while voucher_types and len(vouchers) < page_size:
+            operator, denomination = voucher_types[0]
+            wanted = page_size - len(vouchers)
+            if count is not None:
+                wanted = min(wanted, count - exported)
+            claimed = []
+            while wanted > len(claimed):
+                voucher = self._issue_voucher(
+                    data, operator, denomination, 'exported')
+                if voucher is None:
+                    break
+                claimed.append(voucher)
+            vouchers.extend(claimed)
+            exported += len(claimed)
+            if len(claimed) < wanted or exported == count:
+                if len(claimed) < wanted and count is not None:
+                    warnings.append(
+                        "Insufficient vouchers available for '%s' '%s'." % (
+                            operator, denomination))
+                voucher_types = voucher_types[1:]
+                exported = 0
+        if not voucher_types:
+            return vouchers, warnings, None
+        return vouchers, warnings, [voucher_types, exported]
+
+    @_deferred
+    def export_page(self, request_id, count, operators, denominations,
+                    page_size, page):
+        data = self._data()
+        request_data = {
+            'count': count,
+            'operators': operators,
+            'denominations': denominations,
+            'page_size': page_size,
+        }
+        if request_id in data.export_audit:
+            old_request_data, old_warnings, old_ids = data.export_audit[
+                request_id]
+            if json.loads(old_request_data) != request_data:
+                raise AuditMismatch(old_request_data)
+        elif page != 0:
+            raise UnknownExportPage(request_id, page)
+
+        fields = ['operator', 'denomination', 'voucher']
+        stored = data.export_pages.get((request_id, page))
+        if stored is not None:
+            warnings, next_position, voucher_ids = stored
+            return {
+                'vouchers': [
+                    self._format_voucher(data.vouchers[voucher_id], fields)
+                    for voucher_id in voucher_ids],
+                'warnings': warnings,
+                'next_page': None if next_position is None else page + 1,
+            }
+
+        if page == 0:
+            position = [
+                self._list_voucher_types(data, operators, denominations), 0]
+            old_request_data, old_warnings, old_ids = (
+                json.dumps(request_data), json.dumps([]), [])
+        else:
+            previous = data.export_pages.get((request_id, page - 1))
+            if previous is None or previous[1] is None:
+                raise UnknownExportPage(request_id, page)
+            position = previous[1]
+
+        vouchers, warnings, next_position = self._claim_export_page(
+            data, count, page_size, position)
+        voucher_ids = [voucher['id'] for voucher in vouchers]
+        data.export_pages[(request_id, page)] = (
+            warnings, next_position, voucher_ids)
+        data.export_audit[request_id] = (
+            old_request_data, json.dumps(json.loads(old_warnings) + warnings),
+            old_ids + voucher_ids)
+        self._record_issuance('exported', vouchers)
+        return {
+            'vouchers': [self._format_voucher(v, fields) for v in vouchers],
+            'warnings': warnings,
+            'next_page': None if next_position is None else page + 1,
+        }
@@ -0,0 +1,585 @@
+"""
+Versioned schema migrations for voucher pool tables.
+
+Each migration brings a pool's tables from the previous schema version to
+its own. The version each set of tables is at is recorded in the
+``airtime_schema_versions`` table, so only migrations that haven't been
+applied yet are run.
+
+Migrations work in small steps (one index or one batch of rows at a time)
+so the pool can stay in use while they run. The exception is voucher
+tables on SQLite that still store names instead of dimension ids, which
+can only be rebuilt while the pool is idle. Online upgrades (from
+``PUT /<pool>``) refuse to do that, so pools that need it must be upgraded
+with the service stopped by running::
+
+    python -m airtime_service.upgrade <database> [pool ...]
+
+Every migration is safe to rerun if it was interrupted.
+"""
+
+from sqlalchemy import MetaData, Table, Column, Integer, String
+from sqlalchemy.schema import CreateTable, CreateIndex
+from sqlalchemy.sql import (
+    select, func, not_, and_, literal_column, table as sql_table,
+    column as sql_column,
+)
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python import log
+from twisted.python.failure import Failure
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+# Fragments of the errors we get when dropping an index that doesn't exist.
+INDEX_MISSING_ERRORS = (
+    # SQLite
+    'no such index',
+    # PostgreSQL
+    'does not exist',
+    # MySQL
+    "check that column/key exists",
+)
+
+# Whether each index with a given name is valid. A failed CREATE INDEX
+# CONCURRENTLY on PostgreSQL leaves an invalid index behind, which queries
+# can't use but which still makes the name "already exist".
+PG_INDEX_VALID_SQL = (
+    "SELECT i.indisvalid FROM pg_index i"
+    " JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s")
+
+# Indexes that older versions created, by table attribute. Names are
+# ix_<table name>_<suffix>.
+OBSOLETE_INDEXES = {
+    # Replaced by the unused index, which is partial on PostgreSQL.
+    'vouchers': ['stock'],
+    # Replaced by the user_created index.
+    'audit': ['user_id'],
+}
+
+# Columns of voucher tables from before the dimension tables existed.
+LEGACY_VOUCHER_COLUMNS = [
+    'id', 'operator', 'denomination', 'voucher', 'used', 'created_at',
+    'modified_at', 'reason',
+]
+
+# Legacy name columns and the dimension id columns that replace them.
+DIMENSION_COLUMNS = [
+    ('operator', 'operator_id', 'operators'),
+    ('denomination', 'denomination_id', 'denominations'),
+]
+
+# How to stop requiring legacy name columns, which new vouchers don't set.
+# Legacy voucher tables are replaced in place on these databases, and
+# rebuilt while the pool is idle on the others.
+NULLABLE_NAME_SQL = {
+    'postgresql': (
+        'ALTER TABLE %(table)s ALTER COLUMN %(column)s DROP NOT NULL'),
+    'mysql': 'ALTER TABLE %(table)s MODIFY %(column)s VARCHAR(255) NULL',
+}
+
+
+schema_metadata = MetaData()
+
+schema_versions = Table(
+    'airtime_schema_versions', schema_metadata,
+    # This is the table name prefix for per-pool tables.
+    Column("name", String(255), primary_key=True),
+    Column("version", Integer(), nullable=False),
+)
+
+
+class InvalidIndex(Exception):
+    """
+    Raised when building an index concurrently leaves it unusable.
+    """
+
+
+class IncompleteMigration(Exception):
+    """
+    Raised when a migration finds rows it didn't manage to update. Running
+    it again carries on from where it stopped.
+    """
+
+
+class OfflineMigrationRequired(Exception):
+    """
+    Raised by online upgrades that would need the pool to be idle.
+    """
+
+
+class SchemaOutOfDate(Exception):
+    """
+    Raised when a pool's tables haven't been upgraded to the schema version
+    this code uses, so queries on them would fail.
+    """
+
+
+# (version, migration) pairs, in the order they must be applied.
+MIGRATIONS = []
+
+
+def migration(version, needs_idle=None):
+    """
+    Decorator that registers a migration to schema ``version``.
+
+    Migrations are called with a pool and a batch size and return a
+    Deferred. If the migration can't run while the pool is in use,
+    ``needs_idle`` is called with the pool and returns a Deferred that
+    fires with ``True`` if the migration has work to do.
+    """
+    def register(func):
+        assert not MIGRATIONS or MIGRATIONS[-1][0] < version
+        func.needs_idle = needs_idle
+        MIGRATIONS.append((version, func))
+        return func
+    return register
+
+
+def _quote(pool, name):
+    return pool._conn._engine.dialect.identifier_preparer.quote(name)
+
+
+def _ignore_errors(failure, fragments):
+    if any(err in str(failure.value) for err in fragments):
+        return None
+    return failure
+
+
+@inlineCallbacks
+def _column_names(pool, table_name):
+    result = yield pool._conn.execute(
+        select([literal_column('*')]).select_from(
+            sql_table(table_name)).limit(1))
+    columns = yield result.keys()
+    yield result.fetchall()
+    returnValue(columns)
+
+
+@inlineCallbacks
+def _in_transaction(pool, func, *args):
+    trx = yield pool._conn.begin()
+    try:
+        result = yield func(*args)
+    except Exception:
+        failure = Failure()
+        yield trx.rollback()
+        failure.raiseException()
+    yield trx.commit()
+    returnValue(result)
+
+
+@inlineCallbacks
+def _max_id(pool, table):
+    result = yield pool.execute_query(select([func.max(table.c.id)]))
+    max_id = yield result.scalar()
+    returnValue(max_id or 0)
+
+
+@migration(1)
+@inlineCallbacks
+def create_missing_tables(pool, batch_size):
+    """
+    Create tables that were added after the pool was created.
+    """
+    engine = pool._conn._engine
+    for table in pool._metadata.sorted_tables:
+        exists = yield engine.has_table(table.name)
+        if not exists:
+            yield pool._conn.execute(CreateTable(table))
+
+
+@inlineCallbacks
+def _fill_dimensions(pool, legacy):
+    for dimension, names in [(pool.operators, legacy.c.operator),
+                             (pool.denominations, legacy.c.denomination)]:
+        rows = yield pool.execute_fetchall(
+            select([names.label('name')]).distinct().where(and_(
+                names.isnot(None),
+                not_(names.in_(select([dimension.c.name]))))))
+        if rows:
+            # Imports may be adding the same names if the pool is in use.
+            yield pool._insert_missing(
+                dimension, [{'name': row['name']} for row in rows])
+
+
+def _copy_legacy_batch(pool, table, legacy, last_id, batch_size):
+    return pool.execute_query(table.insert().from_select(
+        [c.name for c in table.columns],
+        select([
+            legacy.c.id,
+            pool.operators.c.id,
+            pool.denominations.c.id,
+            legacy.c.voucher,
+            legacy.c.used,
+            legacy.c.created_at,
+            legacy.c.modified_at,
+            legacy.c.reason,
+        ]).select_from(legacy.join(
+            pool.operators, pool.operators.c.name == legacy.c.operator,
+        ).join(
+            pool.denominations,
+            pool.denominations.c.name == legacy.c.denomination,
+        )).where(
+            legacy.c.id > last_id,
+        ).order_by(legacy.c.id).limit(batch_size)))
+
+
+def _legacy_table(table):
+    return sql_table(
+        table.name + '_legacy',
+        *[sql_column(name) for name in LEGACY_VOUCHER_COLUMNS])
+
+
+@inlineCallbacks
+def _needs_rebuild(pool):
+    if pool._conn._engine.dialect.name in NULLABLE_NAME_SQL:
+        returnValue(False)
+    for table in [pool.vouchers, pool.vouchers_used]:
+        resuming = yield pool._conn._engine.has_table(
+            _legacy_table(table).name)
+        columns = yield _column_names(pool, table.name)
+        if resuming or 'operator' in columns:
+            returnValue(True)
+    returnValue(False)
+
+
+@inlineCallbacks
+def _rebuild_legacy_vouchers(pool, table, batch_size):
+    legacy = _legacy_table(table)
+    # If the legacy table is still there, we were interrupted while copying
+    # and can carry on from where we stopped.
+    resuming = yield pool._conn._engine.has_table(legacy.name)
+    if not resuming:
+        columns = yield _column_names(pool, table.name)
+        if 'operator' not in columns:
+            return
+        yield pool._conn.execute('ALTER TABLE %s RENAME TO %s' % (
+            _quote(pool, table.name), _quote(pool, legacy.name)))
+        yield pool._conn.execute(CreateTable(table))
+
+    yield _in_transaction(pool, _fill_dimensions, pool, legacy)
+    last_id = yield _max_id(pool, table)
+    while True:
+        yield _in_transaction(
+            pool, _copy_legacy_batch, pool, table, legacy, last_id,
+            batch_size)
+        copied_id = yield _max_id(pool, table)
+        if copied_id == last_id:
+            break
+        last_id = copied_id
+
+    yield pool._conn.execute('DROP TABLE %s' % (_quote(pool, legacy.name),))
+    yield pool._advance_id_sequence(table)
+
+
+def _named_vouchers(table):
+    return sql_table(table.name, *[
+        sql_column(name) for name in ['id'] + [
+            column for names in DIMENSION_COLUMNS for column in names[:2]]])
+
+
+def _backfill_dimension_ids(pool, vouchers, last_id, batch_size):
+    values = dict(
+        (id_column, select([getattr(pool, dimension).c.id]).where(
+            getattr(pool, dimension).c.name == vouchers.c[name]).as_scalar())
+        for name, id_column, dimension in DIMENSION_COLUMNS)
+    return pool.execute_query(vouchers.update().where(and_(
+        vouchers.c.id > last_id,
+        vouchers.c.id <= last_id + batch_size,
+        vouchers.c.operator_id.is_(None),
+    )).values(**values))
+
+
+@inlineCallbacks
+def _add_dimension_ids(pool, table, batch_size):
+    """
+    Replace the operator and denomination names in ``table`` with dimension
+    ids without rebuilding it, so the pool can stay in use.
+
+    We add nullable id columns, stop requiring the names, fill the ids in
+    batches and then drop the names. The id columns stay nullable, because
+    requiring them would lock the table while every row is checked.
+    """
+    columns = yield _column_names(pool, table.name)
+    if 'operator' not in columns:
+        return
+    quoted_table = _quote(pool, table.name)
+    nullable_sql = NULLABLE_NAME_SQL.get(pool._conn._engine.dialect.name)
+    for name, id_column, _ in DIMENSION_COLUMNS:
+        if id_column not in columns:
+            yield pool._conn.execute(
+                'ALTER TABLE %s ADD COLUMN %s INTEGER' % (
+                    quoted_table, _quote(pool, id_column)))
+        if nullable_sql is not None:
+            yield pool._conn.execute(nullable_sql % {
+                'table': quoted_table, 'column': _quote(pool, name)})
+
+    vouchers = _named_vouchers(table)
+    yield _in_transaction(pool, _fill_dimensions, pool, vouchers)
+    # Vouchers may be imported while we do this, so we check the highest id
+    # after each batch.
+    last_id = 0
+    max_id = yield _max_id(pool, table)
+    while last_id < max_id:
+        yield _in_transaction(
+            pool, _backfill_dimension_ids, pool, vouchers, last_id,
+            batch_size)
+        last_id += batch_size
+        max_id = yield _max_id(pool, table)
+
+    result = yield pool._conn.execute(
+        select([func.count()]).select_from(vouchers).where(
+            vouchers.c.operator_id.is_(None)))
+    missing = yield result.scalar()
+    if missing:
+        raise IncompleteMigration(
+            "%s has %s vouchers without dimension ids." % (
+                table.name, missing))
+
+    # Indexed columns can't be dropped on SQLite. The index on used alone
+    # has been replaced too.
+    for name in ['operator', 'denomination', 'used']:
+        yield _drop_index(pool, table, 'ix_%s_%s' % (table.name, name))
+    for name, _, _ in DIMENSION_COLUMNS:
+        yield pool._conn.execute('ALTER TABLE %s DROP COLUMN %s' % (
+            quoted_table, _quote(pool, name)))
+
+
+@migration(2, needs_idle=_needs_rebuild)
+@inlineCallbacks
+def use_dimension_ids(pool, batch_size):
+    """
+    Change voucher tables that store operator and denomination names so
+    that they store dimension ids instead.
+
+    On PostgreSQL and MySQL this happens in place while the pool is in use.
+    Elsewhere the tables are renamed and copied, so nothing may use the
+    pool while this runs.
+    """
+    if pool._conn._engine.dialect.name in NULLABLE_NAME_SQL:
+        rebuild = _add_dimension_ids
+    else:
+        rebuild = _rebuild_legacy_vouchers
+    yield rebuild(pool, pool.vouchers, batch_size)
+    yield rebuild(pool, pool.vouchers_used, batch_size)
+
+
+@inlineCallbacks
+def _fill_catalog_batch(pool, last_id, batch_size):
+    vouchers = pool.vouchers
+    batch = pool._in_pool(pool._select_vouchers(vouchers).where(and_(
+        vouchers.c.id > last_id,
+        vouchers.c.id <= last_id + batch_size,
+    )), vouchers).alias('vouchers')
+    rows = yield pool.execute_fetchall(select([
+        batch.c.operator,
+        batch.c.denomination,
+    ]).distinct())
+    yield pool._update_catalog(rows)
+
+
+@migration(3)
+@inlineCallbacks
+def fill_catalog(pool, batch_size):
+    """
+    Add every (operator, denomination) pair we have vouchers for to the
+    catalog.
+    """
+    last_id = 0
+    max_id = yield _max_id(pool, pool.vouchers)
+    while last_id < max_id:
+        yield _in_transaction(
+            pool, _fill_catalog_batch, pool, last_id, batch_size)
+        last_id += batch_size
+
+
+def _drop_index(pool, table, name):
+    if pool._conn._engine.dialect.name == 'mysql':
+        sql = 'DROP INDEX %s ON %s' % (
+            _quote(pool, name), _quote(pool, table.name))
+    else:
+        sql = 'DROP INDEX %s' % (_quote(pool, name),)
+    d = pool._conn.execute(sql)
+    return d.addErrback(_ignore_errors, INDEX_MISSING_ERRORS)
+
+
+def _create_index(pool, index):
+    dialect = pool._conn._engine.dialect
+    if dialect.name != 'postgresql':
+        # MySQL builds indexes without blocking writes anyway.
+        d = pool._conn.execute(CreateIndex(index))
+    else:
+        d = _create_index_concurrently(pool._conn._engine, index)
+    return d.addErrback(pool._ignore_existing_index)
+
+
+def _create_index_concurrently(engine, index):
+    """
+    Build an index without blocking writes to its table.
+
+    PostgreSQL can only do this outside a transaction, so we use a
+    connection of our own in autocommit mode.
+    """
+    dialect = engine.dialect
+    sql = str(CreateIndex(index).compile(dialect=dialect))
+    sql = sql.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+    quoted_name = dialect.identifier_preparer.quote(index.name)
+
+    def create():
+        conn = engine._engine.raw_connection()
+        try:
+            conn.connection.autocommit = True
+            cursor = conn.cursor()
+            try:
+                _build_index_concurrently(cursor, index.name, quoted_name, sql)
+            finally:
+                cursor.close()
+                conn.connection.autocommit = False
+        finally:
+            conn.close()
+    return engine._defer_to_thread(create)
+
+
+def _build_index_concurrently(cursor, name, quoted_name, sql):
+    """
+    Build the index called ``name`` with ``sql`` unless a valid one already
+    exists. An invalid one left by an interrupted build is dropped and
+    rebuilt, so we never count it as done.
+    """
+    cursor.execute(PG_INDEX_VALID_SQL, (name,))
+    row = cursor.fetchone()
+    if row is not None:
+        if row[0]:
+            return
+        cursor.execute('DROP INDEX CONCURRENTLY %s' % (quoted_name,))
+    cursor.execute(sql)
+    # The build failing should have raised, but we make sure before the old
+    # indexes are dropped.
+    cursor.execute(PG_INDEX_VALID_SQL, (name,))
+    row = cursor.fetchone()
+    if row is None or not row[0]:
+        raise InvalidIndex(name)
+
+
+@migration(4)
+@inlineCallbacks
+def update_indexes(pool, batch_size):
+    """
+    Replace obsolete indexes with the current ones.
+
+    The new indexes are built before the old ones are dropped, so queries
+    always have an index to use.
+    """
+    for table in pool._metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            yield _create_index(pool, index)
+    for attr, suffixes in sorted(OBSOLETE_INDEXES.items()):
+        table = getattr(pool, attr)
+        for suffix in suffixes:
+            yield _drop_index(pool, table, 'ix_%s_%s' % (table.name, suffix))
+
+
+@migration(5)
+@inlineCallbacks
+def create_import_staging(pool, batch_size):
+    """
+    Create the tables that chunked imports stage vouchers in.
+    """
+    yield create_missing_tables(pool, batch_size)
+    for table in [pool.staged_vouchers, pool.import_chunks]:
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            yield _create_index(pool, index)
+
+
+@migration(6)
+@inlineCallbacks
+def add_export_pages(pool, batch_size):
+    """
+    Create the table paged exports record their pages in, and add the page
+    column to exported_vouchers.
+    """
+    yield create_missing_tables(pool, batch_size)
+    table = pool.exported_vouchers
+    columns = yield _column_names(pool, table.name)
+    if 'page' not in columns:
+        yield pool._conn.execute('ALTER TABLE %s ADD COLUMN %s INTEGER' % (
+            _quote(pool, table.name), _quote(pool, 'page')))
+
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+@inlineCallbacks
+def get_schema_version(pool):
+    """
+    Return the schema version of the pool's tables.
+
+    Tables from before versions were recorded are at version 0.
+    """
+    exists = yield pool._conn._engine.has_table(schema_versions.name)
+    if not exists:
+        returnValue(0)
+    result = yield pool._conn.execute(
+        select([schema_versions.c.version]).where(
+            schema_versions.c.name == pool.schema_name()))
+    version = yield result.scalar()
+    returnValue(version or 0)
+
+
+@inlineCallbacks
+def check_schema_version(pool):
+    """
+    Raise :class:`SchemaOutOfDate` if the pool exists and its tables are
+    older than :data:`SCHEMA_VERSION`.
+    """
+    version = yield get_schema_version(pool)
+    if version < SCHEMA_VERSION:
+        exists = yield pool.exists()
+        if exists:
+            raise SchemaOutOfDate(pool.name, version)
+
+
+@inlineCallbacks
+def set_schema_version(pool, version):
+    exists = yield pool._conn._engine.has_table(schema_versions.name)
+    if not exists:
+        d = pool._conn.execute(CreateTable(schema_versions))
+        yield d.addErrback(_ignore_errors, ['already exists'])
+    result = yield pool._conn.execute(
+        schema_versions.update().where(
+            schema_versions.c.name == pool.schema_name(),
+        ).values(version=version))
+    if result.rowcount == 0:
+        yield pool._conn.execute(schema_versions.insert().values(
+            name=pool.schema_name(), version=version))
+
+
+@inlineCallbacks
+def migrate(pool, batch_size=DEFAULT_BATCH_SIZE, online=False):
+    """
+    Apply any migrations the pool's tables are missing.
+
+    If ``online`` is true, the pool may be in use, so we stop with
+    :class:`OfflineMigrationRequired` before any migration that needs it to
+    be idle. Migrations before that one are still applied.
+
+    Returns a Deferred that fires with the versions applied.
+    """
+    version = yield get_schema_version(pool)
+    applied = []
+    for migration_version, func in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        if online and func.needs_idle is not None:
+            needs_idle = yield func.needs_idle(pool)
+            if needs_idle:
+                raise OfflineMigrationRequired(
+                    "%s needs schema version %s to be applied offline." % (
+                        pool.schema_name(), migration_version))
+        yield func(pool, batch_size)
+        yield set_schema_version(pool, migration_version)
+        log.msg("Migrated %s to schema version %s." % (
+            pool.schema_name(), migration_version))
+        applied.append(migration_version)
+    returnValue(applied)
@@ -1,11 +1,28 @@
 from datetime import datetime
 import json
 
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, Text
-from sqlalchemy.sql import select, func, and_, not_
-from twisted.internet.defer import inlineCallbacks, returnValue
+from sqlalchemy import (
+    Column, Integer, String, DateTime, Boolean, Text, Index,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.sql import (
+    select, func, and_, not_, bindparam, union_all, text, false,
+)
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from twisted.python.failure import Failure
 
-from aludel.database import TableCollection, make_table, CollectionMissingError
+from aludel.database import (
+    TableCollection, CollectionMetadata, make_table, CollectionMissingError,
+    TableMissingError,
+)
+
+from .lru import LRUCache
+from .migrations import (
+    migrate, set_schema_version, check_schema_version, SCHEMA_VERSION,
+    DEFAULT_BATCH_SIZE as DEFAULT_MIGRATION_BATCH_SIZE,
+)
+from .timing import NULL_TIMER
 
 
 class VoucherError(Exception):
@@ -24,28 +41,141 @@ class NoVoucherAvailable(VoucherError):
     pass
 
 
+class IncompleteImport(VoucherError):
+    pass
+
+
+class UnknownExportPage(VoucherError):
+    pass
+
+
+# VoucherPool instances are created for every request, so compiled statements
+# are cached at module level. Keys are (pool name, pool id, dialect, driver,
+# shape). Pools can be created through the API, so the cache is bounded.
+MAX_CACHED_STATEMENTS = 10000
+_compiled_statements = LRUCache(MAX_CACHED_STATEMENTS)
+
+
+# Columns set by _update_voucher() when issuing or exporting.
+ISSUE_UPDATE_COLUMNS = ['modified_at', 'reason', 'used']
+
+
+def clear_statement_cache():
+    _compiled_statements.clear()
+
+
+# Fragments of the errors we get when creating an index that already exists.
+INDEX_EXISTS_ERRORS = (
+    # SQLite, PostgreSQL
+    'already exists',
+    # MySQL
+    'Duplicate key name',
+)
+
+# INSERT prefixes that skip rows that would violate a unique constraint.
+# Other databases insert in savepoints instead.
+INSERT_IGNORE_PREFIXES = {
+    'sqlite': 'OR IGNORE',
+    'mysql': 'IGNORE',
+}
+
+
+class make_indexed_table(make_table):
+    """
+    Like :class:`make_table`, but also adds multi-column indexes.
+
+    ``indexes`` maps an index name suffix to a list of column names. Index
+    names are prefixed with the table name, like the ones SQLAlchemy
+    generates for ``index=True``. ``postgresql_where`` maps suffixes to SQL
+    conditions that make those indexes partial on PostgreSQL.
+    """
+
+    def __init__(self, *args, **kw):
+        self.indexes = kw.pop('indexes', {})
+        self.postgresql_where = kw.pop('postgresql_where', {})
+        super(make_indexed_table, self).__init__(*args, **kw)
+
+    def make_table(self, name, metadata):
+        table = super(make_indexed_table, self).make_table(name, metadata)
+        for suffix, columns in sorted(self.indexes.items()):
+            where = self.postgresql_where.get(suffix)
+            Index('ix_%s_%s' % (name, suffix),
+                  *[table.c[column] for column in columns],
+                  postgresql_where=None if where is None else text(where))
+        return table
+
+
+# Building table metadata is relatively expensive, so we only do it once for
+# each recently used pool name. Values are (metadata, {attribute name:
+# table}).
+MAX_CACHED_POOL_TABLES = 1000
+_pool_tables = LRUCache(MAX_CACHED_POOL_TABLES)
+
+
 class VoucherPool(TableCollection):
-    vouchers = make_table(
+    # Replaced with a RequestTimer to record per-phase timing.
+    timer = NULL_TIMER
+    # Set to a SlowQueryLog to record slow queries.
+    slow_query_log = None
+    # Set to an IssuanceStats to record imports, issues and exports.
+    issuance_stats = None
+    # Only set for pools that share their tables with other pools.
+    pool_id = None
+
+    # Operator and denomination names are stored once here, so voucher rows
+    # and their indexes only hold integer ids.
+    operators = make_table(
+        Column("id", Integer(), primary_key=True),
+        Column("name", String(255), nullable=False, unique=True),
+    )
+
+    denominations = make_table(
         Column("id", Integer(), primary_key=True),
-        Column("operator", String(255), nullable=False, index=True),
-        Column("denomination", String(255), nullable=False, index=True),
+        Column("name", String(255), nullable=False, unique=True),
+    )
+
+    vouchers = make_indexed_table(
+        Column("id", Integer(), primary_key=True),
+        Column("operator_id", Integer(), nullable=False),
+        Column("denomination_id", Integer(), nullable=False),
         Column("voucher", String(255), nullable=False, index=True),
-        Column("used", Boolean(), default=False, index=True),
+        Column("used", Boolean(), default=False),
+        Column("created_at", DateTime(timezone=False)),
+        Column("modified_at", DateTime(timezone=False)),
+        Column("reason", String(255), default=None),
+        # This is what we search when issuing a voucher. We only ever look
+        # for unused vouchers, so PostgreSQL can leave the others out.
+        indexes={
+            'unused': ['operator_id', 'denomination_id', 'used', 'id'],
+        },
+        postgresql_where={'unused': 'NOT used'},
+    )
+
+    # Used vouchers are moved here by archive_used_vouchers() so that the
+    # vouchers table only holds stock that can still be issued.
+    vouchers_used = make_table(
+        Column("id", Integer(), primary_key=True, autoincrement=False),
+        Column("operator_id", Integer(), nullable=False),
+        Column("denomination_id", Integer(), nullable=False),
+        Column("voucher", String(255), nullable=False),
+        Column("used", Boolean(), default=True),
         Column("created_at", DateTime(timezone=False)),
         Column("modified_at", DateTime(timezone=False)),
         Column("reason", String(255), default=None),
     )
 
-    audit = make_table(
+    audit = make_indexed_table(
         Column("id", Integer(), primary_key=True),
         Column("request_id", String(255), nullable=False, index=True,
                unique=True),
         Column("transaction_id", String(255), nullable=False, index=True),
-        Column("user_id", String(255), nullable=False, index=True),
+        Column("user_id", String(255), nullable=False),
         Column("request_data", Text(), nullable=False),
         Column("response_data", Text(), nullable=False),
         Column("error", Boolean(), nullable=False),
         Column("created_at", DateTime(timezone=False)),
+        # User queries are ordered by created_at.
+        indexes={'user_created': ['user_id', 'created_at']},
     )
 
     import_audit = make_table(
@@ -67,12 +197,107 @@ class VoucherPool(TableCollection):
 
     exported_vouchers = make_table(
         Column("id", Integer(), primary_key=True),
-        Column("request_id", String(255), nullable=False, index=True,
-               unique=True),
+        # Each export has a row for every voucher it exported.
+        Column("request_id", String(255), nullable=False, index=True),
         Column("voucher_id", Integer(), nullable=False),
         Column("created_at", DateTime(timezone=False)),
+        # The page of a paged export the voucher was on.
+        Column("page", Integer()),
+    )
+
+    # A row for each page of a paged export, so a replayed page gets the
+    # same vouchers back.
+    export_pages = make_table(
+        Column("request_id", String(255), primary_key=True),
+        Column("page", Integer(), primary_key=True, autoincrement=False),
+        Column("warnings", Text(), nullable=False),
+        # Where the next page starts, or NULL after the last page.
+        Column("next_position", Text()),
+        Column("created_at", DateTime(timezone=False)),
     )
 
+    # Chunked imports stage their vouchers here, one transaction per chunk,
+    # and move them to the vouchers table once every chunk is in.
+    staged_vouchers = make_table(
+        Column("id", Integer(), primary_key=True),
+        Column("request_id", String(255), nullable=False, index=True),
+        Column("operator_id", Integer(), nullable=False),
+        Column("denomination_id", Integer(), nullable=False),
+        Column("voucher", String(255), nullable=False),
+        Column("created_at", DateTime(timezone=False)),
+    )
+
+    # A row for each chunk that has been staged, so that a retried chunk
+    # isn't staged twice.
+    import_chunks = make_table(
+        Column("request_id", String(255), primary_key=True),
+        Column("chunk", Integer(), primary_key=True, autoincrement=False),
+        Column("content_md5", String(255), nullable=False),
+        Column("chunk_size", Integer(), nullable=False),
+        Column("created_at", DateTime(timezone=False)),
+    )
+
+    # Every (operator, denomination) pair that has been imported, so we don't
+    # have to scan the vouchers table to find them.
+    catalog = make_table(
+        Column("operator", String(255), primary_key=True),
+        Column("denomination", String(255), primary_key=True),
+    )
+
+    def __init__(self, name, connection, collection_metadata=None):
+        cached = _pool_tables.get(name)
+        if cached is None:
+            super(VoucherPool, self).__init__(
+                name, connection, collection_metadata)
+            _pool_tables.put(name, (self._metadata, dict(
+                (attr, getattr(self, attr)) for attr in self.table_attrs())))
+            return
+
+        # This does what TableCollection.__init__() does, except with
+        # existing tables.
+        self.name = name
+        self._conn = connection
+        self._metadata, tables = cached
+        self.__dict__.update(tables)
+        if collection_metadata is None:
+            collection_metadata = CollectionMetadata(
+                self.collection_type(), connection)
+        self._collection_metadata = collection_metadata
+
+    @classmethod
+    @inlineCallbacks
+    def list_pool_names(cls, conn):
+        """
+        Return the sorted names of all the pools in the database.
+        """
+        collection_metadata = CollectionMetadata(cls.collection_type(), conn)
+        try:
+            pools = yield collection_metadata.get_all_metadata()
+        except TableMissingError:
+            # No pools have been created yet.
+            returnValue([])
+        returnValue(sorted(pools))
+
+    @classmethod
+    def table_attrs(cls):
+        return [attr for attr in dir(cls)
+                if isinstance(getattr(cls, attr), make_table)]
+
+    def _execute_query(self, query, *args, **kw):
+        slow_query_log = self.slow_query_log
+        if slow_query_log is None:
+            return super(VoucherPool, self)._execute_query(query, *args, **kw)
+        start = slow_query_log.start()
+        d = super(VoucherPool, self)._execute_query(query, *args, **kw)
+        # Failed queries are recorded too, and the failure is passed on.
+        return d.addBoth(
+            self._check_slow_query, slow_query_log, start, query, args, kw)
+
+    def _check_slow_query(self, result, slow_query_log, start, query, args,
+                          kw):
+        slow_query_log.finish(start, self, query, args, kw, result)
+        return result
+
     @inlineCallbacks
     def execute_query(self, query, *args, **kw):
         try:
@@ -82,26 +307,123 @@ class VoucherPool(TableCollection):
             raise NoVoucherPool(self.name)
         returnValue(result)
 
+    def _compiled(self, shape, build_statement, column_keys=None):
+        """
+        Return a cached compiled statement, building it if necessary.
+
+        :param tuple shape:
+            Identifies the statement within this pool. Anything that changes
+            the generated SQL (such as the columns being set) must be part of
+            the shape.
+        :param build_statement:
+            Callable that builds the SQLAlchemy expression. Parameters must
+            be ``bindparam()``s so they can be supplied at execution time.
+        :param column_keys:
+            Columns to include in compiled INSERT and UPDATE statements.
+        """
+        dialect = self._conn._engine.dialect
+        key = (self.name, self.pool_id, dialect.name, dialect.driver, shape)
+        compiled = _compiled_statements.get(key)
+        if compiled is None:
+            compiled = build_statement().compile(
+                dialect=dialect, column_keys=column_keys)
+            _compiled_statements.put(key, compiled)
+        return compiled
+
+    def _in_pool(self, query, *tables):
+        """
+        Restrict ``query`` to the rows of ``tables`` that belong to this pool.
+
+        Every row in our tables belongs to this pool, so there's nothing to
+        do here. This is overridden when pools share tables.
+        """
+        return query
+
+    def _insert(self, table):
+        """
+        Return an insert into ``table`` for rows that belong to this pool.
+        """
+        return table.insert()
+
+    def _stmt_audit_insert(self):
+        return self._compiled(('audit_insert',), lambda: (
+            self._insert(self.audit)), [
+            'request_id', 'transaction_id', 'user_id', 'request_data',
+            'response_data', 'error', 'created_at'])
+
+    def _stmt_audit_by_request_id(self):
+        return self._compiled(('audit_by_request_id',), lambda: (
+            self._in_pool(self.audit.select().where(
+                self.audit.c.request_id == bindparam('b_request_id')),
+                self.audit)))
+
+    def _select_vouchers(self, vouchers):
+        """
+        Select from ``vouchers`` with operator and denomination names in
+        place of their ids.
+        """
+        return select([
+            vouchers.c.id,
+            self.operators.c.name.label('operator'),
+            self.denominations.c.name.label('denomination'),
+            vouchers.c.voucher,
+            vouchers.c.used,
+            vouchers.c.reason,
+            vouchers.c.created_at,
+            vouchers.c.modified_at,
+        ]).select_from(vouchers.join(
+            self.operators,
+            self.operators.c.id == vouchers.c.operator_id,
+        ).join(
+            self.denominations,
+            self.denominations.c.id == vouchers.c.denomination_id,
+        ))
+
+    def _stmt_get_voucher(self):
+        return self._compiled(('get_voucher',), lambda: (
+            self._in_pool(self._select_vouchers(self.vouchers).where(and_(
+                self.operators.c.name == bindparam('b_operator'),
+                self.denominations.c.name == bindparam('b_denomination'),
+                not_(self.vouchers.c.used),
+            )), self.vouchers, self.operators, self.denominations).limit(1)))
+
+    def _stmt_update_voucher(self, columns):
+        return self._compiled(('update_voucher',) + tuple(columns), lambda: (
+            self.vouchers.update().where(
+                self.vouchers.c.id == bindparam('b_voucher_id'))), columns)
+
+    def _stmt_exported_voucher_insert(self):
+        return self._compiled(
+            ('exported_voucher_insert',),
+            lambda: self._insert(self.exported_vouchers),
+            ['request_id', 'voucher_id', 'page'])
+
+    def compile_statements(self):
+        """
+        Compile and cache the statements used when issuing vouchers.
+        """
+        self._stmt_audit_insert()
+        self._stmt_audit_by_request_id()
+        self._stmt_get_voucher()
+        self._stmt_update_voucher(ISSUE_UPDATE_COLUMNS)
+        self._stmt_exported_voucher_insert()
+
     def _audit_request(self, audit_params, req_data, resp_data, error=False):
-        request_id = audit_params['request_id']
-        transaction_id = audit_params['transaction_id']
-        user_id = audit_params['user_id']
-        return self.execute_query(
-            self.audit.insert().values(
-                request_id=request_id,
-                transaction_id=transaction_id,
-                user_id=user_id,
-                request_data=json.dumps(req_data),
-                response_data=json.dumps(resp_data),
-                error=error,
-                created_at=datetime.utcnow(),
-            ))
+        return self.execute_query(self._stmt_audit_insert(), {
+            'request_id': audit_params['request_id'],
+            'transaction_id': audit_params['transaction_id'],
+            'user_id': audit_params['user_id'],
+            'request_data': json.dumps(req_data),
+            'response_data': json.dumps(resp_data),
+            'error': error,
+            'created_at': datetime.utcnow(),
+        })
 
     @inlineCallbacks
     def _get_previous_request(self, audit_params, req_data):
         rows = yield self.execute_fetchall(
-            self.audit.select().where(
-                self.audit.c.request_id == audit_params['request_id']))
+            self._stmt_audit_by_request_id(),
+            b_request_id=audit_params['request_id'])
         if not rows:
             returnValue(None)
         [row] = rows
@@ -122,14 +444,155 @@ class VoucherPool(TableCollection):
             raise exc_class()
         returnValue(json.loads(row['response_data']))
 
+    def _ignore_existing_index(self, failure):
+        if any(err in str(failure.value) for err in INDEX_EXISTS_ERRORS):
+            return None
+        return failure
+
+    @inlineCallbacks
+    def _create_indexes(self):
+        # Each index is created in its own implicit transaction, because a
+        # failure aborts the whole transaction in some databases.
+        for table in self._metadata.sorted_tables:
+            for index in sorted(table.indexes, key=lambda i: i.name):
+                d = self._conn.execute(CreateIndex(index))
+                yield d.addErrback(self._ignore_existing_index)
+
+    @inlineCallbacks
+    def create_tables(self, metadata=None):
+        # aludel only creates the tables, so we create their indexes as well.
+        # We need the unique index on audit.request_id for idempotence.
+        yield self._create_tables()
+        yield self._create_indexes()
+        yield set_schema_version(self, SCHEMA_VERSION)
+        result = yield self._collection_metadata.create_collection(
+            self.name, metadata)
+        returnValue(result)
+
+    def _advance_id_sequence(self, table):
+        """
+        Make sure ids generated for ``table`` don't clash with ids that we
+        inserted ourselves.
+        """
+        if self._conn._engine.dialect.name != 'postgresql':
+            # Other databases start after the highest id in the table.
+            return succeed(None)
+        quote = self._conn._engine.dialect.identifier_preparer.quote
+        return self._conn.execute(
+            "SELECT setval(pg_get_serial_sequence('%(table)s', 'id'), "
+            "(SELECT coalesce(max(id), 0) + 1 FROM %(table)s), false)" % {
+                'table': quote(table.name)})
+
+    def schema_name(self):
+        """
+        Return the name the schema version of our tables is recorded under.
+        """
+        return '%s_%s' % (self.collection_type(), self.name)
+
+    def upgrade_tables(self, batch_size=DEFAULT_MIGRATION_BATCH_SIZE,
+                       online=False):
+        """
+        Bring the tables of a pool created by an older version up to date.
+
+        If ``online`` is true, migrations that need the pool to be idle
+        aren't applied. See :mod:`airtime_service.migrations` for what this
+        involves.
+        """
+        return migrate(self, batch_size, online)
+
+    def check_schema_version(self):
+        """
+        Fail with :class:`SchemaOutOfDate` if the pool's tables need to be
+        upgraded before they can be used.
+        """
+        return check_schema_version(self)
+
+    @inlineCallbacks
+    def _list_catalog(self):
+        rows = yield self.execute_fetchall(
+            self._in_pool(self.catalog.select(), self.catalog).order_by(
+                self.catalog.c.operator, self.catalog.c.denomination))
+        returnValue([(row['operator'], row['denomination']) for row in rows])
+
+    @inlineCallbacks
+    def _update_catalog(self, voucher_rows):
+        voucher_types = set(
+            (row['operator'], row['denomination']) for row in voucher_rows)
+        if not voucher_types:
+            return
+        catalog = yield self._list_catalog()
+        new_types = voucher_types.difference(catalog)
+        if new_types:
+            # Concurrent imports may be adding the same pairs.
+            yield self._insert_missing(self.catalog, [{
+                'operator': operator,
+                'denomination': denomination,
+            } for operator, denomination in sorted(new_types)])
+
+    @inlineCallbacks
+    def list_catalog(self):
+        trx = yield self._conn.begin()
+        catalog = yield self._list_catalog()
+        yield trx.commit()
+        returnValue(catalog)
+
+    @inlineCallbacks
+    def _insert_missing(self, table, rows):
+        """
+        Insert ``rows`` into ``table``, skipping any that a concurrent
+        transaction has already added.
+        """
+        prefix = INSERT_IGNORE_PREFIXES.get(self._conn._engine.dialect.name)
+        if prefix is not None:
+            yield self.execute_query(
+                self._insert(table).prefix_with(prefix), rows)
+            return
+
+        # A failed insert aborts the whole transaction on PostgreSQL, so
+        # each row gets a savepoint we can roll back to.
+        for row in rows:
+            yield self._conn.execute('SAVEPOINT insert_missing')
+            try:
+                yield self.execute_query(self._insert(table), row)
+            except IntegrityError:
+                yield self._conn.execute(
+                    'ROLLBACK TO SAVEPOINT insert_missing')
+            yield self._conn.execute('RELEASE SAVEPOINT insert_missing')
+
+    @inlineCallbacks
+    def _get_dimension_ids(self, table, names):
+        """
+        Return a dict mapping each of ``names`` to its id in ``table``,
+        adding any names that aren't there yet.
+        """
+        names = set(names)
+        query = self._in_pool(select([table.c.id, table.c.name]), table)
+        rows = yield self.execute_fetchall(
+            query.where(table.c.name.in_(names)))
+        ids = dict((row['name'], row['id']) for row in rows)
+        new_names = names.difference(ids)
+        if new_names:
+            # Concurrent imports may be adding the same names, so we skip
+            # any they've added since we looked.
+            yield self._insert_missing(
+                table, [{'name': name} for name in sorted(new_names)])
+            # Names added by other transactions may not be in our snapshot
+            # (on MySQL, for example), but a locking read sees them.
+            rows = yield self.execute_fetchall(
+                query.where(table.c.name.in_(new_names)).with_for_update(
+                    read=True))
+            ids.update((row['name'], row['id']) for row in rows)
+        returnValue(ids)
+
     @inlineCallbacks
     def import_vouchers(self, request_id, content_md5, voucher_dicts):
         trx = yield self._conn.begin()
 
         # Check if we've already done this one.
-        rows = yield self.execute_fetchall(
-            self.import_audit.select().where(
-                self.import_audit.c.request_id == request_id))
+        rows = yield self.timer.measure('lookup', self.execute_fetchall(
+            self._in_pool(self.import_audit.select().where(
+                self.import_audit.c.request_id == request_id),
+                self.import_audit)))
         if rows:
             yield trx.rollback()
             [row] = rows
@@ -139,7 +602,7 @@ class VoucherPool(TableCollection):
                 raise AuditMismatch(row['content_md5'])
 
         yield self.execute_query(
-            self.import_audit.insert().values(
+            self._insert(self.import_audit).values(
                 request_id=request_id,
                 content_md5=content_md5,
                 created_at=datetime.utcnow(),
@@ -147,18 +610,224 @@ class VoucherPool(TableCollection):
 
         # NOTE: We're assuming that this will be fast enough. If it isn't,
         # we'll need to make a database-specific plan of some kind.
+        voucher_dicts = list(voucher_dicts)
+        operator_ids = yield self.timer.measure(
+            'dimensions', self._get_dimension_ids(
+                self.operators, [vd['operator'] for vd in voucher_dicts]))
+        denomination_ids = yield self.timer.measure(
+            'dimensions', self._get_dimension_ids(
+                self.denominations,
+                [vd['denomination'] for vd in voucher_dicts]))
+
         now = datetime.utcnow()
         voucher_rows = [{
-            'operator': voucher_dict['operator'],
-            'denomination': voucher_dict['denomination'],
+            'operator_id': operator_ids[voucher_dict['operator']],
+            'denomination_id': denomination_ids[voucher_dict['denomination']],
             'voucher': voucher_dict['voucher'],
             'created_at': now,
             'modified_at': now,
         } for voucher_dict in voucher_dicts]
-        result = yield self.execute_query(self.vouchers.insert(), voucher_rows)
-        yield trx.commit()
+        result = yield self.timer.measure('insert', self.execute_query(
+            self._insert(self.vouchers), voucher_rows))
+        yield self.timer.measure(
+            'catalog', self._update_catalog(voucher_dicts))
+        yield self.timer.measure('commit', trx.commit())
+        self._record_issuance('imported', voucher_dicts)
+        returnValue(result)
+
+    def _record_issuance(self, event, vouchers):
+        if self.issuance_stats is not None:
+            self.issuance_stats.record_vouchers(self.name, event, vouchers)
+
+    @inlineCallbacks
+    def _in_transaction(self, func, *args):
+        trx = yield self._conn.begin()
+        try:
+            result = yield func(*args)
+        except Exception:
+            failure = Failure()
+            yield trx.rollback()
+            failure.raiseException()
+        yield self.timer.measure('commit', trx.commit())
         returnValue(result)
 
+    @inlineCallbacks
+    def _previous_import(self, request_id, content_md5):
+        """
+        Return ``True`` if ``request_id`` has already been imported, or
+        raise :class:`AuditMismatch` if it was imported with different
+        content.
+        """
+        rows = yield self.timer.measure('lookup', self.execute_fetchall(
+            self._in_pool(self.import_audit.select().where(
+                self.import_audit.c.request_id == request_id),
+                self.import_audit)))
+        if not rows:
+            returnValue(False)
+        [row] = rows
+        if row['content_md5'] != content_md5:
+            raise AuditMismatch(row['content_md5'])
+        returnValue(True)
+
+    @inlineCallbacks
+    def _clear_staging(self, request_id):
+        for table in [self.staged_vouchers, self.import_chunks]:
+            yield self.execute_query(self._in_pool(
+                table.delete().where(table.c.request_id == request_id),
+                table))
+
+    @inlineCallbacks
+    def _prepare_import(self, request_id, content_md5, chunk_size,
+                        voucher_dicts):
+        previous = yield self._previous_import(request_id, content_md5)
+        if previous:
+            returnValue(True)
+
+        # Chunks staged for different content, or split up differently,
+        # don't match the chunks we're about to stage.
+        chunks = self.import_chunks
+        rows = yield self.execute_fetchall(self._in_pool(
+            select([chunks.c.content_md5, chunks.c.chunk_size]).distinct(
+            ).where(chunks.c.request_id == request_id), chunks))
+        if any((row['content_md5'], row['chunk_size']) !=
+               (content_md5, chunk_size) for row in rows):
+            yield self._clear_staging(request_id)
+
+        # Chunks are staged concurrently, so we add new operators and
+        # denominations now instead of letting the chunks race to do it.
+        yield self.timer.measure('dimensions', self._get_dimension_ids(
+            self.operators, [vd['operator'] for vd in voucher_dicts]))
+        yield self.timer.measure('dimensions', self._get_dimension_ids(
+            self.denominations, [vd['denomination'] for vd in voucher_dicts]))
+        returnValue(False)
+
+    def prepare_import(self, request_id, content_md5, chunk_size,
+                       voucher_dicts):
+        """
+        Get ready to import ``voucher_dicts`` in chunks of ``chunk_size``
+        with :meth:`stage_import_chunk` and :meth:`finish_import`.
+
+        Returns a Deferred that fires with ``True`` if this import has
+        already been done, in which case there's nothing more to do.
+        """
+        return self._in_transaction(
+            self._prepare_import, request_id, content_md5, chunk_size,
+            voucher_dicts)
+
+    @inlineCallbacks
+    def _stage_import_chunk(self, request_id, content_md5, chunk_size, chunk,
+                            voucher_dicts):
+        now = datetime.utcnow()
+        yield self.execute_query(self._insert(self.import_chunks).values(
+            request_id=request_id,
+            chunk=chunk,
+            content_md5=content_md5,
+            chunk_size=chunk_size,
+            created_at=now,
+        ))
+        # prepare_import() has added all the names, so these only look up
+        # their ids.
+        operator_ids = yield self.timer.measure(
+            'dimensions', self._get_dimension_ids(
+                self.operators, [vd['operator'] for vd in voucher_dicts]))
+        denomination_ids = yield self.timer.measure(
+            'dimensions', self._get_dimension_ids(
+                self.denominations,
+                [vd['denomination'] for vd in voucher_dicts]))
+        yield self.timer.measure('insert', self.execute_query(
+            self._insert(self.staged_vouchers), [{
+                'request_id': request_id,
+                'operator_id': operator_ids[vd['operator']],
+                'denomination_id': denomination_ids[vd['denomination']],
+                'voucher': vd['voucher'],
+                'created_at': now,
+            } for vd in voucher_dicts]))
+
+    @inlineCallbacks
+    def stage_import_chunk(self, request_id, content_md5, chunk_size, chunk,
+                           voucher_dicts):
+        """
+        Stage chunk number ``chunk`` of an import in its own transaction.
+
+        Chunks of the same import can be staged concurrently on different
+        connections. Returns a Deferred that fires with ``False`` if the
+        chunk had already been staged.
+        """
+        try:
+            yield self._in_transaction(
+                self._stage_import_chunk, request_id, content_md5,
+                chunk_size, chunk, voucher_dicts)
+        except IntegrityError:
+            # This chunk's row in import_chunks is already there.
+            returnValue(False)
+        returnValue(True)
+
+    def _staged_voucher_columns(self):
+        """
+        Return (vouchers column name, staged value) pairs for moving staged
+        vouchers into the vouchers table.
+        """
+        staged = self.staged_vouchers
+        return [
+            ('operator_id', staged.c.operator_id),
+            ('denomination_id', staged.c.denomination_id),
+            ('voucher', staged.c.voucher),
+            ('used', false()),
+            ('created_at', staged.c.created_at),
+            ('modified_at', staged.c.created_at.label('modified_at')),
+        ]
+
+    @inlineCallbacks
+    def _finish_import(self, request_id, content_md5, chunk_count,
+                       voucher_dicts):
+        previous = yield self._previous_import(request_id, content_md5)
+        if previous:
+            returnValue(False)
+
+        chunks = self.import_chunks
+        result = yield self.execute_query(self._in_pool(
+            select([func.count()]).where(and_(
+                chunks.c.request_id == request_id,
+                chunks.c.content_md5 == content_md5)), chunks))
+        staged_chunks = yield result.scalar()
+        if staged_chunks != chunk_count:
+            raise IncompleteImport(request_id, staged_chunks, chunk_count)
+
+        yield self.execute_query(
+            self._insert(self.import_audit).values(
+                request_id=request_id,
+                content_md5=content_md5,
+                created_at=datetime.utcnow(),
+            ))
+        staged = self.staged_vouchers
+        columns = self._staged_voucher_columns()
+        yield self.timer.measure('insert', self.execute_query(
+            self.vouchers.insert().from_select(
+                [name for name, _ in columns],
+                self._in_pool(select([value for _, value in columns]).where(
+                    staged.c.request_id == request_id), staged,
+                ).order_by(staged.c.id))))
+        yield self.timer.measure(
+            'catalog', self._update_catalog(voucher_dicts))
+        yield self._clear_staging(request_id)
+        returnValue(True)
+
+    @inlineCallbacks
+    def finish_import(self, request_id, content_md5, chunk_count,
+                      voucher_dicts):
+        """
+        Move the staged vouchers of an import into the pool and record the
+        import, all in one transaction.
+
+        This raises :class:`IncompleteImport` unless all ``chunk_count``
+        chunks have been staged.
+        """
+        imported = yield self._in_transaction(
+            self._finish_import, request_id, content_md5, chunk_count,
+            voucher_dicts)
+        if imported:
+            self._record_issuance('imported', voucher_dicts)
+
     def _format_voucher(self, voucher_row, fields=None):
         if fields is None:
             fields = set(f for f in voucher_row.keys()
@@ -168,11 +837,8 @@ class VoucherPool(TableCollection):
     @inlineCallbacks
     def _get_voucher(self, operator, denomination):
         result = yield self.execute_query(
-            self.vouchers.select().where(and_(
-                self.vouchers.c.operator == operator,
-                self.vouchers.c.denomination == denomination,
-                not_(self.vouchers.c.used),
-            )).limit(1))
+            self._stmt_get_voucher(),
+            b_operator=operator, b_denomination=denomination)
         voucher = yield result.fetchone()
         if voucher is not None:
             voucher = self._format_voucher(voucher)
@@ -181,8 +847,8 @@ class VoucherPool(TableCollection):
     def _update_voucher(self, voucher_id, **values):
         values['modified_at'] = datetime.utcnow()
         return self.execute_query(
-            self.vouchers.update().where(
-                self.vouchers.c.id == voucher_id).values(**values))
+            self._stmt_update_voucher(sorted(values.keys())),
+            b_voucher_id=voucher_id, **values)
 
     @inlineCallbacks
     def _issue_voucher(self, operator, denomination, reason):
@@ -192,56 +858,137 @@ class VoucherPool(TableCollection):
         yield self._update_voucher(voucher['id'], used=True, reason=reason)
         returnValue(voucher)
 
+    @inlineCallbacks
+    def _replay_request(self, failure, audit_params, audit_req_data):
+        previous_data = yield self.timer.measure(
+            'lookup', self._get_previous_request(
+                audit_params, audit_req_data))
+        if previous_data is None:
+            # The conflict wasn't on the request_id, so it's a real error.
+            failure.raiseException()
+        returnValue(previous_data)
+
     @inlineCallbacks
     def issue_voucher(self, operator, denomination, audit_params):
         audit_req_data = {'operator': operator, 'denomination': denomination}
 
-        # If we have already seen this request, return the same response as
-        # before. Appropriate exceptions will be raised here.
-        previous_data = yield self._get_previous_request(
-            audit_params, audit_req_data)
-        if previous_data is not None:
-            returnValue(previous_data)
-
-        # This is a new request, so handle it accordingly.
-        trx = yield self._conn.begin()
+        # We assume this is a new request and rely on the unique request_id
+        # in the audit table to tell us otherwise. The common case is then
+        # just the claim and a single audit insert, and two concurrent
+        # requests with the same request_id can't both succeed.
+        trx = yield self.timer.measure('begin', self._conn.begin())
         try:
-            voucher = yield self._issue_voucher(
-                operator, denomination, 'issued')
+            voucher = yield self.timer.measure('claim', self._issue_voucher(
+                operator, denomination, 'issued'))
             if voucher is None:
-                yield self._audit_request(
-                    audit_params, audit_req_data, 'no_voucher', error=True)
-                raise NoVoucherAvailable()
+                yield self.timer.measure('audit', self._audit_request(
+                    audit_params, audit_req_data, 'no_voucher', error=True))
             else:
-                yield self._audit_request(
-                    audit_params, audit_req_data, voucher)
-        finally:
-            yield trx.commit()
+                yield self.timer.measure('audit', self._audit_request(
+                    audit_params, audit_req_data, voucher))
+        except IntegrityError:
+            # If we have already seen this request, we undo our claim and
+            # return the same response as before. Appropriate exceptions will
+            # be raised here. Other constraint violations are re-raised.
+            failure = Failure()
+            yield trx.rollback()
+            previous_data = yield self._replay_request(
+                failure, audit_params, audit_req_data)
+            returnValue(previous_data)
+        except Exception:
+            failure = Failure()
+            yield trx.rollback()
+            failure.raiseException()
+
+        yield self.timer.measure('commit', trx.commit())
+        if voucher is None:
+            self._record_issuance('no_voucher', [audit_req_data])
+            raise NoVoucherAvailable()
+        self._record_issuance('issued', [voucher])
         returnValue(voucher)
 
+    def _all_vouchers(self):
+        """
+        Return a selectable over both live and archived vouchers.
+        """
+        columns = [
+            'id', 'operator_id', 'denomination_id', 'voucher', 'used',
+            'reason', 'created_at', 'modified_at']
+        return union_all(*[
+            self._in_pool(select([table.c[name] for name in columns]), table)
+            for table in [self.vouchers, self.vouchers_used]
+        ]).alias('all_vouchers')
+
     @inlineCallbacks
     def count_vouchers(self):
         trx = yield self._conn.begin()
+        vouchers = self._all_vouchers()
+        counts = select([
+            vouchers.c.operator_id,
+            vouchers.c.denomination_id,
+            vouchers.c.used,
+            func.count(vouchers.c.voucher).label('count'),
+        ]).group_by(
+            vouchers.c.operator_id,
+            vouchers.c.denomination_id,
+            vouchers.c.used,
+        ).alias('counts')
         rows = yield self.execute_fetchall(
             select([
-                self.vouchers.c.operator,
-                self.vouchers.c.denomination,
-                self.vouchers.c.used,
-                func.count(self.vouchers.c.voucher).label('count'),
-            ]).group_by(
-                self.vouchers.c.operator,
-                self.vouchers.c.denomination,
-                self.vouchers.c.used,
-            )
+                self.operators.c.name.label('operator'),
+                self.denominations.c.name.label('denomination'),
+                counts.c.used,
+                counts.c.count,
+            ]).select_from(counts.join(
+                self.operators,
+                self.operators.c.id == counts.c.operator_id,
+            ).join(
+                self.denominations,
+                self.denominations.c.id == counts.c.denomination_id,
+            ))
         )
         yield trx.commit()
         returnValue(rows)
 
+    @inlineCallbacks
+    def archive_used_vouchers(self, batch_size):
+        """
+        Move up to ``batch_size`` used vouchers to the ``vouchers_used``
+        table.
+
+        Returns a Deferred that fires with the number of vouchers moved.
+        """
+        trx = yield self._conn.begin()
+        try:
+            # Archived vouchers keep their ids. Some databases (SQLite, for
+            # example) reuse the highest id if it's deleted, so we never
+            # archive that voucher.
+            max_id = select([func.max(self.vouchers.c.id)]).as_scalar()
+            rows = yield self.execute_fetchall(
+                self._in_pool(self.vouchers.select().where(and_(
+                    self.vouchers.c.used,
+                    self.vouchers.c.id < max_id,
+                )), self.vouchers).order_by(
+                    self.vouchers.c.id).limit(batch_size))
+            if rows:
+                yield self.execute_query(
+                    self._insert(self.vouchers_used),
+                    [dict(row) for row in rows])
+                yield self.execute_query(
+                    self.vouchers.delete().where(
+                        self.vouchers.c.id.in_([row['id'] for row in rows])))
+        except Exception:
+            failure = Failure()
+            yield trx.rollback()
+            failure.raiseException()
+        yield trx.commit()
+        returnValue(len(rows))
+
     @inlineCallbacks
     def _query_audit(self, where_clause):
         rows = yield self.execute_fetchall(
-            self.audit.select().where(where_clause).order_by(
-                self.audit.c.created_at))
+            self._in_pool(self.audit.select().where(where_clause),
+                          self.audit).order_by(self.audit.c.created_at))
         returnValue([{
             'request_id': row['request_id'],
             'transaction_id': row['transaction_id'],
@@ -262,23 +1009,44 @@ class VoucherPool(TableCollection):
         return self._query_audit(self.audit.c.user_id == user_id)
 
     @inlineCallbacks
-    def _list_operators(self):
-        rows = yield self.execute_fetchall(
-            select([self.vouchers.c.operator]).distinct())
-        returnValue([r['operator'] for r in rows])
+    def audit_version(self, field, value):
+        """
+        Return the number of audit rows with ``field`` set to ``value`` and
+        the id of the newest one.
+
+        Audit rows are never changed or deleted, so the results of an audit
+        query can only change when this does. We need the count as well as
+        the id because concurrent transactions may commit their rows out of
+        id order.
+        """
+        rows = yield self.execute_fetchall(self._in_pool(
+            select([func.count(self.audit.c.id), func.max(self.audit.c.id)]
+                   ).where(self.audit.c[field] == value),
+            self.audit))
+        [(count, latest_id)] = rows
+        returnValue((count, latest_id or 0))
 
     @inlineCallbacks
-    def _list_denominations(self):
-        rows = yield self.execute_fetchall(
-            select([self.vouchers.c.denomination]).distinct())
-        returnValue([r['denomination'] for r in rows])
+    def _list_voucher_types(self, operators, denominations):
+        if operators is not None and denominations is not None:
+            returnValue([(operator, denomination)
+                         for operator in operators
+                         for denomination in denominations])
+
+        # If either is unspecified, we only want pairs that exist.
+        catalog = yield self._list_catalog()
+        returnValue([
+            (operator, denomination) for operator, denomination in catalog
+            if operators is None or operator in operators
+            if denominations is None or denomination in denominations])
 
     @inlineCallbacks
     def _get_previous_export(self, trx, request_id, request_data):
         # Check if we've already done this one.
         rows = yield self.execute_fetchall(
-            self.export_audit.select().where(
-                self.export_audit.c.request_id == request_id))
+            self._in_pool(self.export_audit.select().where(
+                self.export_audit.c.request_id == request_id),
+                self.export_audit))
         if not rows:
             returnValue(None)
 
@@ -287,22 +1055,36 @@ class VoucherPool(TableCollection):
             yield trx.rollback()
             raise AuditMismatch(row['request_data'])
 
-        vouchers = yield self.execute_fetchall(
-            self.vouchers.select().select_from(
-                self.vouchers.join(
-                    self.exported_vouchers,
-                    self.exported_vouchers.c.voucher_id == self.vouchers.c.id)
-                ).where(self.exported_vouchers.c.request_id == request_id))
-
+        vouchers = yield self._get_exported_vouchers(
+            self.exported_vouchers.c.request_id == request_id)
         yield trx.rollback()
-        fields = ['operator', 'denomination', 'voucher']
         returnValue({
-            'vouchers': [self._format_voucher(v, fields) for v in vouchers],
+            'vouchers': vouchers,
             'warnings': json.loads(row['warnings']),
         })
 
     @inlineCallbacks
-    def _export_vouchers(self, request_id, count, operator, denomination):
+    def _get_exported_vouchers(self, *conditions):
+        exported_ids = self._in_pool(
+            select([self.exported_vouchers.c.voucher_id]).where(
+                and_(*conditions)),
+            self.exported_vouchers)
+        # These vouchers may have been archived since they were exported.
+        # Filtering a union of both tables can't use their primary keys, so
+        # we look in each one separately.
+        vouchers = []
+        for table in [self.vouchers, self.vouchers_used]:
+            rows = yield self.execute_fetchall(self._in_pool(
+                self._select_vouchers(table).where(
+                    table.c.id.in_(exported_ids)), table))
+            vouchers.extend(rows)
+        vouchers.sort(key=lambda voucher: voucher['id'])
+        fields = ['operator', 'denomination', 'voucher']
+        returnValue([self._format_voucher(v, fields) for v in vouchers])
+
+    @inlineCallbacks
+    def _export_vouchers(self, request_id, count, operator, denomination,
+                         page=None):
         vouchers = []
         warnings = []
         while (count is None) or (count > len(vouchers)):
@@ -311,10 +1093,8 @@ class VoucherPool(TableCollection):
             if voucher is None:
                 break
             yield self.execute_query(
-                self.exported_vouchers.insert().values(
-                    request_id=request_id,
-                    voucher_id=voucher['id'],
-                ))
+                self._stmt_exported_voucher_insert(),
+                request_id=request_id, voucher_id=voucher['id'], page=page)
             vouchers.append(voucher)
 
         if (count is not None) and (count > len(vouchers)):
@@ -333,22 +1113,16 @@ class VoucherPool(TableCollection):
         }
         trx = yield self._conn.begin()
 
-        previous_response = yield self._get_previous_export(
-            trx, request_id, request_data)
+        previous_response = yield self.timer.measure(
+            'lookup', self._get_previous_export(trx, request_id, request_data))
 
         if previous_response is not None:
             returnValue(previous_response)
 
-        if operators is None:
-            operators = yield self._list_operators()
-
-        if denominations is None:
-            denominations = yield self._list_denominations()
+        voucher_types = yield self._list_voucher_types(
+            operators, denominations)
 
         response = {'vouchers': [], 'warnings': []}
-        voucher_types = [(operator, denomination)
-                         for operator in operators
-                         for denomination in denominations]
         for operator, denomination in voucher_types:
             vouchers, warnings = yield self._export_vouchers(
                 request_id, count, operator, denomination)
@@ -358,12 +1132,155 @@ class VoucherPool(TableCollection):
             response['warnings'].extend(warnings)
 
         yield self.execute_query(
-            self.export_audit.insert().values(
+            self._insert(self.export_audit).values(
                 request_id=request_id,
                 request_data=json.dumps(request_data),
                 warnings=json.dumps(response['warnings']),
                 created_at=datetime.utcnow(),
             ))
 
-        yield trx.commit()
+        yield self.timer.measure('commit', trx.commit())
+        self._record_issuance('exported', response['vouchers'])
+        returnValue(response)
+
+    @inlineCallbacks
+    def _claim_export_page(self, request_id, count, page_size, page,
+                           position):
+        """
+        Export up to ``page_size`` vouchers, starting at ``position``.
+
+        A position is the list of voucher types still to export and the
+        number of vouchers of the first one that have already been
+        exported. Returns the vouchers, the warnings, and the position the
+        next page starts at, which is ``None`` if there's nothing left.
+        """
+        voucher_types, exported = position
+        vouchers = []
+        warnings = []
+        while voucher_types and len(vouchers) < page_size:
+            operator, denomination = voucher_types[0]
+            wanted = page_size - len(vouchers)
+            if count is not None:
+                wanted = min(wanted, count - exported)
+            claimed, type_warnings = yield self._export_vouchers(
+                request_id, wanted, operator, denomination, page)
+            vouchers.extend(claimed)
+            exported += len(claimed)
+            if len(claimed) < wanted or exported == count:
+                # Running out only matters if we were asked for a count.
+                if count is not None:
+                    warnings.extend(type_warnings)
+                voucher_types = voucher_types[1:]
+                exported = 0
+        if not voucher_types:
+            returnValue((vouchers, warnings, None))
+        returnValue((vouchers, warnings, [voucher_types, exported]))
+
+    @inlineCallbacks
+    def _export_page(self, request_id, request_data, page):
+        audit_rows = yield self.timer.measure(
+            'lookup', self.execute_fetchall(
+                self._in_pool(self.export_audit.select().where(
+                    self.export_audit.c.request_id == request_id),
+                    self.export_audit)))
+        if audit_rows:
+            [audit_row] = audit_rows
+            if json.loads(audit_row['request_data']) != request_data:
+                raise AuditMismatch(audit_row['request_data'])
+        elif page != 0:
+            raise UnknownExportPage(request_id, page)
+
+        pages = self.export_pages
+        rows = yield self.timer.measure('lookup', self.execute_fetchall(
+            self._in_pool(pages.select().where(and_(
+                pages.c.request_id == request_id,
+                pages.c.page.in_([page - 1, page]))), pages)))
+        page_rows = dict((row['page'], row) for row in rows)
+        row = page_rows.get(page)
+        if row is not None:
+            vouchers = yield self._get_exported_vouchers(
+                self.exported_vouchers.c.request_id == request_id,
+                self.exported_vouchers.c.page == page)
+            returnValue(([], {
+                'vouchers': vouchers,
+                'warnings': json.loads(row['warnings']),
+                'next_page': (
+                    None if row['next_position'] is None else page + 1),
+            }))
+
+        if page == 0:
+            voucher_types = yield self._list_voucher_types(
+                request_data['operators'], request_data['denominations'])
+            position = [voucher_types, 0]
+        else:
+            previous = page_rows.get(page - 1)
+            if previous is None or previous['next_position'] is None:
+                raise UnknownExportPage(request_id, page)
+            position = json.loads(previous['next_position'])
+
+        vouchers, warnings, next_position = yield self._claim_export_page(
+            request_id, request_data['count'], request_data['page_size'],
+            page, position)
+
+        now = datetime.utcnow()
+        yield self.execute_query(self._insert(pages).values(
+            request_id=request_id,
+            page=page,
+            warnings=json.dumps(warnings),
+            next_position=(
+                None if next_position is None else json.dumps(next_position)),
+            created_at=now,
+        ))
+        # The export's audit row has the warnings of all its pages so far.
+        if page == 0:
+            yield self.execute_query(
+                self._insert(self.export_audit).values(
+                    request_id=request_id,
+                    request_data=json.dumps(request_data),
+                    warnings=json.dumps(warnings),
+                    created_at=now,
+                ))
+        elif warnings:
+            yield self.execute_query(self._in_pool(
+                self.export_audit.update().where(
+                    self.export_audit.c.request_id == request_id),
+                self.export_audit,
+            ).values(warnings=json.dumps(
+                json.loads(audit_row['warnings']) + warnings)))
+
+        fields = ['operator', 'denomination', 'voucher']
+        returnValue((vouchers, {
+            'vouchers': [self._format_voucher(v, fields) for v in vouchers],
+            'warnings': warnings,
+            'next_page': None if next_position is None else page + 1,
+        }))
+
+    @inlineCallbacks
+    def export_page(self, request_id, count, operators, denominations,
+                    page_size, page):
+        """
+        Export page number ``page`` of a paged export, claiming at most
+        ``page_size`` vouchers in its own transaction.
+
+        Pages must be exported in order, starting at 0, and asking for a
+        page that doesn't follow one we've exported raises
+        :class:`UnknownExportPage`. Asking for a page again returns the
+        same vouchers. The response's ``next_page`` is ``None`` after the
+        last page.
+        """
+        request_data = {
+            'count': count,
+            'operators': operators,
+            'denominations': denominations,
+            'page_size': page_size,
+        }
+        try:
+            vouchers, response = yield self._in_transaction(
+                self._export_page, request_id, request_data, page)
+        except IntegrityError:
+            # Someone else exported this page at the same time, so we return
+            # the page they exported.
+            vouchers, response = yield self._in_transaction(
+                self._export_page, request_id, request_data, page)
+        self._record_issuance('exported', vouchers)
         returnValue(response)
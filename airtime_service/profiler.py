@@ -0,0 +1,144 @@
+from StringIO import StringIO
+import cProfile
+import marshal
+import pstats
+import sys
+import threading
+
+from twisted.internet.task import deferLater
+
+
+DEFAULT_MAX_DURATION = 60.0
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+def format_stats(stats):
+    """
+    Format :class:`pstats.Stats` as text, most expensive calls first.
+    """
+    output = StringIO()
+    stats.stream = output
+    stats.sort_stats('cumulative').print_stats()
+    return output.getvalue()
+
+
+def dump_stats(stats):
+    """
+    Serialise :class:`pstats.Stats` in the format written by
+    :meth:`pstats.Stats.dump_stats`, which tools like ``snakeviz`` and
+    ``gprof2dot`` read.
+    """
+    return marshal.dumps(stats.stats)
+
+
+def format_collapsed(counts):
+    """
+    Format sampled stack counts as collapsed stacks (one ``frame;frame;...
+    count`` line per stack), which is what ``flamegraph.pl`` reads.
+    """
+    return ''.join(
+        '%s %d\n' % (stack, count) for stack, count in sorted(counts.items()))
+
+
+class StackSampler(object):
+    """
+    Periodically records the stack of every thread in the process.
+
+    Sampling happens in its own thread, so it sees the reactor thread and the
+    database threads without needing the reactor to be responsive.
+    """
+
+    def __init__(self, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.interval = interval
+        self.counts = {}
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='stack-sampler')
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        return self.counts
+
+    def _run(self):
+        # Event.wait() always returns None before Python 2.7, so we check
+        # is_set() instead.
+        while not self._stopped.is_set():
+            self._stopped.wait(self.interval)
+            if not self._stopped.is_set():
+                self.sample()
+
+    def sample(self):
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        for ident, frame in sys._current_frames().items():
+            if ident == self._thread.ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('%s (%s:%d)' % (
+                    code.co_name, code.co_filename, code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            key = ';'.join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+
+class Profiler(object):
+    """
+    Captures profiles of the running process on demand.
+
+    Only one capture can run at a time, and none may run for longer than
+    ``max_duration`` seconds.
+    """
+
+    def __init__(self, clock, max_duration=DEFAULT_MAX_DURATION,
+                 sample_interval=DEFAULT_SAMPLE_INTERVAL):
+        self.clock = clock
+        self.max_duration = max_duration
+        self.sample_interval = sample_interval
+        self.running = False
+
+    def _finished(self, result):
+        self.running = False
+        return result
+
+    def _capture(self, duration, start, stop):
+        if self.running:
+            raise ProfilerBusy()
+        self.running = True
+        start()
+        d = deferLater(self.clock, duration, stop)
+        return d.addBoth(self._finished)
+
+    def profile(self, duration):
+        """
+        Run ``cProfile`` on the reactor thread for ``duration`` seconds.
+
+        Returns a Deferred that fires with the resulting
+        :class:`pstats.Stats`.
+        """
+        profile = cProfile.Profile()
+
+        def stop():
+            profile.disable()
+            return pstats.Stats(profile)
+        return self._capture(duration, profile.enable, stop)
+
+    def sample(self, duration):
+        """
+        Sample the stacks of all threads for ``duration`` seconds.
+
+        Returns a Deferred that fires with a dict mapping collapsed stacks to
+        the number of times they were seen.
+        """
+        sampler = StackSampler(self.sample_interval)
+        return self._capture(duration, sampler.start, sampler.stop)
@@ -0,0 +1,95 @@
+import math
+
+
+def source_address(request, trusted_proxies=()):
+    """
+    Return the address of the client that sent ``request``.
+
+    Requests that come through one of ``trusted_proxies`` are from the last
+    address in ``X-Forwarded-For`` that isn't a trusted proxy itself.
+    Addresses to the left of that were added by clients, so we ignore them.
+    """
+    address = getattr(request.client, 'host', None)
+    if address not in trusted_proxies:
+        return address
+    forwarded = ','.join(
+        request.requestHeaders.getRawHeaders('X-Forwarded-For', []))
+    for hop in reversed(forwarded.split(',')):
+        hop = hop.strip()
+        if not hop:
+            continue
+        address = hop
+        if address not in trusted_proxies:
+            break
+    return address
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after):
+        super(RateLimited, self).__init__(retry_after)
+        self.retry_after = retry_after
+
+
+class _Bucket(object):
+    __slots__ = ['tokens', 'updated']
+
+    def __init__(self, tokens, updated):
+        self.tokens = tokens
+        self.updated = updated
+
+
+class RateLimiter(object):
+    """
+    Limits how often each key (a user id, for example) may do something.
+
+    Each key has a bucket of ``burst`` tokens that refills at ``rate``
+    tokens per second, and every call takes a token. Calls that find the
+    bucket empty fail with :class:`RateLimited`.
+
+    A bucket that has been idle long enough to refill is the same as a new
+    one, so we forget those. We look for them at most once every
+    ``burst / rate`` seconds, when a call is checked.
+    """
+
+    def __init__(self, clock, rate, burst=None):
+        if burst is None:
+            burst = max(1, int(math.ceil(rate)))
+        self.clock = clock
+        self.rate = rate
+        self.burst = burst
+        self.rejected = 0
+        self._buckets = {}
+        self._refill_time = burst / float(rate)
+        self._last_sweep = clock.seconds()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _sweep(self, now):
+        self._last_sweep = now
+        idle_since = now - self._refill_time
+        for key, bucket in self._buckets.items():
+            if bucket.updated <= idle_since:
+                del self._buckets[key]
+
+    def check(self, key):
+        """
+        Take a token from ``key``'s bucket, or raise :class:`RateLimited`
+        with the number of seconds until one is available.
+        """
+        now = self.clock.seconds()
+        if now - self._last_sweep >= self._refill_time:
+            self._sweep(now)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = _Bucket(self.burst, now)
+        else:
+            bucket.tokens = min(
+                self.burst,
+                bucket.tokens + (now - bucket.updated) * self.rate)
+            bucket.updated = now
+        if bucket.tokens < 1:
+            self.rejected += 1
+            raise RateLimited(
+                int(math.ceil((1 - bucket.tokens) / self.rate)))
+        bucket.tokens -= 1
@@ -0,0 +1,113 @@
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+from twisted.python import log
+
+
+DEFAULT_MAX_LAG = 5.0
+
+
+class ReplicaLagUnknown(Exception):
+    pass
+
+
+@inlineCallbacks
+def _query_lag_postgresql(engine):
+    # NOTE: This overestimates lag on an idle replica, because nothing new has
+    #       been replayed. That just sends reads to the primary when there's
+    #       very little traffic, which is harmless.
+    result = yield engine.execute(
+        "SELECT COALESCE(EXTRACT(EPOCH FROM"
+        " now() - pg_last_xact_replay_timestamp()), 0)")
+    lag = yield result.scalar()
+    returnValue(float(lag))
+
+
+@inlineCallbacks
+def _query_lag_mysql(engine):
+    result = yield engine.execute("SHOW SLAVE STATUS")
+    row = yield result.fetchone()
+    if row is None:
+        # Not replicating from anything, so never behind.
+        returnValue(0.0)
+    if row['Seconds_Behind_Master'] is None:
+        raise ReplicaLagUnknown("Replication is not running.")
+    returnValue(float(row['Seconds_Behind_Master']))
+
+
+@inlineCallbacks
+def _query_lag_default(engine):
+    # We have no way to measure lag here, so just check connectivity.
+    result = yield engine.execute("SELECT 1")
+    yield result.scalar()
+    returnValue(0.0)
+
+
+LAG_QUERIES = {
+    'postgresql': _query_lag_postgresql,
+    'mysql': _query_lag_mysql,
+}
+
+
+def query_lag(engine):
+    return LAG_QUERIES.get(engine.dialect.name, _query_lag_default)(engine)
+
+
+class Replica(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.healthy = True
+        self.lag = 0.0
+
+    def usable(self, max_lag):
+        return self.healthy and self.lag <= max_lag
+
+    @inlineCallbacks
+    def check_health(self):
+        try:
+            self.lag = yield query_lag(self.engine)
+            self.healthy = True
+        except Exception:
+            log.err(None, "Replica health check failed.")
+            self.healthy = False
+
+
+class ReplicaRouter(object):
+    """
+    Routes read-only work to replica databases.
+
+    Replicas are selected round-robin, skipping any that failed their last
+    health check or are lagging by more than ``max_lag`` seconds. If no
+    replica is usable, the primary is used instead.
+    """
+
+    def __init__(self, primary, replicas, max_lag=DEFAULT_MAX_LAG):
+        self.primary = primary
+        self.replicas = [Replica(engine) for engine in replicas]
+        self.max_lag = max_lag
+        self._next = 0
+
+    def _next_replica(self):
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self._next]
+            self._next = (self._next + 1) % len(self.replicas)
+            if replica.usable(self.max_lag):
+                return replica
+        return None
+
+    def check_health(self):
+        return gatherResults([r.check_health() for r in self.replicas])
+
+    @inlineCallbacks
+    def connect(self):
+        """
+        Connect to a usable replica, falling back to the primary.
+        """
+        replica = self._next_replica()
+        if replica is not None:
+            try:
+                conn = yield replica.engine.connect()
+                returnValue(conn)
+            except Exception:
+                log.err(None, "Replica connection failed, using primary.")
+                replica.healthy = False
+        conn = yield self.primary.connect()
+        returnValue(conn)
@@ -0,0 +1,117 @@
+import random
+
+from sqlalchemy.exc import DBAPIError
+from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
+from twisted.internet.task import deferLater
+from twisted.python import log
+from twisted.python.failure import Failure
+
+
+DEFAULT_DEADLINE = 1.0
+DEFAULT_BASE_DELAY = 0.01
+DEFAULT_MAX_DELAY = 0.25
+
+
+def _retryable_postgresql(exc):
+    # serialization_failure and deadlock_detected
+    return getattr(exc.orig, 'pgcode', None) in ('40001', '40P01')
+
+
+def _retryable_mysql(exc):
+    # ER_LOCK_DEADLOCK and ER_LOCK_WAIT_TIMEOUT
+    args = getattr(exc.orig, 'args', ())
+    return bool(args) and args[0] in (1213, 1205)
+
+
+def _retryable_sqlite(exc):
+    # SQLite has no deadlocks, but a writer can time out waiting for another.
+    return 'database is locked' in str(exc.orig)
+
+
+RETRYABLE_ERRORS = {
+    'postgresql': _retryable_postgresql,
+    'mysql': _retryable_mysql,
+    'sqlite': _retryable_sqlite,
+}
+
+
+def is_retryable(engine, exc):
+    """
+    Return ``True`` if ``exc`` means the transaction lost a race with
+    another one and may succeed if it's run again.
+    """
+    if not isinstance(exc, DBAPIError):
+        return False
+    check = RETRYABLE_ERRORS.get(engine.dialect.name)
+    return check is not None and check(exc)
+
+
+class TransactionRetrier(object):
+    """
+    Retries transactions that fail because of deadlocks or serialization
+    failures.
+
+    Retries wait for a random delay of up to ``base_delay * 2 ** attempt``
+    seconds (but no more than ``max_delay``), so that transactions that
+    collided are unlikely to collide again. We give up and return the error
+    if the next attempt would start more than ``deadline`` seconds after the
+    first one.
+
+    Retried operations must be safe to run more than once, and each attempt
+    must start a new transaction.
+    """
+
+    def __init__(self, clock, engine, deadline=DEFAULT_DEADLINE,
+                 base_delay=DEFAULT_BASE_DELAY, max_delay=DEFAULT_MAX_DELAY,
+                 random=random.random):
+        self.clock = clock
+        self.engine = engine
+        self.deadline = deadline
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._random = random
+        # Counts by operation name.
+        self.retries = {}
+        self.exhausted = {}
+
+    def _delay(self, attempt):
+        return self._random() * min(
+            self.max_delay, self.base_delay * 2 ** attempt)
+
+    def _count(self, counts, operation):
+        counts[operation] = counts.get(operation, 0) + 1
+
+    def stats(self):
+        return {
+            'deadline': self.deadline,
+            'retries': dict(self.retries),
+            'exhausted': dict(self.exhausted),
+        }
+
+    @inlineCallbacks
+    def run(self, operation, func, *args, **kw):
+        """
+        Call ``func``, retrying if it fails with a retryable error.
+
+        ``operation`` names the operation in the retry counts.
+        """
+        give_up_at = self.clock.seconds() + self.deadline
+        attempt = 0
+        while True:
+            try:
+                result = yield maybeDeferred(func, *args, **kw)
+            except Exception as e:
+                failure = Failure()
+                if not is_retryable(self.engine, e):
+                    failure.raiseException()
+                delay = self._delay(attempt)
+                if self.clock.seconds() + delay > give_up_at:
+                    self._count(self.exhausted, operation)
+                    log.msg("Giving up on %s after %s attempts: %s" % (
+                        operation, attempt + 1, e))
+                    failure.raiseException()
+            else:
+                returnValue(result)
+            self._count(self.retries, operation)
+            attempt += 1
+            yield deferLater(self.clock, delay, lambda: None)
@@ -1,29 +1,352 @@
 from twisted.application import strports
+from twisted.application.internet import TimerService
+from twisted.application.service import Service, MultiService
 from twisted.internet import reactor
-from twisted.python import usage
+from twisted.python import log, usage
 from twisted.web import server
 
-from .api import AirtimeServiceApp
+from .access_log import (
+    AccessLog, QuietSite, DEFAULT_MAX_QUEUED as DEFAULT_ACCESS_LOG_MAX_QUEUED,
+)
+from .admission import (
+    AdmissionController, DEFAULT_MAX_QUEUED, DEFAULT_QUEUE_TIMEOUT,
+    DEFAULT_RETRY_AFTER)
+from .admin import AdminApp
+from .api import (
+    AirtimeServiceApp, DEFAULT_IMPORT_CONCURRENCY,
+    DEFAULT_MAX_EXPORT_PAGE_SIZE)
+from .archiver import VoucherArchiver, DEFAULT_BATCH_SIZE
+from .concurrency import DatabaseThreads
+from .issuance_stats import IssuanceStats
+from .memory import is_memory_conn_str
+from .profiler import Profiler, DEFAULT_MAX_DURATION
+from .rate_limit import RateLimiter
+from .replicas import DEFAULT_MAX_LAG
+from .retry import DEFAULT_DEADLINE
+from .shutdown import DEFAULT_DRAIN_TIMEOUT
+from .slow_queries import SlowQueryLog
 
 
 DEFAULT_PORT = '8080'
+DEFAULT_REPLICA_CHECK_INTERVAL = 10.0
+DEFAULT_WARMUP_CONNECTIONS = 1
+WARMUP_RETRY_DELAY = 5.0
 
 
 class Options(usage.Options):
     """Command line args when run as a twistd plugin"""
+    optFlags = [["server-timing", None,
+                 "Return per-phase request timing in a Server-Timing header"],
+                ["log-timing", None, "Log per-phase request timing"],
+                ["enable-profiler", None,
+                 "Allow profiling through the admin endpoints"],
+                ["shared-tables", None,
+                 "Keep all voucher pools in one set of shared tables"
+                 " instead of separate tables for each pool"]]
     optParameters = [["port", "p", DEFAULT_PORT,
                       "Port number for airtime-service to listen on"],
                      ["database-connection-string", "d", None,
-                      "Database connection string"]]
+                      "Database connection string (memory:// keeps"
+                      " everything in memory, for testing)"],
+                     ["replica-max-lag", None, DEFAULT_MAX_LAG,
+                      "Maximum replication lag (in seconds) before reads"
+                      " fall back to the primary database", float],
+                     ["replica-check-interval", None,
+                      DEFAULT_REPLICA_CHECK_INTERVAL,
+                      "Interval (in seconds) between replica health checks",
+                      float],
+                     ["db-thread-pool-size", None, None,
+                      "Size of a dedicated database thread pool (defaults to"
+                      " sharing the reactor's thread pool)", int],
+                     ["pool-concurrency-limit", None, None,
+                      "Maximum concurrent database operations per voucher"
+                      " pool (defaults to unlimited)", int],
+                     ["max-in-flight", None, None,
+                      "Maximum requests handled at once (defaults to"
+                      " unlimited)", int],
+                     ["max-queued", None, DEFAULT_MAX_QUEUED,
+                      "Maximum requests waiting for admission when at the"
+                      " in-flight limit", int],
+                     ["queue-timeout", None, DEFAULT_QUEUE_TIMEOUT,
+                      "Seconds a request may wait for admission before it is"
+                      " rejected", float],
+                     ["retry-after", None, DEFAULT_RETRY_AFTER,
+                      "Retry-After value (in seconds) sent with overload"
+                      " responses", int],
+                     ["shutdown-timeout", None, DEFAULT_DRAIN_TIMEOUT,
+                      "Seconds to wait for requests in progress when"
+                      " shutting down", float],
+                     ["transaction-retry-deadline", None, DEFAULT_DEADLINE,
+                      "Seconds to keep retrying transactions that hit"
+                      " deadlocks or serialization failures", float],
+                     ["user-rate-limit", None, None,
+                      "Issue requests per second allowed for each user"
+                      " (defaults to unlimited)", float],
+                     ["user-rate-burst", None, None,
+                      "Issue requests a user may make at once before the"
+                      " rate limit applies (defaults to one second's worth)",
+                      int],
+                     ["source-rate-limit", None, None,
+                      "Issue requests per second allowed from each client"
+                      " address (defaults to unlimited)", float],
+                     ["source-rate-burst", None, None,
+                      "Issue requests a client address may make at once"
+                      " before the rate limit applies (defaults to one"
+                      " second's worth)", int],
+                     ["import-chunk-size", None, None,
+                      "Import files with more rows than this in chunks of"
+                      " this size, staged concurrently in separate"
+                      " transactions (defaults to one transaction per"
+                      " file)", int],
+                     ["import-concurrency", None, DEFAULT_IMPORT_CONCURRENCY,
+                      "Maximum chunks of one import staged at once", int],
+                     ["max-export-page-size", None,
+                      DEFAULT_MAX_EXPORT_PAGE_SIZE,
+                      "Largest page_size allowed for paged exports", int],
+                     ["warmup-connections", None, DEFAULT_WARMUP_CONNECTIONS,
+                      "Number of database connections to open at startup",
+                      int],
+                     ["admin-port", None, None,
+                      "Port (strports description) for admin endpoints."
+                      " This should only be reachable by operators, for"
+                      " example 'tcp:8081:interface=127.0.0.1'"],
+                     ["access-log", None, None,
+                      "File to write a JSON access log line to for each API"
+                      " request (rotated). This replaces the default"
+                      " request log"],
+                     ["access-log-sample-rate", None, 1.0,
+                      "Fraction of successful requests to write to the"
+                      " access log (errors are always written)", float],
+                     ["access-log-max-queued", None,
+                      DEFAULT_ACCESS_LOG_MAX_QUEUED,
+                      "Maximum access log lines waiting to be written before"
+                      " new ones are dropped", int],
+                     ["issuance-stats-file", None, None,
+                      "File to save issuance rate statistics to on shutdown"
+                      " and load them from at startup"],
+                     ["slow-query-threshold", None, None,
+                      "Record queries slower than this many seconds",
+                      float],
+                     ["slow-query-log", None, None,
+                      "File to write slow queries to (rotated)"],
+                     ["slow-query-explain-after", None, None,
+                      "Capture EXPLAIN output once a statement has been slow"
+                      " this many times", int],
+                     ["profile-max-seconds", None, DEFAULT_MAX_DURATION,
+                      "Longest profile the admin endpoints will capture",
+                      float],
+                     ["archive-interval", None, None,
+                      "Interval (in seconds) between moving used vouchers to"
+                      " the archive table (defaults to never)", float],
+                     ["archive-batch-size", None, DEFAULT_BATCH_SIZE,
+                      "Maximum vouchers archived in one transaction", int]]
+
+    def __init__(self):
+        usage.Options.__init__(self)
+        self['replica-connection-string'] = []
+        self['endpoint-limit'] = {}
+        self['warmup-pool'] = []
+        self['trusted-proxy'] = []
+
+    def opt_replica_connection_string(self, conn_str):
+        """Read-only replica database connection string (repeatable)"""
+        self['replica-connection-string'].append(conn_str)
+
+    def opt_warmup_pool(self, voucher_pool):
+        """Voucher pool to prepare at startup (repeatable)"""
+        self['warmup-pool'].append(voucher_pool)
+
+    def opt_trusted_proxy(self, address):
+        """Address of a proxy whose X-Forwarded-For header identifies the
+        client for the source rate limit (repeatable)"""
+        self['trusted-proxy'].append(address)
+
+    def opt_endpoint_limit(self, endpoint_limit):
+        """Maximum requests handled at once for one endpoint, given as
+        ENDPOINT=LIMIT (repeatable)"""
+        try:
+            endpoint, limit = endpoint_limit.split('=')
+            self['endpoint-limit'][endpoint] = int(limit)
+        except ValueError:
+            raise usage.UsageError(
+                "Invalid endpoint limit: %r" % (endpoint_limit,))
 
     def postOptions(self):
         if self['database-connection-string'] is None:
             raise usage.UsageError(
                 "--database-connection-string parameter is mandatory.")
+        if is_memory_conn_str(self['database-connection-string']):
+            if self['replica-connection-string']:
+                raise usage.UsageError(
+                    "Replicas can't be used with an in-memory database.")
+            if self['archive-interval'] is not None:
+                raise usage.UsageError(
+                    "Archiving can't be used with an in-memory database.")
+            if self['shared-tables']:
+                raise usage.UsageError(
+                    "Shared tables can't be used with an in-memory"
+                    " database.")
+        if self['enable-profiler'] and self['admin-port'] is None:
+            raise usage.UsageError("--enable-profiler requires --admin-port.")
+
+
+class WarmUpService(Service):
+    """
+    Warms up the app when started, retrying until it succeeds.
+
+    The app reports itself ready once this is done.
+    """
+
+    def __init__(self, app, clock, connections, pools):
+        self.app = app
+        self.clock = clock
+        self.connections = connections
+        self.pools = pools
+        self._retry_call = None
+
+    def startService(self):
+        Service.startService(self)
+        self._warm_up()
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._retry_call is not None and self._retry_call.active():
+            self._retry_call.cancel()
+
+    def _warm_up(self):
+        self._retry_call = None
+        d = self.app.warm_up(self.connections, self.pools)
+        return d.addErrback(self._warm_up_failed)
+
+    def _warm_up_failed(self, failure):
+        log.err(failure, "Warm-up failed.")
+        if self.running:
+            self._retry_call = self.clock.callLater(
+                WARMUP_RETRY_DELAY, self._warm_up)
+
+
+class DrainService(MultiService):
+    """
+    Shuts the app down gracefully when stopped.
+
+    Stopping waits for requests in progress to finish (for up to
+    ``timeout`` seconds) and then closes pooled database connections. The
+    listening port is stopped at the same time, so no new connections are
+    accepted.
+
+    Child services are only stopped once the app has shut down, so they
+    can be used by requests until the end.
+    """
+
+    def __init__(self, app, timeout):
+        MultiService.__init__(self)
+        self.app = app
+        self.timeout = timeout
+
+    def stopService(self):
+        d = self.app.shutdown(self.timeout)
+        return d.addCallback(lambda _: MultiService.stopService(self))
 
 
 def makeService(options):
+    svc = MultiService()
+
+    db_threads = None
+    db_reactor = reactor
+    if options['db-thread-pool-size'] is not None:
+        db_threads = db_reactor = DatabaseThreads(
+            reactor, options['db-thread-pool-size'])
+
+    admission = AdmissionController(
+        reactor, max_in_flight=options['max-in-flight'],
+        endpoint_limits=options['endpoint-limit'],
+        max_queued=options['max-queued'],
+        queue_timeout=options['queue-timeout'],
+        retry_after=options['retry-after'])
+
+    slow_query_log = None
+    if options['slow-query-threshold'] is not None:
+        slow_query_log = SlowQueryLog(
+            options['slow-query-threshold'],
+            log_path=options['slow-query-log'],
+            explain_after=options['slow-query-explain-after'])
+
+    user_rate_limiter = None
+    if options['user-rate-limit'] is not None:
+        user_rate_limiter = RateLimiter(
+            reactor, options['user-rate-limit'], options['user-rate-burst'])
+    source_rate_limiter = None
+    if options['source-rate-limit'] is not None:
+        source_rate_limiter = RateLimiter(
+            reactor, options['source-rate-limit'],
+            options['source-rate-burst'])
+
+    access_log = None
+    if options['access-log'] is not None:
+        access_log = AccessLog(
+            options['access-log'],
+            success_sample_rate=options['access-log-sample-rate'],
+            max_queued=options['access-log-max-queued'])
+
+    issuance_stats = IssuanceStats(
+        reactor, state_path=options['issuance-stats-file'])
+
     app = AirtimeServiceApp(
-        options['database-connection-string'], reactor=reactor)
-    site = server.Site(app.app.resource())
-    return strports.service(options['port'], site)
+        options['database-connection-string'], reactor=db_reactor,
+        replica_conn_strs=options['replica-connection-string'],
+        replica_max_lag=options['replica-max-lag'],
+        pool_concurrency=options['pool-concurrency-limit'],
+        admission=admission, server_timing=options['server-timing'],
+        log_timing=options['log-timing'], slow_query_log=slow_query_log,
+        shared_tables=options['shared-tables'],
+        retry_deadline=options['transaction-retry-deadline'],
+        access_log=access_log, user_rate_limiter=user_rate_limiter,
+        source_rate_limiter=source_rate_limiter,
+        trusted_proxies=options['trusted-proxy'],
+        issuance_stats=issuance_stats,
+        import_chunk_size=options['import-chunk-size'],
+        import_concurrency=options['import-concurrency'],
+        max_export_page_size=options['max-export-page-size'])
+    if access_log is None:
+        site = server.Site(app.app.resource())
+    else:
+        site = QuietSite(app.app.resource())
+
+    # The drain service's children start before anything else and stop
+    # after requests have drained, so the database threads are there for as
+    # long as anything might use them. Children stop in reverse order, so
+    # the timers below finish their last run before the threads go.
+    drain = DrainService(app, options['shutdown-timeout'])
+    drain.setServiceParent(svc)
+    if db_threads is not None:
+        db_threads.setServiceParent(drain)
+    if access_log is not None:
+        access_log.setServiceParent(drain)
+    if slow_query_log is not None:
+        slow_query_log.setServiceParent(drain)
+    issuance_stats.setServiceParent(drain)
+    WarmUpService(
+        app, reactor, options['warmup-connections'], options['warmup-pool'],
+    ).setServiceParent(svc)
+    strports.service(options['port'], site).setServiceParent(svc)
+    if options['admin-port'] is not None:
+        profiler = None
+        if options['enable-profiler']:
+            profiler = Profiler(
+                reactor, max_duration=options['profile-max-seconds'])
+        admin = AdminApp(app, profiler=profiler)
+        admin_site = server.Site(admin.app.resource())
+        strports.service(
+            options['admin-port'], admin_site).setServiceParent(svc)
+    if app.replicas.replicas:
+        TimerService(
+            options['replica-check-interval'], app.replicas.check_health,
+        ).setServiceParent(drain)
+    if options['archive-interval'] is not None:
+        archiver = VoucherArchiver(
+            app.engine, batch_size=options['archive-batch-size'],
+            voucher_pool_class=app.voucher_pool_class)
+        TimerService(
+            options['archive-interval'], archiver.archive,
+        ).setServiceParent(drain)
+    return svc
@@ -0,0 +1,471 @@
+import json
+import sys
+
+from aludel.database import get_engine
+from sqlalchemy import (
+    MetaData, Table, Column, Integer, String, DateTime, Boolean, Text, Index,
+    UniqueConstraint, PrimaryKeyConstraint,
+)
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.sql import select, func, literal, and_, text
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import react
+from twisted.python.failure import Failure
+
+from .migrations import migrate, set_schema_version, SCHEMA_VERSION
+from .models import VoucherPool, NoVoucherPool
+
+
+# All pools use the same tables, so there's only one set of table metadata.
+shared_metadata = MetaData()
+
+TABLE_PREFIX = 'SharedVoucherPool_'
+
+
+def _shared_table(name, *args):
+    return Table(TABLE_PREFIX + name, shared_metadata, *args)
+
+
+def _pool_index(table, suffix, *columns, **kw):
+    # Every index starts with pool_id, because every query is for one pool.
+    return Index('ix_%s%s_%s' % (TABLE_PREFIX, table, suffix),
+                 'pool_id', *columns, **kw)
+
+
+pools_table = _shared_table(
+    'pools',
+    Column("id", Integer(), primary_key=True),
+    Column("name", String(255), nullable=False, unique=True),
+    Column("metadata_json", Text(), nullable=False),
+)
+
+
+def _dimension_table(name):
+    return _shared_table(
+        name,
+        Column("id", Integer(), primary_key=True),
+        Column("pool_id", Integer(), nullable=False),
+        Column("name", String(255), nullable=False),
+        UniqueConstraint('pool_id', 'name'),
+    )
+
+
+def _vouchers_table(name, autoincrement, *args):
+    return _shared_table(
+        name,
+        Column("id", Integer(), primary_key=True,
+               autoincrement=autoincrement),
+        Column("pool_id", Integer(), nullable=False),
+        Column("operator_id", Integer(), nullable=False),
+        Column("denomination_id", Integer(), nullable=False),
+        Column("voucher", String(255), nullable=False),
+        Column("used", Boolean(), default=False),
+        Column("created_at", DateTime(timezone=False)),
+        Column("modified_at", DateTime(timezone=False)),
+        Column("reason", String(255), default=None),
+        *args)
+
+
+def _audit_table(name, *args):
+    # Indexes may refer to created_at, so it must come before them.
+    columns = tuple(arg for arg in args if isinstance(arg, Column))
+    others = tuple(arg for arg in args if not isinstance(arg, Column))
+    args = columns + (
+        Column("created_at", DateTime(timezone=False)),
+        UniqueConstraint('pool_id', 'request_id'),
+    ) + others
+    return _shared_table(
+        name,
+        Column("id", Integer(), primary_key=True),
+        Column("pool_id", Integer(), nullable=False),
+        Column("request_id", String(255), nullable=False),
+        *args)
+
+
+operators_table = _dimension_table('operators')
+denominations_table = _dimension_table('denominations')
+
+vouchers_table = _vouchers_table(
+    'vouchers', True,
+    _pool_index('vouchers', 'unused',
+                'operator_id', 'denomination_id', 'used', 'id',
+                postgresql_where=text('NOT used')),
+    _pool_index('vouchers', 'voucher', 'voucher'),
+)
+# Archived vouchers keep their ids.
+vouchers_used_table = _vouchers_table(
+    'vouchers_used', False,
+    _pool_index('vouchers_used', 'type', 'operator_id', 'denomination_id'),
+)
+
+audit_table = _audit_table(
+    'audit',
+    Column("transaction_id", String(255), nullable=False),
+    Column("user_id", String(255), nullable=False),
+    Column("request_data", Text(), nullable=False),
+    Column("response_data", Text(), nullable=False),
+    Column("error", Boolean(), nullable=False),
+    _pool_index('audit', 'transaction_id', 'transaction_id'),
+    _pool_index('audit', 'user_created', 'user_id', 'created_at'),
+)
+
+import_audit_table = _audit_table(
+    'import_audit',
+    Column("content_md5", String(255), nullable=False),
+)
+
+export_audit_table = _audit_table(
+    'export_audit',
+    Column("request_data", Text(), nullable=False),
+    Column("warnings", Text(), nullable=False),
+)
+
+exported_vouchers_table = _shared_table(
+    'exported_vouchers',
+    Column("id", Integer(), primary_key=True),
+    Column("pool_id", Integer(), nullable=False),
+    Column("request_id", String(255), nullable=False),
+    Column("voucher_id", Integer(), nullable=False),
+    Column("created_at", DateTime(timezone=False)),
+    Column("page", Integer()),
+    _pool_index('exported_vouchers', 'request_id', 'request_id'),
+)
+
+export_pages_table = _shared_table(
+    'export_pages',
+    Column("pool_id", Integer(), nullable=False),
+    Column("request_id", String(255), nullable=False),
+    Column("page", Integer(), nullable=False, autoincrement=False),
+    Column("warnings", Text(), nullable=False),
+    Column("next_position", Text()),
+    Column("created_at", DateTime(timezone=False)),
+    PrimaryKeyConstraint('pool_id', 'request_id', 'page'),
+)
+
+staged_vouchers_table = _shared_table(
+    'staged_vouchers',
+    Column("id", Integer(), primary_key=True),
+    Column("pool_id", Integer(), nullable=False),
+    Column("request_id", String(255), nullable=False),
+    Column("operator_id", Integer(), nullable=False),
+    Column("denomination_id", Integer(), nullable=False),
+    Column("voucher", String(255), nullable=False),
+    Column("created_at", DateTime(timezone=False)),
+    _pool_index('staged_vouchers', 'request_id', 'request_id'),
+)
+
+import_chunks_table = _shared_table(
+    'import_chunks',
+    Column("pool_id", Integer(), nullable=False),
+    Column("request_id", String(255), nullable=False),
+    Column("chunk", Integer(), nullable=False, autoincrement=False),
+    Column("content_md5", String(255), nullable=False),
+    Column("chunk_size", Integer(), nullable=False),
+    Column("created_at", DateTime(timezone=False)),
+    PrimaryKeyConstraint('pool_id', 'request_id', 'chunk'),
+)
+
+catalog_table = _shared_table(
+    'catalog',
+    Column("pool_id", Integer(), nullable=False),
+    Column("operator", String(255), nullable=False),
+    Column("denomination", String(255), nullable=False),
+    PrimaryKeyConstraint('pool_id', 'operator', 'denomination'),
+)
+
+
+def _in_pool_first(method_name):
+    """
+    Build a method that looks up the pool's id before calling the
+    :class:`VoucherPool` method of the same name.
+    """
+    def method(self, *args, **kw):
+        d = self._load_pool_id()
+        return d.addCallback(lambda _: getattr(
+            super(SharedVoucherPool, self), method_name)(*args, **kw))
+    method.__name__ = method_name
+    method.__doc__ = getattr(VoucherPool, method_name).__doc__
+    return method
+
+
+class SharedVoucherPool(VoucherPool):
+    """
+    A voucher pool that shares its tables with all other pools.
+
+    Rows are partitioned by a ``pool_id`` column, so the number of tables
+    doesn't grow with the number of pools. Apart from where the data lives,
+    this behaves exactly like :class:`VoucherPool`.
+    """
+
+    _metadata = shared_metadata
+    pools = pools_table
+    operators = operators_table
+    denominations = denominations_table
+    vouchers = vouchers_table
+    vouchers_used = vouchers_used_table
+    audit = audit_table
+    import_audit = import_audit_table
+    export_audit = export_audit_table
+    exported_vouchers = exported_vouchers_table
+    export_pages = export_pages_table
+    staged_vouchers = staged_vouchers_table
+    import_chunks = import_chunks_table
+    catalog = catalog_table
+
+    def __init__(self, name, connection):
+        self.name = name
+        self._conn = connection
+
+    @classmethod
+    @inlineCallbacks
+    def list_pool_names(cls, conn):
+        tables_exist = yield conn._engine.has_table(pools_table.name)
+        if not tables_exist:
+            returnValue([])
+        result = yield conn.execute(select([pools_table.c.name]))
+        rows = yield result.fetchall()
+        returnValue(sorted(row['name'] for row in rows))
+
+    def schema_name(self):
+        # All pools share one set of tables, so they have the same version.
+        return TABLE_PREFIX.rstrip('_')
+
+    def execute_query(self, query, *args, **kw):
+        # We've already checked that the pool exists by looking up its id.
+        return self._execute_query(query, *args, **kw)
+
+    @inlineCallbacks
+    def _get_pool_row(self):
+        try:
+            rows = yield self.execute_fetchall(
+                self.pools.select().where(self.pools.c.name == self.name))
+        except DBAPIError:
+            failure = Failure()
+            tables_exist = yield self._conn._engine.has_table(
+                self.pools.name)
+            if tables_exist:
+                failure.raiseException()
+            rows = []
+        returnValue(rows[0] if rows else None)
+
+    @inlineCallbacks
+    def _load_pool_id(self):
+        if self.pool_id is None:
+            row = yield self._get_pool_row()
+            if row is None:
+                raise NoVoucherPool(self.name)
+            self.pool_id = row['id']
+
+    def _in_pool(self, query, *tables):
+        return query.where(and_(*[
+            table.c.pool_id == self.pool_id for table in tables]))
+
+    def _insert(self, table):
+        return table.insert().values(pool_id=self.pool_id)
+
+    def _staged_voucher_columns(self):
+        return super(SharedVoucherPool, self)._staged_voucher_columns() + [
+            ('pool_id', self.staged_vouchers.c.pool_id)]
+
+    @inlineCallbacks
+    def exists(self):
+        row = yield self._get_pool_row()
+        returnValue(row is not None)
+
+    @inlineCallbacks
+    def _add_pool(self, metadata):
+        yield self.execute_query(self.pools.insert().values(
+            name=self.name,
+            metadata_json=json.dumps({} if metadata is None else metadata),
+        ))
+        yield self._load_pool_id()
+
+    @inlineCallbacks
+    def _ensure_tables(self):
+        # The shared tables are only created for the first pool. After that,
+        # we just make sure they're up to date.
+        tables_exist = yield self._conn._engine.has_table(self.pools.name)
+        if tables_exist:
+            yield migrate(self)
+        else:
+            yield self._create_tables()
+            yield self._create_indexes()
+            yield set_schema_version(self, SCHEMA_VERSION)
+
+    @inlineCallbacks
+    def create_tables(self, metadata=None):
+        yield self._ensure_tables()
+        yield self._add_pool(metadata)
+
+    @inlineCallbacks
+    def get_metadata(self):
+        row = yield self._get_pool_row()
+        if row is None:
+            raise NoVoucherPool(self.name)
+        returnValue(json.loads(row['metadata_json']))
+
+    @inlineCallbacks
+    def set_metadata(self, metadata):
+        yield self._load_pool_id()
+        yield self.execute_query(self.pools.update().where(
+            self.pools.c.id == self.pool_id,
+        ).values(metadata_json=json.dumps(metadata)))
+
+    @inlineCallbacks
+    def compile_statements(self):
+        # Our statements include the pool's id, so we need to know it first.
+        try:
+            yield self._load_pool_id()
+        except NoVoucherPool:
+            return
+        super(SharedVoucherPool, self).compile_statements()
+
+    upgrade_tables = _in_pool_first('upgrade_tables')
+    import_vouchers = _in_pool_first('import_vouchers')
+    prepare_import = _in_pool_first('prepare_import')
+    stage_import_chunk = _in_pool_first('stage_import_chunk')
+    finish_import = _in_pool_first('finish_import')
+    issue_voucher = _in_pool_first('issue_voucher')
+    count_vouchers = _in_pool_first('count_vouchers')
+    archive_used_vouchers = _in_pool_first('archive_used_vouchers')
+    query_by_request_id = _in_pool_first('query_by_request_id')
+    query_by_transaction_id = _in_pool_first('query_by_transaction_id')
+    query_by_user_id = _in_pool_first('query_by_user_id')
+    audit_version = _in_pool_first('audit_version')
+    list_catalog = _in_pool_first('list_catalog')
+    export_vouchers = _in_pool_first('export_vouchers')
+    export_page = _in_pool_first('export_page')
+
+    @inlineCallbacks
+    def _max_id(self, *tables):
+        max_id = 0
+        for table in tables:
+            result = yield self.execute_query(select([func.max(table.c.id)]))
+            table_max_id = yield result.scalar()
+            max_id = max(max_id, table_max_id or 0)
+        returnValue(max_id)
+
+    def _copy_rows(self, source, target, offsets):
+        """
+        Copy rows from ``source`` into ``target`` for this pool, adding the
+        offsets in ``offsets`` to the id columns they name.
+
+        Ids that nothing refers to aren't copied, so they're generated.
+        """
+        columns = [column.name for column in target.columns
+                   if column.name != 'id' or 'id' in offsets]
+        values = []
+        for name in columns:
+            if name == 'pool_id':
+                values.append(literal(self.pool_id, Integer()))
+            elif name in offsets:
+                values.append(source.c[name] + offsets[name])
+            else:
+                values.append(source.c[name])
+        query = select(values)
+        if 'id' in source.c:
+            query = query.order_by(source.c.id)
+        return self.execute_query(target.insert().from_select(columns, query))
+
+    @inlineCallbacks
+    def _copy_pool(self, source):
+        # New ids for this pool's rows start after the ones already there.
+        operator_offset = yield self._max_id(self.operators)
+        denomination_offset = yield self._max_id(self.denominations)
+        voucher_offset = yield self._max_id(
+            self.vouchers, self.vouchers_used)
+        voucher_offsets = {
+            'id': voucher_offset,
+            'operator_id': operator_offset,
+            'denomination_id': denomination_offset,
+        }
+        for attr, offsets in [
+                ('operators', {'id': operator_offset}),
+                ('denominations', {'id': denomination_offset}),
+                ('vouchers', voucher_offsets),
+                ('vouchers_used', voucher_offsets),
+                ('audit', {}),
+                ('import_audit', {}),
+                ('export_audit', {}),
+                ('exported_vouchers', {'voucher_id': voucher_offset}),
+                ('export_pages', {}),
+                ('catalog', {})]:
+            yield self._copy_rows(
+                getattr(source, attr), getattr(self, attr), offsets)
+
+    @inlineCallbacks
+    def copy_from(self, source):
+        """
+        Create this pool from the per-pool tables of ``source``, which must
+        be a :class:`VoucherPool` with the same name.
+
+        Nothing else may use either pool while this runs. Returns a Deferred
+        that fires with ``False`` if this pool already exists.
+        """
+        exists = yield self.exists()
+        if exists:
+            returnValue(False)
+        # Make sure the source tables have the columns we expect.
+        yield source.upgrade_tables()
+        metadata = yield source.get_metadata()
+        yield self._ensure_tables()
+
+        trx = yield self._conn.begin()
+        try:
+            yield self._add_pool(metadata)
+            yield self._copy_pool(source)
+        except Exception:
+            failure = Failure()
+            yield trx.rollback()
+            self.pool_id = None
+            failure.raiseException()
+        yield trx.commit()
+        for table in [self.operators, self.denominations, self.vouchers]:
+            yield self._advance_id_sequence(table)
+        returnValue(True)
+
+
+@inlineCallbacks
+def migrate_pools(conn, pool_names=None):
+    """
+    Copy per-pool tables into the shared tables.
+
+    If ``pool_names`` isn't given, all per-pool tables are copied. Pools that
+    are already in the shared tables are skipped. The per-pool tables are
+    left alone, so they can be dropped once the service is using the shared
+    tables.
+
+    Returns a Deferred that fires with the names of the pools copied.
+    """
+    if pool_names is None:
+        pool_names = yield VoucherPool.list_pool_names(conn)
+    migrated = []
+    for pool_name in pool_names:
+        source = VoucherPool(pool_name, conn)
+        exists = yield source.exists()
+        if not exists:
+            raise NoVoucherPool(pool_name)
+        copied = yield SharedVoucherPool(pool_name, conn).copy_from(source)
+        if copied:
+            migrated.append(pool_name)
+    returnValue(migrated)
+
+
+@inlineCallbacks
+def main(reactor, conn_str, *pool_names):
+    """
+    Usage: python -m airtime_service.shared <database> [pool ...]
+
+    The service must be stopped while this runs.
+    """
+    conn = yield get_engine(conn_str, reactor).connect()
+    try:
+        migrated = yield migrate_pools(conn, pool_names or None)
+    finally:
+        yield conn.close()
+    for pool_name in migrated:
+        sys.stdout.write("Migrated pool %r.\n" % (pool_name,))
+
+
+if __name__ == '__main__':
+    react(main, sys.argv[1:])
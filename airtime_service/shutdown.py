@@ -0,0 +1,62 @@
+from twisted.internet.defer import Deferred, fail, maybeDeferred, succeed
+
+
+DEFAULT_DRAIN_TIMEOUT = 10.0
+
+
+class ShuttingDown(Exception):
+    pass
+
+
+class RequestDrainer(object):
+    """
+    Tracks requests in progress so that shutdown can wait for them.
+
+    Once :meth:`drain` has been called, new requests fail with
+    :class:`ShuttingDown` so the client can retry against another instance.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.in_flight = 0
+        self.draining = False
+        self._waiters = []
+
+    def _finished(self, result):
+        self.in_flight -= 1
+        if self.draining and not self.in_flight:
+            self._notify_waiters()
+        return result
+
+    def _notify_waiters(self):
+        waiters, self._waiters = self._waiters, []
+        for d, timeout_call in waiters:
+            timeout_call.cancel()
+            d.callback(0)
+
+    def _timeout(self, d):
+        self._waiters = [w for w in self._waiters if w[0] is not d]
+        d.callback(self.in_flight)
+
+    def run(self, func, *args, **kw):
+        if self.draining:
+            return fail(ShuttingDown())
+        self.in_flight += 1
+        d = maybeDeferred(func, *args, **kw)
+        return d.addBoth(self._finished)
+
+    def drain(self, timeout=DEFAULT_DRAIN_TIMEOUT):
+        """
+        Stop accepting requests and wait up to ``timeout`` seconds for the
+        ones in progress to finish.
+
+        Returns a Deferred that fires with the number of requests still in
+        progress when we stopped waiting.
+        """
+        self.draining = True
+        if not self.in_flight:
+            return succeed(0)
+        d = Deferred()
+        timeout_call = self.clock.callLater(timeout, self._timeout, d)
+        self._waiters.append((d, timeout_call))
+        return d
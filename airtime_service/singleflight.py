@@ -0,0 +1,50 @@
+from twisted.internet.defer import Deferred, fail, maybeDeferred
+
+from .models import AuditMismatch
+
+
+class SingleFlight(object):
+    """
+    Shares the result of a call with duplicates made while it's running.
+
+    Calls are identified by a key. A call with the same key as one that's
+    still in progress waits for that call's result instead of doing the
+    work again. Its ``params`` must be the same as the original's, or it
+    fails with :class:`AuditMismatch`, just as it would if it were replayed
+    after the original had finished.
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def waiting(self, key):
+        """
+        Return the number of duplicates waiting for the call with ``key``.
+        """
+        call = self._calls.get(key)
+        if call is None:
+            return 0
+        return len(call[1])
+
+    def _finished(self, result, key):
+        _, waiters = self._calls.pop(key)
+        for waiter in waiters:
+            waiter.callback(result)
+        return result
+
+    def run(self, key, params, func, *args, **kw):
+        call = self._calls.get(key)
+        if call is not None:
+            call_params, waiters = call
+            if params != call_params:
+                return fail(AuditMismatch())
+            d = Deferred()
+            waiters.append(d)
+            return d
+
+        self._calls[key] = (params, [])
+        d = maybeDeferred(func, *args, **kw)
+        return d.addBoth(self._finished, key)
@@ -0,0 +1,167 @@
+from collections import deque
+from datetime import datetime
+import time
+
+from sqlalchemy.sql import ClauseElement
+from twisted.application.service import Service
+from twisted.python import log
+from twisted.python.failure import Failure
+
+from .log_writer import LogWriter
+from .lru import LRUCache
+
+
+DEFAULT_MAX_ENTRIES = 100
+# Statement shapes we keep slow counts and plans for. Raw SQL can contain
+# literal values, so there may be any number of shapes.
+DEFAULT_MAX_SHAPES = 1000
+
+EXPLAIN_PREFIXES = {
+    'sqlite': 'EXPLAIN QUERY PLAN ',
+}
+# Inserts have boring plans, so we only explain these.
+EXPLAINABLE = ('SELECT', 'UPDATE', 'DELETE')
+
+
+def redact_params(params):
+    """
+    Replace parameter values with their type names.
+
+    Parameters include things like voucher codes and user ids, so we don't
+    want them in our logs.
+    """
+    if isinstance(params, list):
+        return '<%s rows>' % (len(params),)
+    return dict((k, '<%s>' % (type(v).__name__,))
+                for k, v in sorted(params.iteritems()))
+
+
+def _distill_params(args, kw):
+    if args and isinstance(args[0], list):
+        return args[0]
+    params = {}
+    for arg in args:
+        params.update(arg)
+    params.update(kw)
+    return params
+
+
+class SlowQueryLog(Service):
+    """
+    Records database queries that take longer than ``threshold`` seconds.
+
+    The most recent ``max_entries`` slow queries are kept in memory. If
+    ``log_path`` is given, each one is also written as a line of JSON to a
+    rotating log file by a background thread while the service is running.
+    Queries that fail are recorded too, because timeouts and lock waits are
+    often the slowest of all.
+
+    Once a statement shape (its SQL with placeholders) has been slow
+    ``explain_after`` times, its ``EXPLAIN`` output is captured once. Counts
+    and plans are kept for the ``max_shapes`` most recently slow shapes.
+
+    Durations start when the query is handed to the database thread pool,
+    so they include any time spent waiting for a free thread.
+    """
+
+    def __init__(self, threshold, log_path=None, explain_after=None,
+                 max_entries=DEFAULT_MAX_ENTRIES,
+                 max_shapes=DEFAULT_MAX_SHAPES, now=time.time):
+        self.threshold = threshold
+        self.explain_after = explain_after
+        self.entries = deque(maxlen=max_entries)
+        self.plans = LRUCache(max_shapes)
+        self._now = now
+        self._shape_counts = LRUCache(max_shapes)
+        self._writer = None
+        if log_path is not None:
+            self._writer = LogWriter(
+                log_path, name='airtime-service-slow-query-log')
+
+    def startService(self):
+        Service.startService(self)
+        if self._writer is not None:
+            self._writer.start()
+
+    def stopService(self):
+        Service.stopService(self)
+        if self._writer is not None:
+            return self._writer.stop()
+
+    def start(self):
+        """
+        Return a token to pass to :meth:`finish` when the query is done.
+
+        Call this before queueing the query, so the wait for a database
+        thread counts towards its duration.
+        """
+        return self._now()
+
+    def finish(self, start, pool, query, args, kw, result=None):
+        """
+        Record the query if it was slow.
+
+        ``result`` is what the query returned, so we can tell if it failed.
+        """
+        duration = self._now() - start
+        if duration < self.threshold:
+            return
+        engine = pool._conn._engine
+        # Raw SQL strings have no compiled form, so we don't explain them.
+        compiled = query
+        if isinstance(query, ClauseElement):
+            compiled = query.compile(dialect=engine.dialect)
+        elif isinstance(query, basestring):
+            compiled = None
+        sql = str(query if compiled is None else compiled)
+        params = _distill_params(args, kw)
+        if compiled is not None and not isinstance(params, list):
+            params = compiled.construct_params(params)
+
+        entry = {
+            'timestamp': datetime.utcnow().isoformat(),
+            'pool': pool.name,
+            'sql': sql,
+            'params': redact_params(params),
+            'duration': duration,
+            'failed': isinstance(result, Failure),
+        }
+        self.entries.append(entry)
+        if self._writer is not None:
+            self._writer.write(entry)
+
+        count = self._shape_counts.get(sql, 0) + 1
+        self._shape_counts.put(sql, count)
+        if compiled is not None and self._should_explain(sql, count, params):
+            self.plans.put(sql, None)
+            self._explain(engine, compiled, sql, params)
+
+    def _should_explain(self, sql, count, params):
+        if self.explain_after is None or count < self.explain_after:
+            return False
+        if sql in self.plans or isinstance(params, list):
+            return False
+        return sql.lstrip().upper().startswith(EXPLAINABLE)
+
+    def _explain(self, engine, compiled, sql, params):
+        prefix = EXPLAIN_PREFIXES.get(engine.dialect.name, 'EXPLAIN ')
+        if compiled.positional:
+            params = tuple(params[name] for name in compiled.positiontup)
+        d = engine.execute(prefix + sql, params)
+        d.addCallback(lambda result: result.fetchall())
+        d.addCallback(self._store_plan, sql)
+        d.addErrback(log.err, "Failed to explain slow query.")
+        return d
+
+    def _store_plan(self, rows, sql):
+        self.plans.put(sql, [
+            ' '.join(str(value) for value in row) for row in rows])
+
+    def report(self):
+        return {
+            'threshold': self.threshold,
+            'slow_queries': list(self.entries),
+            'plans': [{'sql': sql, 'plan': plan}
+                      for sql, plan in sorted(self.plans.iteritems())
+                      if plan is not None],
+        }
@@ -0,0 +1,294 @@
+"""Microbenchmarks for the model layer.
+
+Run with ``python -m airtime_service.tests.benchmarks``.
+
+Each benchmark calls :class:`VoucherPool` directly, so HTTP handling isn't
+included. Results are in seconds per call. Use ``--output`` to save them as
+JSON and ``--baseline`` to compare them with a previous run; any benchmark
+more than ``--threshold`` slower than its baseline is reported as a
+regression and the exit status is 1.
+
+The default connection string is in-memory SQLite. To benchmark a local
+PostgreSQL database, pass something like
+``-d postgresql://postgres@localhost/aludel_test``. The benchmark pools'
+tables are dropped when we're done, but nothing else is touched.
+"""
+
+from datetime import datetime
+import json
+from optparse import OptionParser
+import sys
+from timeit import default_timer
+
+from aludel.database import get_engine
+from aludel.tests.doubles import FakeReactorThreads
+
+from airtime_service import migrations, models
+from airtime_service.models import VoucherPool
+
+from .helpers import mk_audit_params
+
+
+DEFAULT_THRESHOLD = 0.2
+
+IMPORT_SIZES = [10000, 100000, 1000000]
+ISSUE_FILL_LEVELS = [1000, 10000, 100000]
+EXPORT_COUNTS = [10, 100, 1000]
+AUDIT_SIZE = 100000
+
+OPERATORS = ['Tank', 'Link', 'Clank', 'Spike']
+DENOMINATIONS = ['red', 'blue', 'green', 'gold']
+
+
+def sync_result(d):
+    """
+    Extract the result of a Deferred that has already fired.
+
+    With :class:`FakeReactorThreads` all database calls are synchronous.
+    """
+    results = []
+    d.addBoth(results.append)
+    [result] = results
+    if hasattr(result, 'raiseException'):
+        result.raiseException()
+    return result
+
+
+def timed(func, iterations):
+    start = default_timer()
+    for _ in xrange(iterations):
+        func()
+    return (default_timer() - start) / iterations
+
+
+def scaled(sizes, scale, minimum=1):
+    return [max(minimum, int(size * scale)) for size in sizes]
+
+
+def mk_vouchers(count, prefix='v'):
+    """
+    Build ``count`` voucher dicts spread over all our voucher types.
+    """
+    voucher_types = [(operator, denomination)
+                     for operator in OPERATORS
+                     for denomination in DENOMINATIONS]
+    vouchers = []
+    for i in xrange(count):
+        operator, denomination = voucher_types[i % len(voucher_types)]
+        vouchers.append({
+            'operator': operator,
+            'denomination': denomination,
+            'voucher': '%s-%s' % (prefix, i),
+        })
+    return vouchers
+
+
+class Bench(object):
+    """
+    Creates benchmark pools on one database and drops them afterwards.
+    """
+
+    def __init__(self, conn_str):
+        self.engine = get_engine(conn_str, reactor=FakeReactorThreads())
+        self.conn = sync_result(self.engine.connect())
+        self.pools = []
+
+    @property
+    def dialect_name(self):
+        return self.engine.dialect.name
+
+    def mk_pool(self, vouchers=0):
+        pool = VoucherPool('bench%s' % (len(self.pools),), self.conn)
+        self.pools.append(pool)
+        sync_result(pool.create_tables())
+        if vouchers:
+            sync_result(pool.import_vouchers(
+                'fill', 'fill', mk_vouchers(vouchers)))
+        return pool
+
+    def drop_pools(self):
+        for pool in self.pools:
+            for table in reversed(pool._metadata.sorted_tables):
+                table.drop(self.engine._engine, checkfirst=True)
+            sync_result(self.conn.execute(
+                migrations.schema_versions.delete().where(
+                    migrations.schema_versions.c.name == pool.schema_name())))
+        self.pools = []
+
+    def close(self):
+        self.drop_pools()
+        sync_result(self.conn.close())
+
+
+def bench_statement_compilation(bench, iterations=2000):
+    """
+    Compare building and compiling the issue path's statements on every call
+    with fetching them from the compiled statement cache.
+    """
+    pool = VoucherPool('benchcompile', bench.conn)
+    dialect = bench.engine.dialect
+
+    def uncached():
+        pool._select_vouchers(pool.vouchers).limit(1).compile(
+            dialect=dialect)
+        pool.audit.insert().values(
+            request_id='req-0', transaction_id='tx-0', user_id='user-0',
+            request_data='{}', response_data='{}', error=False,
+        ).compile(dialect=dialect)
+
+    def cached():
+        pool._stmt_get_voucher()
+        pool._stmt_audit_insert()
+
+    models.clear_statement_cache()
+    return {
+        'compile_uncached': timed(uncached, iterations),
+        'compile_cached': timed(cached, iterations),
+    }
+
+
+def bench_import(bench, sizes):
+    results = {}
+    for size in sizes:
+        pool = bench.mk_pool()
+        vouchers = mk_vouchers(size)
+        results['import_vouchers[%s]' % (size,)] = timed(
+            lambda: sync_result(
+                pool.import_vouchers('req-0', 'md5-0', vouchers)), 1)
+        bench.drop_pools()
+    return results
+
+
+def bench_issue(bench, fill_levels, iterations=200):
+    results = {}
+    for fill_level in fill_levels:
+        pool = bench.mk_pool(fill_level)
+        request_ids = iter(xrange(iterations))
+
+        def issue():
+            sync_result(pool.issue_voucher(
+                'Tank', 'red', mk_audit_params('req-%s' % (
+                    request_ids.next(),))))
+        # Only one of our voucher types is issued, so we're limited to the
+        # vouchers of that type.
+        stock = fill_level // (len(OPERATORS) * len(DENOMINATIONS))
+        results['issue_voucher[%s]' % (fill_level,)] = timed(
+            issue, min(iterations, stock))
+        bench.drop_pools()
+    return results
+
+
+def bench_export(bench, counts):
+    results = {}
+    # Each export takes ``count`` vouchers of one type, so there must be
+    # enough of that type for all of them.
+    pool = bench.mk_pool(
+        sum(counts) * len(OPERATORS) * len(DENOMINATIONS))
+    for count in counts:
+        results['export_vouchers[%s]' % (count,)] = timed(
+            lambda: sync_result(pool.export_vouchers(
+                'export-%s' % (count,), count, ['Tank'], ['red'])), 1)
+    results['count_vouchers'] = timed(
+        lambda: sync_result(pool.count_vouchers()), 20)
+    bench.drop_pools()
+    return results
+
+
+def bench_audit_query(bench, audit_size, users=100):
+    pool = bench.mk_pool()
+    now = datetime.utcnow()
+    rows = [{
+        'request_id': 'req-%s' % (i,),
+        'transaction_id': 'tx-%s' % (i,),
+        'user_id': 'user-%s' % (i % users,),
+        'request_data': '{}',
+        'response_data': '{}',
+        'error': False,
+        'created_at': now,
+    } for i in xrange(audit_size)]
+    sync_result(pool.execute_query(pool.audit.insert(), rows))
+    results = {
+        'query_by_user_id[%s]' % (audit_size,): timed(
+            lambda: sync_result(pool.query_by_user_id('user-0')), 20),
+    }
+    bench.drop_pools()
+    return results
+
+
+def run_benchmarks(conn_str, scale=1.0):
+    """
+    Run all the benchmarks against ``conn_str``.
+
+    ``scale`` multiplies the sizes of the tables we benchmark with.
+    """
+    bench = Bench(conn_str)
+    try:
+        results = {}
+        results.update(bench_statement_compilation(bench))
+        results.update(bench_import(bench, scaled(IMPORT_SIZES, scale)))
+        # We need at least one voucher of each type to issue.
+        results.update(bench_issue(bench, scaled(
+            ISSUE_FILL_LEVELS, scale, len(OPERATORS) * len(DENOMINATIONS))))
+        results.update(bench_export(bench, scaled(EXPORT_COUNTS, scale)))
+        results.update(
+            bench_audit_query(bench, scaled([AUDIT_SIZE], scale)[0]))
+    finally:
+        bench.close()
+    return {'database': bench.dialect_name, 'results': results}
+
+
+def compare_results(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Return ``(name, baseline, result)`` for every benchmark that is more
+    than ``threshold`` slower than in ``baseline``.
+
+    Results from different databases aren't compared.
+    """
+    if results['database'] != baseline['database']:
+        return []
+    regressions = []
+    for name, result in sorted(results['results'].iteritems()):
+        previous = baseline['results'].get(name)
+        if previous is not None and result > previous * (1 + threshold):
+            regressions.append((name, previous, result))
+    return regressions
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option(
+        '-d', '--database-connection-string', default='sqlite://',
+        help='Database to benchmark (default: %default)')
+    parser.add_option(
+        '--scale', type='float', default=1.0,
+        help='Multiplier for table sizes (default: %default)')
+    parser.add_option('-o', '--output', help='Write results to this file')
+    parser.add_option('-b', '--baseline', help='Compare with these results')
+    parser.add_option(
+        '--threshold', type='float', default=DEFAULT_THRESHOLD,
+        help='Slowdown reported as a regression (default: %default)')
+    options, _ = parser.parse_args(args)
+
+    results = run_benchmarks(
+        options.database_connection_string, options.scale)
+    for name, result in sorted(results['results'].iteritems()):
+        print '%-30s %12.1f us/call' % (name, result * 1e6)
+
+    if options.output is not None:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if options.baseline is not None:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, options.threshold)
+        for name, previous, result in regressions:
+            print 'REGRESSION: %s %.1f us/call -> %.1f us/call' % (
+                name, previous * 1e6, result * 1e6)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
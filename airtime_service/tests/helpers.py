@@ -1,3 +1,6 @@
+import os
+import shutil
+import tempfile
 from uuid import uuid4
 
 
@@ -38,3 +41,13 @@ def voucher_dict(operator, denomination, voucher, **kw):
     }
     voucher.update(kw)
     return voucher
+
+
+def temp_path(testcase, name='temp'):
+    """
+    Return a path in a new temporary directory, which is removed when the
+    test is done.
+    """
+    directory = tempfile.mkdtemp()
+    testcase.addCleanup(shutil.rmtree, directory)
+    return os.path.join(directory, name)
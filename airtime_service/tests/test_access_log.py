@@ -0,0 +1,149 @@
+import json
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.trial.unittest import TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from aludel.service import set_request_id
+
+from airtime_service.access_log import AccessLog, access_logged
+
+from .helpers import temp_path
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def mk_request(code=200):
+    # DummyRequest doesn't have the response code attribute that real
+    # requests have.
+    request = DummyRequest([''])
+    request.code = code
+    return request
+
+
+class FakeApp(object):
+    def __init__(self, access_log):
+        self.access_log = access_log
+
+    @access_logged
+    def issue_voucher(self, request, voucher_pool, operator, request_id):
+        set_request_id(request, request_id)
+        return 'issued'
+
+
+class TestAccessLog(TestCase):
+    def setUp(self):
+        self.log_path = temp_path(self)
+        self.clock = FakeClock()
+
+    def mk_access_log(self, **kw):
+        access_log = AccessLog(self.log_path, now=self.clock, **kw)
+        access_log.startService()
+        self.addCleanup(self.stop, access_log)
+        return access_log
+
+    def stop(self, access_log):
+        if access_log.running:
+            return access_log.stopService()
+
+    @inlineCallbacks
+    def read_entries(self, access_log):
+        yield self.stop(access_log)
+        with open(self.log_path) as f:
+            returnValue([json.loads(line) for line in f])
+
+    def log(self, access_log, code=200, **params):
+        request = mk_request(code)
+        set_request_id(request, params.pop('request_id', 'req-0'))
+        start = access_log.start()
+        self.clock.now += 0.25
+        access_log.log_request(request, 'issue_voucher', start, params)
+
+    @inlineCallbacks
+    def test_log_request(self):
+        access_log = self.mk_access_log()
+        self.log(access_log, voucher_pool='pool0', operator='Tank')
+        self.log(access_log, code=500, request_id='req-1',
+                 voucher_pool='pool0')
+        [entry0, entry1] = yield self.read_entries(access_log)
+        assert entry0.pop('timestamp')
+        assert entry0 == {
+            'request_id': 'req-0',
+            'endpoint': 'issue_voucher',
+            'pool': 'pool0',
+            'operator': 'Tank',
+            'status': 200,
+            'outcome': 'success',
+            'latency': 0.25,
+        }
+        assert entry1['request_id'] == 'req-1'
+        assert entry1['operator'] is None
+        assert entry1['outcome'] == 'error'
+
+    @inlineCallbacks
+    def test_sampling(self):
+        samples = [0.1, 0.9, 0.1]
+        access_log = self.mk_access_log(
+            success_sample_rate=0.5, random=lambda: samples.pop(0))
+        for i in range(3):
+            self.log(access_log, request_id='req-%s' % (i,))
+        # Errors are always logged.
+        self.log(access_log, code=404, request_id='req-3')
+        entries = yield self.read_entries(access_log)
+        assert [e['request_id'] for e in entries] == [
+            'req-0', 'req-2', 'req-3']
+
+    @inlineCallbacks
+    def test_full_queue_drops_entries(self):
+        # We don't start the writer, so nothing is taken off the queue.
+        access_log = AccessLog(self.log_path, max_queued=2, now=self.clock)
+        for i in range(5):
+            self.log(access_log, request_id='req-%s' % (i,))
+        assert access_log.dropped == 3
+
+        access_log.startService()
+        entries = yield self.read_entries(access_log)
+        assert [e['request_id'] for e in entries] == ['req-0', 'req-1']
+
+    @inlineCallbacks
+    def test_access_logged(self):
+        access_log = self.mk_access_log()
+        app = FakeApp(access_log)
+        request = mk_request()
+        result = app.issue_voucher(
+            request, voucher_pool='pool0', operator='Tank',
+            request_id='req-0')
+        assert result == 'issued'
+        self.clock.now += 0.5
+        request.finish()
+
+        [entry] = yield self.read_entries(access_log)
+        assert entry['request_id'] == 'req-0'
+        assert entry['pool'] == 'pool0'
+        assert entry['operator'] == 'Tank'
+        assert entry['latency'] == 0.5
+
+    @inlineCallbacks
+    def test_access_logged_disconnected(self):
+        access_log = self.mk_access_log()
+        app = FakeApp(access_log)
+        request = mk_request()
+        app.issue_voucher(
+            request, voucher_pool='pool0', operator='Tank',
+            request_id='req-0')
+        request.processingFailed(Exception('Connection lost.'))
+        [entry] = yield self.read_entries(access_log)
+        assert entry['outcome'] == 'disconnected'
+
+    def test_access_logged_disabled(self):
+        app = FakeApp(None)
+        request = mk_request()
+        assert app.issue_voucher(
+            request, voucher_pool='pool0', operator='Tank',
+            request_id='req-0') == 'issued'
@@ -0,0 +1,184 @@
+import json
+import marshal
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from airtime_service.admin import AdminApp
+from airtime_service.audit_cache import AuditCache
+from airtime_service.issuance_stats import IssuanceStats
+from airtime_service.profiler import Profiler
+from airtime_service.retry import TransactionRetrier
+from airtime_service.slow_queries import SlowQueryLog
+
+
+class FakeApi(object):
+    slow_query_log = None
+    retrier = TransactionRetrier(Clock(), engine=None)
+    issuance_stats = IssuanceStats(Clock())
+    audit_cache = AuditCache()
+
+
+class TestAdminApp(TestCase):
+    def setUp(self):
+        self.api = FakeApi()
+        self.admin = AdminApp(self.api)
+
+    def mk_request(self, **args):
+        request = DummyRequest([''])
+        request.args = dict((k, [v]) for k, v in args.iteritems())
+        return request
+
+    def get(self, handler, **args):
+        request = self.mk_request(**args)
+        body = self.successResultOf(handler(request))
+        return request, json.loads(body)
+
+    def enable_profiler(self):
+        self.clock = Clock()
+        self.admin = AdminApp(self.api, Profiler(self.clock, max_duration=5))
+
+    def profile(self, **args):
+        request = self.mk_request(**args)
+        d = self.admin.profile(request)
+        self.clock.advance(float(args.get('seconds', 10)))
+        return request, self.successResultOf(d)
+
+    def test_slow_queries_disabled(self):
+        request, body = self.get(self.admin.slow_queries)
+        assert request.responseCode == 404
+        assert body == {
+            'request_id': None,
+            'error': 'Slow query logging is disabled.',
+        }
+
+    def test_slow_queries(self):
+        self.api.slow_query_log = SlowQueryLog(0.5)
+        self.api.slow_query_log.entries.append({'sql': 'SELECT 1'})
+        request, body = self.get(self.admin.slow_queries, request_id='r-0')
+        assert body == {
+            'request_id': 'r-0',
+            'threshold': 0.5,
+            'slow_queries': [{'sql': 'SELECT 1'}],
+            'plans': [],
+        }
+
+    def test_transaction_retries(self):
+        self.api.retrier = TransactionRetrier(Clock(), engine=None)
+        self.api.retrier.retries['issue'] = 3
+        self.api.retrier.exhausted['issue'] = 1
+        request, body = self.get(
+            self.admin.transaction_retries, request_id='r-0')
+        assert body == {
+            'request_id': 'r-0',
+            'deadline': 1.0,
+            'retries': {'issue': 3},
+            'exhausted': {'issue': 1},
+        }
+
+    def test_audit_cache(self):
+        self.api.audit_cache = AuditCache(max_entries=5)
+        self.api.audit_cache.put(('pool0', 'req-0'), ['row0'])
+        self.api.audit_cache.get(('pool0', 'req-0'))
+        self.api.audit_cache.get(('pool0', 'req-1'))
+        request, body = self.get(self.admin.audit_cache, request_id='r-0')
+        assert body == {
+            'request_id': 'r-0',
+            'entries': 1,
+            'max_entries': 5,
+            'hits': 1,
+            'misses': 1,
+        }
+
+    def test_issuance_stats(self):
+        clock = Clock()
+        clock.advance(3600)
+        self.api.issuance_stats = IssuanceStats(clock)
+        self.api.issuance_stats.record('pool0', 'Tank', 'red', 'issued', 6)
+        self.api.issuance_stats.record('pool1', 'Tank', 'red', 'issued', 6)
+        clock.advance(60)
+        request, body = self.get(
+            self.admin.issuance_stats, pool='pool0', request_id='r-0')
+        assert body == {
+            'request_id': 'r-0',
+            'window': 3600,
+            'stats': [{
+                'pool': 'pool0',
+                'operator': 'Tank',
+                'denomination': 'red',
+                'imported': 0,
+                'issued': 6,
+                'exported': 0,
+                'no_voucher': 0,
+                'issue_rate': 0.1,
+                'export_rate': 0.0,
+                'no_voucher_rate': 0.0,
+                'available': None,
+                'depletion_seconds': None,
+            }],
+        }
+
+    def test_routes(self):
+        rules = sorted(
+            (rule.rule, sorted(rule.methods))
+            for rule in self.admin.app.url_map.iter_rules())
+        assert rules == [
+            ('/audit_cache', ['GET', 'HEAD']),
+            ('/issuance_stats', ['GET', 'HEAD']),
+            ('/profile', ['GET', 'HEAD']),
+            ('/slow_queries', ['GET', 'HEAD']),
+            ('/transaction_retries', ['GET', 'HEAD']),
+        ]
+
+    def test_profile_disabled(self):
+        request, body = self.get(self.admin.profile, seconds='1')
+        assert request.responseCode == 404
+        assert body == {'request_id': None, 'error': 'Profiling is disabled.'}
+
+    def test_profile_text(self):
+        self.enable_profiler()
+        request, body = self.profile(seconds='1')
+        assert request.responseHeaders.getRawHeaders('Content-Type') == [
+            'text/plain']
+        assert 'function calls' in body
+
+    def test_profile_pstats(self):
+        self.enable_profiler()
+        request, body = self.profile(seconds='1', format='pstats')
+        assert request.responseHeaders.getRawHeaders('Content-Type') == [
+            'application/octet-stream']
+        assert isinstance(marshal.loads(body), dict)
+
+    def test_profile_collapsed(self):
+        self.enable_profiler()
+        request, body = self.profile(seconds='0.5', format='collapsed')
+        assert request.responseHeaders.getRawHeaders('Content-Type') == [
+            'text/plain']
+        assert isinstance(body, str)
+
+    def test_profile_bad_params(self):
+        self.enable_profiler()
+        for args, error in [
+                ({'seconds': '1', 'format': 'svg'},
+                 'Invalid profile format.'),
+                ({'seconds': 'ages'}, 'Invalid profile duration.'),
+                ({'seconds': '6'},
+                 'Profile duration must be between 0 and 5 seconds.'),
+                ({'seconds': '0'},
+                 'Profile duration must be between 0 and 5 seconds.')]:
+            request, body = self.get(self.admin.profile, **args)
+            assert request.responseCode == 400
+            assert body['error'] == error
+
+    def test_profile_busy(self):
+        self.enable_profiler()
+        self.admin.profile(self.mk_request(seconds='1'))
+        request, body = self.get(
+            self.admin.profile, seconds='1', request_id='r-0')
+        assert request.responseCode == 409
+        assert body == {
+            'request_id': 'r-0',
+            'error': 'A profile is already running.',
+        }
+        self.clock.advance(1)
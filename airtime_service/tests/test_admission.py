@@ -0,0 +1,121 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from airtime_service.admission import AdmissionController, Overloaded
+
+
+class Work(object):
+    def __init__(self):
+        self.started = []
+
+    def __call__(self, name):
+        d = Deferred()
+        self.started.append((name, d))
+        return d
+
+    @property
+    def names(self):
+        return [name for name, _ in self.started]
+
+    def finish(self, name, result=None):
+        [d] = [d for n, d in self.started if n == name]
+        d.callback(result)
+
+
+class TestAdmissionController(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.work = Work()
+
+    def test_unlimited(self):
+        ac = AdmissionController(self.clock)
+        assert not ac.limited
+        ds = [ac.run('issue', self.work, i) for i in range(10)]
+        assert self.work.names == range(10)
+        assert ac.in_flight == 0
+        self.work.finish(3, 'done')
+        assert self.successResultOf(ds[3]) == 'done'
+
+    def test_global_limit_queues(self):
+        ac = AdmissionController(self.clock, max_in_flight=2)
+        ds = [ac.run('issue', self.work, i) for i in range(4)]
+        assert self.work.names == [0, 1]
+        assert ac.in_flight == 2
+        assert ac.queued == 2
+
+        self.work.finish(1, 'one')
+        assert self.successResultOf(ds[1]) == 'one'
+        assert self.work.names == [0, 1, 2]
+        self.work.finish(0)
+        assert self.work.names == [0, 1, 2, 3]
+        assert ac.queued == 0
+
+        self.work.finish(2)
+        self.work.finish(3)
+        assert ac.in_flight == 0
+        assert ac.endpoint_in_flight == {}
+
+    def test_queue_full_rejects(self):
+        ac = AdmissionController(
+            self.clock, max_in_flight=1, max_queued=1, retry_after=3)
+        ac.run('issue', self.work, 0)
+        ac.run('issue', self.work, 1)
+        f = self.failureResultOf(ac.run('issue', self.work, 2), Overloaded)
+        assert f.value.retry_after == 3
+        assert ac.rejected == 1
+        assert self.work.names == [0]
+
+    def test_queue_timeout_rejects(self):
+        ac = AdmissionController(
+            self.clock, max_in_flight=1, queue_timeout=0.5)
+        ac.run('issue', self.work, 0)
+        d = ac.run('issue', self.work, 1)
+        self.assertNoResult(d)
+        self.clock.advance(0.5)
+        self.failureResultOf(d, Overloaded)
+        assert ac.queued == 0
+        assert ac.rejected == 1
+
+        # The timed-out request never runs.
+        self.work.finish(0)
+        assert self.work.names == [0]
+        assert ac.in_flight == 0
+
+    def test_endpoint_limit(self):
+        ac = AdmissionController(
+            self.clock, endpoint_limits={'export': 1})
+        ac.run('export', self.work, 'export-0')
+        d = ac.run('export', self.work, 'export-1')
+        ac.run('issue', self.work, 'issue-0')
+        assert self.work.names == ['export-0', 'issue-0']
+        assert ac.endpoint_in_flight == {'export': 1, 'issue': 1}
+
+        self.work.finish('issue-0')
+        self.assertNoResult(d)
+        self.work.finish('export-0')
+        assert self.work.names == ['export-0', 'issue-0', 'export-1']
+
+    def test_saturated_endpoint_does_not_block_others(self):
+        ac = AdmissionController(
+            self.clock, max_in_flight=2, endpoint_limits={'export': 1})
+        ac.run('export', self.work, 'export-0')
+        ac.run('issue', self.work, 'issue-0')
+        ac.run('export', self.work, 'export-1')
+        ac.run('issue', self.work, 'issue-1')
+        assert ac.queued == 2
+
+        # The waiting export can't run yet, but the waiting issue can.
+        self.work.finish('issue-0')
+        assert self.work.names == ['export-0', 'issue-0', 'issue-1']
+
+    def test_failure_releases(self):
+        ac = AdmissionController(self.clock, max_in_flight=1)
+        d0 = ac.run('issue', self.work, 0)
+        d1 = ac.run('issue', self.work, 1)
+        self.work.started[0][1].errback(ValueError('oops'))
+        self.failureResultOf(d0, ValueError)
+        assert self.work.names == [0, 1]
+        self.work.finish(1, 'ok')
+        assert self.successResultOf(d1) == 'ok'
+        assert ac.in_flight == 0
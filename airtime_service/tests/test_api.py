@@ -7,22 +7,31 @@ from urllib import urlencode
 from StringIO import StringIO
 
 from aludel.database import MetaData
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import DropTable
 from twisted.internet import reactor
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import Deferred, inlineCallbacks, fail, succeed
+from twisted.internet.task import deferLater
 from twisted.trial.unittest import TestCase
 from twisted.web.client import Agent, FileBodyProducer, readBody
 from twisted.web.http_headers import Headers
 from twisted.web.server import Site
 
+from airtime_service.access_log import AccessLog
+from airtime_service.admission import AdmissionController
+from airtime_service import migrations, models
 from airtime_service.api import AirtimeServiceApp
-from airtime_service.models import VoucherPool
+from airtime_service.rate_limit import RateLimiter
 
-from .helpers import populate_pool, mk_audit_params, sorted_dicts, voucher_dict
+from .helpers import (
+    populate_pool, mk_audit_params, sorted_dicts, voucher_dict, temp_path,
+)
 
 
 class ApiClient(object):
     def __init__(self, base_url):
         self._base_url = base_url
+        self.last_response = None
 
     def _make_url(self, url_path):
         return '%s/%s' % (self._base_url, url_path.lstrip('/'))
@@ -34,30 +43,36 @@ class ApiClient(object):
         return d.addCallback(self._get_response_body, expected_code)
 
     def _get_response_body(self, response, expected_code):
+        self.last_response = response
         assert response.code == expected_code
+        if response.code == 304:
+            # There's no body to decode.
+            return readBody(response).addCallback(lambda _: None)
         return readBody(response).addCallback(json.loads)
 
-    def get(self, url_path, params, expected_code):
+    def get(self, url_path, params, expected_code, headers=None):
         url_path = '?'.join([url_path, urlencode(params)])
-        return self._make_call('GET', url_path, None, None, expected_code)
+        return self._make_call('GET', url_path, headers, None, expected_code)
 
     def put(self, url_path, headers, content, expected_code=200):
         body = FileBodyProducer(StringIO(content))
         return self._make_call('PUT', url_path, headers, body, expected_code)
 
-    def put_json(self, url_path, params, expected_code=200):
-        headers = Headers({'Content-Type': ['application/json']})
+    def put_json(self, url_path, params, expected_code=200, headers=None):
+        headers = Headers(headers or {})
+        headers.setRawHeaders('Content-Type', ['application/json'])
         return self.put(
             url_path, headers, json.dumps(params), expected_code)
 
-    def put_issue(self, request_id, operator, denomination, expected_code=200):
-        params = mk_audit_params(request_id)
+    def put_issue(self, request_id, operator, denomination, expected_code=200,
+                  user_id=None, headers=None):
+        params = mk_audit_params(request_id, user_id=user_id)
         params.update({
             'denomination': denomination,
         })
         params.pop('request_id')
         url_path = 'testpool/issue/%s/%s' % (operator, request_id)
-        return self.put_json(url_path, params, expected_code)
+        return self.put_json(url_path, params, expected_code, headers)
 
     def put_create(self, expected_code=201):
         url_path = 'testpool'
@@ -76,7 +91,8 @@ class ApiClient(object):
         return self.put(url_path, Headers(hdict), content, expected_code)
 
     def put_export(self, request_id, count=None, operators=None,
-                   denominations=None, expected_code=200):
+                   denominations=None, expected_code=200, page_size=None,
+                   page_token=None):
         params = {}
         if count is not None:
             params['count'] = count
@@ -84,36 +100,60 @@ class ApiClient(object):
             params['operators'] = operators
         if denominations is not None:
             params['denominations'] = denominations
+        if page_size is not None:
+            params['page_size'] = page_size
+        if page_token is not None:
+            params['page_token'] = page_token
         url_path = 'testpool/export/%s' % (request_id,)
         return self.put_json(url_path, params, expected_code)
 
-    def get_audit_query(self, request_id, field, value, expected_code=200):
+    def get_audit_query(self, request_id, field, value, expected_code=200,
+                        etag=None):
         params = {'request_id': request_id, 'field': field, 'value': value}
-        return self.get('testpool/audit_query', params, expected_code)
+        headers = None
+        if etag is not None:
+            headers = Headers({'If-None-Match': [etag]})
+        return self.get('testpool/audit_query', params, expected_code, headers)
+
+    def last_etag(self):
+        [etag] = self.last_response.headers.getRawHeaders('ETag')
+        return etag
 
     def get_voucher_counts(self, request_id, expected_code=200):
         params = {'request_id': request_id}
         return self.get('testpool/voucher_counts', params, expected_code)
 
+    def get_catalog(self, request_id, expected_code=200):
+        params = {'request_id': request_id}
+        return self.get('testpool/catalog', params, expected_code)
+
+
+class AirtimeServiceAppTestsMixin(object):
+    """
+    Tests for API behaviour that doesn't depend on the database backend.
+
+    Subclasses must set ``connection_string`` and implement
+    ``_drop_tables()``.
+    """
 
-class TestAirtimeServiceApp(TestCase):
     timeout = 5
+    _using_mysql = False
+    shared_tables = False
 
     @inlineCallbacks
     def setUp(self):
         # We need to make sure all our queries run in the same thread,
         # otherwise sqlite gets very sad.
         reactor.suggestThreadPoolSize(1)
-        connection_string = os.environ.get(
-            "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
-        self._using_mysql = connection_string.startswith('mysql')
-        self.asapp = AirtimeServiceApp(connection_string, reactor=reactor)
+        self.asapp = AirtimeServiceApp(
+            self.connection_string, reactor=reactor,
+            shared_tables=self.shared_tables)
         site = Site(self.asapp.app.resource())
         self.listener = reactor.listenTCP(0, site, interface='localhost')
         self.listener_port = self.listener.getHost().port
         self._drop_tables()
         self.conn = yield self.asapp.engine.connect()
-        self.pool = VoucherPool('testpool', self.conn)
+        self.pool = self.asapp.voucher_pool_class('testpool', self.conn)
         self.client = ApiClient('http://localhost:%s' % (self.listener_port,))
 
     @inlineCallbacks
@@ -122,18 +162,41 @@ class TestAirtimeServiceApp(TestCase):
         self._drop_tables()
         yield self.listener.loseConnection()
 
-    def _drop_tables(self):
-        # NOTE: This is a blocking operation!
-        md = MetaData(bind=self.asapp.engine._engine)
-        md.reflect()
-        md.drop_all()
-        assert self.asapp.engine._engine.table_names() == []
-
     @inlineCallbacks
     def assert_voucher_counts(self, expected_rows):
         rows = yield self.pool.count_vouchers()
         assert sorted(tuple(r) for r in rows) == sorted(expected_rows)
 
+    @inlineCallbacks
+    def test_health_live(self):
+        rsp = yield self.client.get('health/live', {}, 200)
+        assert rsp == {'request_id': None, 'live': True}
+
+    @inlineCallbacks
+    def test_health_ready(self):
+        rsp = yield self.client.get('health/ready', {}, 503)
+        assert rsp == {'request_id': None, 'ready': False}
+
+        yield self.asapp.warm_up()
+        rsp = yield self.client.get('health/ready', {}, 200)
+        assert rsp == {'request_id': None, 'ready': True}
+
+    @inlineCallbacks
+    def test_shutdown(self):
+        yield self.asapp.warm_up()
+        yield self.asapp.shutdown(timeout=1)
+
+        rsp = yield self.client.get('health/ready', {}, 503)
+        assert rsp == {'request_id': None, 'ready': False}
+        rsp = yield self.client.put_issue(
+            'req-0', 'Tank', 'red', expected_code=503)
+        assert rsp == {
+            'request_id': 'req-0',
+            'error': 'Service shutting down.',
+        }
+        headers = self.client.last_response.headers
+        assert headers.getRawHeaders('Retry-After') == ['1']
+
     @inlineCallbacks
     def test_request_missing_params(self):
         params = mk_audit_params('req-0')
@@ -236,6 +299,148 @@ class TestAirtimeServiceApp(TestCase):
                 ' parameters.'),
         }
 
+    @inlineCallbacks
+    def test_issue_overloaded(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red'], [0])
+        self.asapp.admission = AdmissionController(
+            reactor, endpoint_limits={'issue_voucher': 0}, max_queued=0,
+            retry_after=7)
+        rsp = yield self.client.put_issue(
+            'req-0', 'Tank', 'red', expected_code=503)
+        assert rsp == {
+            'request_id': 'req-0',
+            'error': 'Service overloaded.',
+        }
+        headers = self.client.last_response.headers
+        assert headers.getRawHeaders('Retry-After') == ['7']
+        yield self.assert_voucher_counts([('Tank', 'red', False, 1)])
+
+        # Other endpoints are unaffected.
+        rsp = yield self.client.get_voucher_counts('req-1')
+        assert rsp['voucher_counts'] == [{
+            'operator': 'Tank',
+            'denomination': 'red',
+            'used': False,
+            'count': 1,
+        }]
+
+    def gate_issue(self):
+        """
+        Make issue_voucher wait until the returned Deferred fires.
+        """
+        pool_class = self.asapp.voucher_pool_class
+        issue_voucher = pool_class.issue_voucher
+        gate = Deferred()
+        calls = []
+
+        def gated_issue_voucher(pool, *args):
+            calls.append(args)
+            return gate.addCallback(lambda _: issue_voucher(pool, *args))
+        self.patch(pool_class, 'issue_voucher', gated_issue_voucher)
+        return gate, calls
+
+    @inlineCallbacks
+    def wait_for(self, condition):
+        # Requests arrive over real connections, so we have to poll.
+        while not condition():
+            yield deferLater(reactor, 0.01, lambda: None)
+
+    @inlineCallbacks
+    def test_issue_duplicates_share_result(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red'], [0, 1])
+        gate, calls = self.gate_issue()
+
+        key = ('testpool', 'issue', 'req-0')
+        d0 = self.client.put_issue('req-0', 'Tank', 'red')
+        yield self.wait_for(lambda: calls)
+        d1 = self.client.put_issue('req-0', 'Tank', 'red')
+        rsp2 = yield self.client.put_issue(
+            'req-0', 'Tank', 'blue', expected_code=400)
+        assert rsp2['error'] == (
+            'This request has already been performed with different'
+            ' parameters.')
+        yield self.wait_for(lambda: self.asapp.single_flight.waiting(key))
+        gate.callback(None)
+
+        rsp0 = yield d0
+        rsp1 = yield d1
+        assert rsp0 == rsp1 == {'request_id': 'req-0', 'voucher': 'Tank-red-0'}
+        assert len(calls) == 1
+        yield self.assert_voucher_counts([
+            ('Tank', 'red', False, 1),
+            ('Tank', 'red', True, 1),
+        ])
+
+    @inlineCallbacks
+    def test_issue_rate_limited(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red'], [0, 1])
+        self.asapp.user_rate_limiter = RateLimiter(reactor, rate=0.1, burst=1)
+        yield self.client.put_issue('req-0', 'Tank', 'red', user_id='user-0')
+        rsp = yield self.client.put_issue(
+            'req-1', 'Tank', 'red', user_id='user-0', expected_code=429)
+        assert rsp == {
+            'request_id': 'req-1',
+            'error': 'Rate limit exceeded.',
+        }
+        headers = self.client.last_response.headers
+        assert headers.getRawHeaders('Retry-After') == ['10']
+        yield self.assert_voucher_counts([
+            ('Tank', 'red', False, 1),
+            ('Tank', 'red', True, 1),
+        ])
+
+        # Other users aren't limited.
+        yield self.client.put_issue(
+            'req-2', 'Tank', 'red', user_id='user-1')
+
+    @inlineCallbacks
+    def test_issue_rate_limited_by_source(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red'], [0, 1])
+        self.asapp.source_rate_limiter = RateLimiter(
+            reactor, rate=0.1, burst=1)
+        yield self.client.put_issue('req-0', 'Tank', 'red')
+        yield self.client.put_issue(
+            'req-1', 'Tank', 'red', user_id='user-1', expected_code=429)
+
+    @inlineCallbacks
+    def test_issue_rate_limited_by_source_behind_proxy(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red'], [0, 1, 2])
+        self.asapp.source_rate_limiter = RateLimiter(
+            reactor, rate=0.1, burst=1)
+        # The test client connects from 127.0.0.1, like a local proxy.
+        self.asapp.trusted_proxies = ['127.0.0.1']
+
+        def forwarded_for(address):
+            return {'X-Forwarded-For': [address]}
+
+        yield self.client.put_issue(
+            'req-0', 'Tank', 'red', user_id='user-0',
+            headers=forwarded_for('192.168.0.1'))
+        yield self.client.put_issue(
+            'req-1', 'Tank', 'red', user_id='user-1',
+            headers=forwarded_for('192.168.0.2'))
+        yield self.client.put_issue(
+            'req-2', 'Tank', 'red', user_id='user-2',
+            headers=forwarded_for('192.168.0.1'), expected_code=429)
+        # Clients can't get around the limit by adding their own addresses.
+        yield self.client.put_issue(
+            'req-3', 'Tank', 'red', user_id='user-3',
+            headers=forwarded_for('10.9.9.9, 192.168.0.2'),
+            expected_code=429)
+
+    @inlineCallbacks
+    def test_no_server_timing_by_default(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red'], [0])
+        yield self.client.put_issue('req-0', 'Tank', 'red')
+        headers = self.client.last_response.headers
+        assert not headers.hasHeader('Server-Timing')
+
     @inlineCallbacks
     def test_issue_no_voucher(self):
         yield self.pool.create_tables()
@@ -371,6 +576,76 @@ class TestAirtimeServiceApp(TestCase):
             'error': False,
         }])
 
+    @inlineCallbacks
+    def test_query_by_request_id_cached(self):
+        yield self.pool.create_tables()
+        cache = self.asapp.audit_cache
+
+        # Lookups that find nothing aren't cached.
+        yield self.client.get_audit_query('audit-0', 'request_id', 'req-0')
+        yield self.client.get_audit_query('audit-1', 'request_id', 'req-0')
+        assert (cache.hits, cache.misses) == (0, 2)
+
+        audit_params = mk_audit_params('req-0')
+        yield self.pool._audit_request(audit_params, 'req_data', 'resp_data')
+        rsp0 = yield self.client.get_audit_query(
+            'audit-2', 'request_id', 'req-0')
+        rsp1 = yield self.client.get_audit_query(
+            'audit-3', 'request_id', 'req-0')
+        assert (cache.hits, cache.misses) == (1, 3)
+        assert rsp1['results'] == rsp0['results']
+        self._assert_audit_entries('audit-3', rsp1, [{
+            'audit_params': audit_params,
+            'request_data': u'req_data',
+            'response_data': u'resp_data',
+            'error': False,
+        }])
+
+    @inlineCallbacks
+    def test_query_etag(self):
+        yield self.pool.create_tables()
+
+        audit_params_0 = mk_audit_params('req-0', 'transaction-0', 'user-0')
+        audit_params_1 = mk_audit_params('req-1', 'transaction-1', 'user-0')
+        yield self.pool._audit_request(
+            audit_params_0, 'req_data_0', 'resp_data_0')
+
+        rsp = yield self.client.get_audit_query('audit-0', 'user_id', 'user-0')
+        assert len(rsp['results']) == 1
+        etag = self.client.last_etag()
+
+        rsp = yield self.client.get_audit_query(
+            'audit-1', 'user_id', 'user-0', expected_code=304, etag=etag)
+        assert rsp is None
+        assert self.client.last_etag() == etag
+
+        # Other queries have their own ETags.
+        yield self.client.get_audit_query(
+            'audit-2', 'transaction_id', 'transaction-1', etag=etag)
+        assert self.client.last_etag() != etag
+
+        yield self.pool._audit_request(
+            audit_params_1, 'req_data_1', 'resp_data_1')
+        rsp = yield self.client.get_audit_query(
+            'audit-3', 'user_id', 'user-0', etag=etag)
+        assert len(rsp['results']) == 2
+        assert self.client.last_etag() != etag
+
+    @inlineCallbacks
+    def test_issuance_stats(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red'], [0, 1, 2, 3])
+        yield self.client.get_voucher_counts('req-0')
+        yield self.client.put_issue('req-1', 'Tank', 'red')
+        yield self.client.put_export('req-2', 2, ['Tank'], ['red'])
+
+        [stats] = self.asapp.issuance_stats.report('testpool')['stats']
+        assert stats['issued'] == 1
+        assert stats['exported'] == 2
+        # The voucher count told us how many there were.
+        assert stats['available'] == 1
+        assert stats['depletion_seconds'] > 0
+
     @inlineCallbacks
     def test_create(self):
         resp = yield self.client.put_create()
@@ -414,6 +689,42 @@ class TestAirtimeServiceApp(TestCase):
             ('Tank', 'red', False, 2),
         ])
 
+    @inlineCallbacks
+    def test_import_in_chunks(self):
+        self.asapp.import_chunk_size = 3
+        yield self.pool.create_tables()
+
+        content = '\n'.join([
+            'operator,denomination,voucher',
+            'Tank,red,Tr0',
+            'Tank,red,Tr1',
+            'Tank,blue,Tb0',
+            'Tank,blue,Tb1',
+            'Link,red,Lr0',
+            'Link,red,Lr1',
+            'Link,blue,Lb0',
+            'Link,blue,Lb1',
+        ])
+        expected_counts = [
+            ('Link', 'blue', False, 2),
+            ('Link', 'red', False, 2),
+            ('Tank', 'blue', False, 2),
+            ('Tank', 'red', False, 2),
+        ]
+
+        resp = yield self.client.put_import('req-0', content)
+        assert resp == {
+            'request_id': 'req-0',
+            'imported': True,
+        }
+        yield self.assert_voucher_counts(expected_counts)
+
+        resp = yield self.client.put_import('req-0', content)
+        assert resp['imported']
+        yield self.assert_voucher_counts(expected_counts)
+        yield self.client.put_import(
+            'req-0', content.replace('Lb1', 'Lb2'), expected_code=400)
+
     @inlineCallbacks
     def test_import_missing_pool(self):
         content = '\n'.join([
@@ -592,6 +903,33 @@ class TestAirtimeServiceApp(TestCase):
             },
         ]
 
+    @inlineCallbacks
+    def test_catalog(self):
+        yield self.pool.create_tables()
+        rsp0 = yield self.client.get_catalog('req-0')
+        assert rsp0 == {
+            'request_id': 'req-0',
+            'catalog': [],
+        }
+
+        yield populate_pool(self.pool, ['Tank', 'Link'], ['red'], [0, 1])
+        rsp1 = yield self.client.get_catalog('req-1')
+        assert rsp1 == {
+            'request_id': 'req-1',
+            'catalog': [
+                {'operator': 'Link', 'denomination': 'red'},
+                {'operator': 'Tank', 'denomination': 'red'},
+            ],
+        }
+
+    @inlineCallbacks
+    def test_catalog_missing_pool(self):
+        rsp = yield self.client.get_catalog('req-0', expected_code=404)
+        assert rsp == {
+            'request_id': 'req-0',
+            'error': 'Voucher pool does not exist.',
+        }
+
     @inlineCallbacks
     def test_export_all_vouchers(self):
         yield self.pool.create_tables()
@@ -740,3 +1078,350 @@ class TestAirtimeServiceApp(TestCase):
                 'This request has already been performed with different'
                 ' parameters.'),
         }
+
+    @inlineCallbacks
+    def test_export_in_pages(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red', 'blue'], [0, 0, 0])
+
+        page0 = yield self.client.put_export(
+            'req-0', 2, ['Tank'], ['red', 'blue'], page_size=3)
+        assert page0['next_page_token'] == '1'
+        assert len(page0['vouchers']) == 3
+        page1 = yield self.client.put_export(
+            'req-0', 2, ['Tank'], ['red', 'blue'], page_size=3,
+            page_token=page0['next_page_token'])
+        assert page1 == {
+            'request_id': 'req-0',
+            'vouchers': [voucher_dict('Tank', 'blue', 'Tank-blue-0')],
+            'warnings': [],
+            'next_page_token': None,
+        }
+        yield self.assert_voucher_counts([
+            ('Tank', 'blue', False, 1),
+            ('Tank', 'red', False, 1),
+            ('Tank', 'blue', True, 2),
+            ('Tank', 'red', True, 2),
+        ])
+
+        # Replaying a token gets the same page.
+        replayed = yield self.client.put_export(
+            'req-0', 2, ['Tank'], ['red', 'blue'], page_size=3,
+            page_token='1')
+        assert replayed == page1
+
+        response = yield self.client.put_export(
+            'req-0', 2, ['Tank'], ['red', 'blue'], page_size=3,
+            page_token='2', expected_code=400)
+        assert response == {
+            'request_id': 'req-0',
+            'error': 'Unknown page_token.',
+        }
+        response = yield self.client.put_export(
+            'req-0', 2, ['Tank'], ['red', 'blue'], page_size=2,
+            page_token='1', expected_code=400)
+        assert response['error'] == (
+            'This request has already been performed with different'
+            ' parameters.')
+        yield self.assert_voucher_counts([
+            ('Tank', 'blue', False, 1),
+            ('Tank', 'red', False, 1),
+            ('Tank', 'blue', True, 2),
+            ('Tank', 'red', True, 2),
+        ])
+
+    @inlineCallbacks
+    def test_export_in_pages_bad_params(self):
+        yield self.pool.create_tables()
+        for page_size in [0, 'many']:
+            response = yield self.client.put_export(
+                'req-0', page_size=page_size, expected_code=400)
+            assert response['error'] == 'page_size must be a positive integer.'
+        self.asapp.max_export_page_size = 5
+        response = yield self.client.put_export(
+            'req-0', page_size=6, expected_code=400)
+        assert response['error'] == 'page_size must be at most 5.'
+        response = yield self.client.put_export(
+            'req-0', page_size=2, page_token='next', expected_code=400)
+        assert response['error'] == 'Unknown page_token.'
+        response = yield self.client.put_export(
+            'req-0', page_token='1', expected_code=400)
+        assert response['error'] == 'page_token requires page_size.'
+
+
+class TestAirtimeServiceApp(AirtimeServiceAppTestsMixin, TestCase):
+    connection_string = os.environ.get(
+        "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
+    _using_mysql = connection_string.startswith('mysql')
+
+    def _drop_tables(self):
+        # NOTE: This is a blocking operation!
+        md = MetaData(bind=self.asapp.engine._engine)
+        md.reflect()
+        md.drop_all()
+        assert self.asapp.engine._engine.table_names() == []
+
+    @inlineCallbacks
+    def test_warm_up_compiles_statements(self):
+        models.clear_statement_cache()
+        yield self.asapp.warm_up(connections=2, pools=['pool0', 'pool1'])
+        assert self.asapp.ready
+        shapes = set(
+            (key[0], key[-1][0]) for key in models._compiled_statements)
+        assert set([
+            ('pool0', 'get_voucher'),
+            ('pool0', 'audit_insert'),
+            ('pool1', 'get_voucher'),
+            ('pool1', 'audit_insert'),
+        ]).issubset(shapes)
+
+    def _server_timing_phases(self):
+        [value] = self.client.last_response.headers.getRawHeaders(
+            'Server-Timing')
+        return [phase.split(';')[0] for phase in value.split(', ')]
+
+    @inlineCallbacks
+    def test_issue_server_timing(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red'], [0])
+        self.asapp.server_timing = True
+        yield self.client.put_issue('req-0', 'Tank', 'red')
+        assert self._server_timing_phases() == [
+            'admission', 'connect', 'begin', 'claim', 'audit', 'commit',
+            'total']
+
+        # Replays and failures get timing too. Replays don't get as far as
+        # claiming a voucher.
+        yield self.client.put_issue('req-0', 'Tank', 'red')
+        assert self._server_timing_phases() == [
+            'admission', 'connect', 'begin', 'claim', 'audit', 'lookup',
+            'total']
+        yield self.client.put_issue('req-1', 'Tank', 'red', expected_code=500)
+        assert self._server_timing_phases() == [
+            'admission', 'connect', 'begin', 'claim', 'audit', 'commit',
+            'total']
+
+    @inlineCallbacks
+    def test_issue_server_timing_includes_admission_wait(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red'], [0, 1])
+        self.asapp.server_timing = True
+        self.asapp.admission = AdmissionController(
+            reactor, endpoint_limits={'issue_voucher': 1}, max_queued=1)
+        gate, calls = self.gate_issue()
+
+        d0 = self.client.put_issue('req-0', 'Tank', 'red')
+        yield self.wait_for(lambda: calls)
+        d1 = self.client.put_issue('req-1', 'Tank', 'red')
+        yield self.wait_for(lambda: self.asapp.admission.queued)
+        yield deferLater(reactor, 0.05, lambda: None)
+        gate.callback(None)
+        yield d0
+        yield d1
+
+        [value] = self.client.last_response.headers.getRawHeaders(
+            'Server-Timing')
+        phases = dict(
+            (name, float(dur[len('dur='):])) for name, dur in [
+                phase.split(';') for phase in value.split(', ')])
+        assert phases['admission'] >= 50
+        assert phases['total'] >= phases['admission']
+
+    @inlineCallbacks
+    def test_rejected_server_timing(self):
+        yield self.pool.create_tables()
+        self.asapp.server_timing = True
+        self.asapp.admission = AdmissionController(
+            reactor, endpoint_limits={'issue_voucher': 0}, max_queued=0)
+        yield self.client.put_issue('req-0', 'Tank', 'red', expected_code=503)
+        assert self._server_timing_phases() == ['admission', 'total']
+
+    @inlineCallbacks
+    def test_access_log(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red'], [0])
+        log_path = temp_path(self)
+        self.asapp.access_log = AccessLog(log_path)
+        self.asapp.access_log.startService()
+
+        yield self.client.put_issue('req-0', 'Tank', 'red')
+        yield self.client.put_issue('req-1', 'Tank', 'red', expected_code=500)
+        yield self.asapp.access_log.stopService()
+
+        with open(log_path) as f:
+            entries = [json.loads(line) for line in f]
+        assert [(e['request_id'], e['pool'], e['operator'], e['status'],
+                 e['outcome']) for e in entries] == [
+            ('req-0', 'testpool', 'Tank', 200, 'success'),
+            ('req-1', 'testpool', 'Tank', 500, 'error'),
+        ]
+        assert all(e['latency'] > 0 for e in entries)
+
+    def fail_once(self, method_name, exc):
+        """
+        Make the voucher pool method ``method_name`` fail with ``exc`` the
+        first time it's called.
+        """
+        pool_class = self.asapp.voucher_pool_class
+        method = getattr(pool_class, method_name)
+        calls = []
+
+        def fail_once(pool, *args, **kw):
+            calls.append(args)
+            if len(calls) == 1:
+                return fail(exc)
+            return method(pool, *args, **kw)
+        self.patch(pool_class, method_name, fail_once)
+        return calls
+
+    @inlineCallbacks
+    def test_import_retried_when_database_locked(self):
+        yield self.pool.create_tables()
+        calls = self.fail_once('_get_dimension_ids', OperationalError(
+            'SELECT ...', {}, Exception('database is locked')))
+        content = '\n'.join([
+            'operator,denomination,voucher',
+            'Tank,red,Tr0',
+            'Tank,red,Tr1',
+        ])
+
+        yield self.client.put_import('req-0', content)
+        assert len(calls) == 3
+        yield self.assert_voucher_counts([('Tank', 'red', False, 2)])
+        assert self.asapp.retrier.retries == {'import': 1}
+
+    @inlineCallbacks
+    def test_import_in_chunks_resumed(self):
+        self.asapp.import_chunk_size = 2
+        # Our in-memory database has only one connection, so a chunk that
+        # rolls back would take concurrently staged chunks with it.
+        self.asapp.import_concurrency = 1
+        yield self.pool.create_tables()
+        stage_chunk = self.asapp.voucher_pool_class.stage_import_chunk
+        staged = []
+
+        def fail_chunk_1(pool, request_id, content_md5, chunk_size, chunk,
+                         rows):
+            staged.append(chunk)
+            if staged.count(1) == 1 and chunk == 1:
+                return fail(ValueError('Connection lost.'))
+            return stage_chunk(
+                pool, request_id, content_md5, chunk_size, chunk, rows)
+        self.patch(
+            self.asapp.voucher_pool_class, 'stage_import_chunk', fail_chunk_1)
+
+        content = '\n'.join([
+            'operator,denomination,voucher',
+            'Tank,red,Tr0',
+            'Tank,red,Tr1',
+            'Tank,red,Tr2',
+            'Tank,red,Tr3',
+            'Tank,red,Tr4',
+        ])
+        yield self.client.put_import('req-0', content, expected_code=500)
+        self.flushLoggedErrors(ValueError)
+        yield self.assert_voucher_counts([])
+
+        # The retry skips the chunks that made it the first time, so
+        # nothing is imported twice.
+        yield self.client.put_import('req-0', content)
+        assert sorted(staged) == [0, 0, 1, 1, 2, 2]
+        yield self.assert_voucher_counts([('Tank', 'red', False, 5)])
+        rows = yield self.pool.execute_fetchall(
+            self.pool.staged_vouchers.select())
+        assert rows == []
+
+    @inlineCallbacks
+    def test_issue_not_retried_for_other_errors(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red'], [0])
+        calls = self.fail_once('_issue_voucher', OperationalError(
+            'SELECT ...', {}, Exception('disk I/O error')))
+
+        yield self.client.put_issue('req-0', 'Tank', 'red', expected_code=500)
+        self.flushLoggedErrors(OperationalError)
+        assert len(calls) == 1
+        assert self.asapp.retrier.retries == {}
+        yield self.assert_voucher_counts([('Tank', 'red', False, 1)])
+
+    @inlineCallbacks
+    def test_create_upgrades_existing_pool(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red'], [0])
+        # Pretend this pool was created before the catalog existed, and
+        # before schema versions were recorded.
+        yield self.conn.execute(DropTable(self.pool.catalog))
+        yield self.conn.execute(migrations.schema_versions.delete())
+
+        yield self.client.put_create(expected_code=200)
+        catalog = yield self.pool.list_catalog()
+        assert catalog == [('Tank', 'red')]
+
+    @inlineCallbacks
+    def test_requests_refused_until_upgraded(self):
+        yield self.pool.create_tables()
+        yield populate_pool(self.pool, ['Tank'], ['red'], [0])
+        yield self.conn.execute(migrations.schema_versions.delete())
+
+        rsp = yield self.client.put_issue(
+            'req-0', 'Tank', 'red', expected_code=503)
+        assert rsp == {
+            'request_id': 'req-0',
+            'error': 'Voucher pool needs a schema upgrade.',
+        }
+        yield self.assert_voucher_counts([('Tank', 'red', False, 1)])
+
+        yield self.client.put_create(expected_code=200)
+        rsp = yield self.client.put_issue('req-0', 'Tank', 'red')
+        assert rsp['voucher'] == 'Tank-red-0'
+
+    @inlineCallbacks
+    def test_create_refuses_offline_upgrade(self):
+        yield self.pool.create_tables()
+        yield self.conn.execute(migrations.schema_versions.delete())
+        # Pretend the voucher tables still need rebuilding.
+        self.patch(migrations.use_dimension_ids, 'needs_idle',
+                   lambda pool: succeed(True))
+
+        rsp = yield self.client.put_create(expected_code=503)
+        assert rsp == {
+            'request_id': None,
+            'error': 'Voucher pool needs an offline schema upgrade.',
+        }
+        version = yield migrations.get_schema_version(self.pool)
+        assert version == 1
+
+
+class TestSharedAirtimeServiceApp(AirtimeServiceAppTestsMixin, TestCase):
+    connection_string = os.environ.get(
+        "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
+    _using_mysql = connection_string.startswith('mysql')
+    shared_tables = True
+
+    def _drop_tables(self):
+        # NOTE: This is a blocking operation!
+        md = MetaData(bind=self.asapp.engine._engine)
+        md.reflect()
+        md.drop_all()
+        assert self.asapp.engine._engine.table_names() == []
+
+    @inlineCallbacks
+    def test_warm_up_compiles_statements(self):
+        models.clear_statement_cache()
+        yield self.pool.create_tables()
+        yield self.asapp.warm_up(pools=['testpool', 'missingpool'])
+        assert self.asapp.ready
+        shapes = set(
+            (key[0], key[-1][0]) for key in models._compiled_statements)
+        assert ('testpool', 'get_voucher') in shapes
+        # Statements for a pool include its id, so we can't build them for
+        # pools that don't exist yet.
+        assert 'missingpool' not in set(key[0] for key in shapes)
+
+
+class TestMemoryAirtimeServiceApp(AirtimeServiceAppTestsMixin, TestCase):
+    connection_string = 'memory://'
+
+    def _drop_tables(self):
+        # Each app has its own in-memory database, so there's nothing to do.
+        pass
@@ -0,0 +1,101 @@
+import os
+
+from aludel.database import get_engine, MetaData
+from aludel.tests.doubles import FakeReactorThreads
+from twisted.trial.unittest import TestCase
+
+from airtime_service.archiver import VoucherArchiver
+from airtime_service.models import VoucherPool
+from airtime_service.shared import SharedVoucherPool
+
+from .helpers import populate_pool, mk_audit_params
+
+
+class TestVoucherArchiver(TestCase):
+    timeout = 5
+
+    def setUp(self):
+        connection_string = os.environ.get(
+            "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
+        self.engine = get_engine(
+            connection_string, reactor=FakeReactorThreads())
+        self._drop_tables()
+        self.conn = self.successResultOf(self.engine.connect())
+
+    def tearDown(self):
+        self.successResultOf(self.conn.close())
+        self._drop_tables()
+
+    def _drop_tables(self):
+        # NOTE: This is a blocking operation!
+        md = MetaData(bind=self.engine._engine)
+        md.reflect()
+        md.drop_all()
+
+    def mk_pool(self, name, vouchers, issued, pool_class=VoucherPool):
+        pool = pool_class(name, self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], range(vouchers))
+        for i in range(issued):
+            self.successResultOf(pool.issue_voucher(
+                'Tank', 'red', mk_audit_params('req-%s' % (i,))))
+        return pool
+
+    def assert_voucher_counts(self, pool, expected_rows):
+        rows = self.successResultOf(pool.count_vouchers())
+        assert sorted(tuple(r) for r in rows) == sorted(expected_rows)
+
+    def count_archived(self, pool):
+        rows = self.successResultOf(
+            pool.execute_fetchall(pool.vouchers_used.select()))
+        return len(rows)
+
+    def test_archive_pool_in_batches(self):
+        pool = self.mk_pool('pool0', 8, 6)
+        archived = []
+        archive_used_vouchers = pool.archive_used_vouchers
+
+        def record_batches(batch_size):
+            d = archive_used_vouchers(batch_size)
+            return d.addCallback(lambda moved: archived.append(moved) or moved)
+        pool.archive_used_vouchers = record_batches
+
+        archiver = VoucherArchiver(self.engine, batch_size=4)
+        assert self.successResultOf(archiver.archive_pool(pool)) == 6
+        assert archived == [4, 2]
+
+    def test_archive_all_pools(self):
+        pool0 = self.mk_pool('pool0', 3, 2)
+        pool1 = self.mk_pool('pool1', 3, 1)
+        archiver = VoucherArchiver(self.engine)
+        self.successResultOf(archiver.archive())
+        assert self.count_archived(pool0) == 2
+        assert self.count_archived(pool1) == 1
+
+    def test_archive_shared_pools(self):
+        pool0 = self.mk_pool('pool0', 3, 2, SharedVoucherPool)
+        pool1 = self.mk_pool('pool1', 3, 1, SharedVoucherPool)
+        archiver = VoucherArchiver(
+            self.engine, voucher_pool_class=SharedVoucherPool)
+        self.successResultOf(archiver.archive())
+        # Archiving is per pool, but the archive table is shared.
+        assert self.count_archived(pool0) == 3
+        self.assert_voucher_counts(pool0, [
+            ('Tank', 'red', False, 1), ('Tank', 'red', True, 2)])
+        self.assert_voucher_counts(pool1, [
+            ('Tank', 'red', False, 2), ('Tank', 'red', True, 1)])
+
+    def test_archive_no_pools(self):
+        archiver = VoucherArchiver(self.engine)
+        self.successResultOf(archiver.archive())
+        assert self.flushLoggedErrors() == []
+
+    def test_archive_logs_errors(self):
+        self.mk_pool('pool0', 3, 2)
+        archiver = VoucherArchiver(self.engine)
+
+        def broken_archive_pool(pool):
+            raise ValueError('oops')
+        archiver.archive_pool = broken_archive_pool
+        self.successResultOf(archiver.archive())
+        assert len(self.flushLoggedErrors(ValueError)) == 1
@@ -0,0 +1,43 @@
+from twisted.trial.unittest import TestCase
+
+from airtime_service.audit_cache import AuditCache
+
+
+class TestAuditCache(TestCase):
+    def test_get_and_put(self):
+        cache = AuditCache()
+        assert cache.get(('pool0', 'req-0')) is None
+        cache.put(('pool0', 'req-0'), ['row0'])
+        assert cache.get(('pool0', 'req-0')) == ['row0']
+        assert cache.get(('pool1', 'req-0')) is None
+        assert (cache.hits, cache.misses) == (1, 2)
+        assert cache.stats() == {
+            'entries': 1,
+            'max_entries': 10000,
+            'hits': 1,
+            'misses': 2,
+        }
+
+    def test_put_existing(self):
+        cache = AuditCache(max_entries=2)
+        cache.put('a', 1)
+        cache.put('a', 2)
+        assert cache.get('a') == 1
+        assert len(cache) == 1
+
+    def test_oldest_entries_evicted(self):
+        cache = AuditCache(max_entries=2)
+        for i, key in enumerate('abc'):
+            cache.put(key, i)
+        assert len(cache) == 2
+        assert cache.get('a') is None
+        assert cache.get('b') == 1
+        assert cache.get('c') == 2
+
+    def test_used_entries_kept(self):
+        cache = AuditCache(max_entries=2)
+        cache.put('a', 0)
+        cache.put('b', 1)
+        assert cache.get('a') == 0
+        cache.put('c', 2)
+        assert sorted(cache) == ['a', 'c']
@@ -0,0 +1,30 @@
+from twisted.trial.unittest import TestCase
+
+from airtime_service.tests.benchmarks import run_benchmarks, compare_results
+
+
+def mk_results(database='sqlite', **results):
+    return {'database': database, 'results': results}
+
+
+class TestBenchmarks(TestCase):
+    def test_run_benchmarks(self):
+        results = run_benchmarks('sqlite://', scale=0.001)
+        assert results['database'] == 'sqlite'
+        assert set([
+            'compile_cached', 'compile_uncached', 'import_vouchers[10]',
+            'import_vouchers[100]', 'import_vouchers[1000]',
+            'issue_voucher[16]', 'issue_voucher[100]', 'export_vouchers[1]',
+            'count_vouchers', 'query_by_user_id[100]',
+        ]).issubset(results['results'])
+
+    def test_compare_results(self):
+        baseline = mk_results(fast=1.0, slow=1.0, gone=1.0)
+        results = mk_results(fast=0.5, slow=1.5, new=1.0)
+        assert compare_results(results, baseline) == [('slow', 1.0, 1.5)]
+        assert compare_results(results, baseline, threshold=0.6) == []
+
+    def test_compare_results_different_database(self):
+        baseline = mk_results('postgresql', slow=1.0)
+        results = mk_results(slow=2.0)
+        assert compare_results(results, baseline) == []
@@ -0,0 +1,80 @@
+from twisted.internet.defer import Deferred, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from airtime_service.concurrency import DatabaseThreads, PoolLimiter
+
+
+class TestPoolLimiter(TestCase):
+    def test_unlimited(self):
+        limiter = PoolLimiter()
+        blockers = [Deferred() for _ in range(5)]
+        results = [limiter.run('pool', lambda d=d: d) for d in blockers]
+        for i, d in enumerate(blockers):
+            d.callback(i)
+        assert [self.successResultOf(r) for r in results] == range(5)
+        assert limiter.in_flight('pool') == 0
+
+    def test_limit_per_pool(self):
+        limiter = PoolLimiter(2)
+        started = []
+
+        def work(name):
+            d = Deferred()
+            started.append((name, d))
+            return d
+
+        results = [limiter.run('pool0', work, i) for i in range(4)]
+        other = limiter.run('pool1', work, 'other')
+        assert [name for name, _ in started] == [0, 1, 'other']
+        assert limiter.in_flight('pool0') == 2
+        assert limiter.waiting('pool0') == 2
+        assert limiter.in_flight('pool1') == 1
+
+        # Waiting work starts in the order it arrived.
+        started[1][1].callback('done-1')
+        assert [name for name, _ in started] == [0, 1, 'other', 2]
+        started[0][1].callback('done-0')
+        assert [name for name, _ in started] == [0, 1, 'other', 2, 3]
+        assert self.successResultOf(results[0]) == 'done-0'
+        assert self.successResultOf(results[1]) == 'done-1'
+
+        started[2][1].callback(None)
+        self.successResultOf(other)
+
+    def test_failure_releases(self):
+        limiter = PoolLimiter(1)
+        blocker = Deferred()
+        d0 = limiter.run('pool', lambda: blocker)
+        d1 = limiter.run('pool', lambda: succeed('ok'))
+        assert limiter.waiting('pool') == 1
+        blocker.errback(ValueError('oops'))
+        self.failureResultOf(d0, ValueError)
+        assert self.successResultOf(d1) == 'ok'
+
+    def test_idle_pools_forgotten(self):
+        limiter = PoolLimiter(1)
+        blocker = Deferred()
+        d = limiter.run('pool', lambda: blocker)
+        assert 'pool' in limiter._semaphores
+        blocker.callback(None)
+        self.successResultOf(d)
+        assert limiter._semaphores == {}
+
+
+class TestDatabaseThreads(TestCase):
+    def test_delegates_to_reactor(self):
+        clock = Clock()
+        db_threads = DatabaseThreads(clock, 4)
+        db_threads.callLater(1, lambda: None)
+        assert len(clock.getDelayedCalls()) == 1
+
+    def test_thread_pool_lifecycle(self):
+        db_threads = DatabaseThreads(Clock(), 4)
+        threadpool = db_threads.getThreadPool()
+        assert threadpool.max == 4
+        assert not threadpool.started
+        db_threads.startService()
+        assert threadpool.started
+        db_threads.stopService()
+        assert threadpool.joined
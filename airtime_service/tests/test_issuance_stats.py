@@ -0,0 +1,152 @@
+import json
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from airtime_service.issuance_stats import IssuanceStats
+
+from .helpers import temp_path
+
+
+def mk_clock(now=3600):
+    clock = Clock()
+    clock.advance(now)
+    return clock
+
+
+def voucher_count(operator, denomination, used, count):
+    return {
+        'operator': operator,
+        'denomination': denomination,
+        'used': used,
+        'count': count,
+    }
+
+
+class TestIssuanceStats(TestCase):
+    def stats_for(self, stats, voucher_pool='pool0'):
+        return dict(
+            ((s['operator'], s['denomination']), s)
+            for s in stats.report(voucher_pool)['stats'])
+
+    def test_empty(self):
+        stats = IssuanceStats(mk_clock(), bucket_seconds=10, buckets=6)
+        assert stats.report() == {'window': 60, 'stats': []}
+
+    def test_rates(self):
+        clock = mk_clock()
+        stats = IssuanceStats(clock, bucket_seconds=10, buckets=6)
+        stats.record_vouchers('pool0', 'issued', [
+            {'operator': 'Tank', 'denomination': 'red'},
+            {'operator': 'Tank', 'denomination': 'red'},
+            {'operator': 'Link', 'denomination': 'blue'},
+        ])
+        clock.advance(15)
+        stats.record('pool0', 'Tank', 'red', 'exported', 4)
+        stats.record('pool0', 'Tank', 'red', 'no_voucher')
+        stats.record('pool1', 'Tank', 'red', 'issued')
+        clock.advance(5)
+
+        # We've only been counting for 20 seconds.
+        tank_red = self.stats_for(stats)[('Tank', 'red')]
+        assert tank_red['issued'] == 2
+        assert tank_red['exported'] == 4
+        assert tank_red['issue_rate'] == 0.1
+        assert tank_red['export_rate'] == 0.2
+        assert tank_red['no_voucher_rate'] == 0.05
+        assert self.stats_for(stats)[('Link', 'blue')]['issued'] == 1
+        assert len(stats.report()['stats']) == 3
+
+    def test_old_buckets_expire(self):
+        clock = mk_clock()
+        stats = IssuanceStats(clock, bucket_seconds=10, buckets=6)
+        stats.record('pool0', 'Tank', 'red', 'issued', 6)
+        clock.advance(30)
+        stats.record('pool0', 'Tank', 'red', 'issued', 3)
+        clock.advance(30)
+        tank_red = self.stats_for(stats)[('Tank', 'red')]
+        assert tank_red['issued'] == 9
+        assert tank_red['issue_rate'] == 0.15
+
+        clock.advance(10)
+        tank_red = self.stats_for(stats)[('Tank', 'red')]
+        assert tank_red['issued'] == 3
+        assert tank_red['issue_rate'] == 0.05
+
+    def test_depletion(self):
+        clock = mk_clock()
+        stats = IssuanceStats(clock, bucket_seconds=10, buckets=6)
+        stats.record('pool0', 'Tank', 'red', 'issued', 2)
+        # We don't know how many are left yet.
+        clock.advance(10)
+        assert self.stats_for(stats)[('Tank', 'red')][
+            'depletion_seconds'] is None
+
+        stats.set_available('pool0', [
+            voucher_count('Tank', 'red', False, 22),
+            voucher_count('Tank', 'red', True, 100),
+            voucher_count('Link', 'blue', False, 5),
+        ])
+        stats.record('pool0', 'Tank', 'red', 'issued', 2)
+        stats.record('pool0', 'Tank', 'red', 'imported', 10)
+        clock.advance(10)
+        results = self.stats_for(stats)
+        assert results[('Tank', 'red')]['available'] == 30
+        # 4 vouchers in 20 seconds.
+        assert results[('Tank', 'red')]['depletion_seconds'] == 150
+        # Nothing is being used, so it won't run out.
+        assert results[('Link', 'blue')]['available'] == 5
+        assert results[('Link', 'blue')]['depletion_seconds'] is None
+
+    def test_persistence(self):
+        state_path = temp_path(self)
+        clock = mk_clock()
+        stats = IssuanceStats(
+            clock, bucket_seconds=10, buckets=6, state_path=state_path)
+        stats.startService()
+        stats.set_available('pool0', [voucher_count('Tank', 'red', False, 8)])
+        stats.record('pool0', 'Tank', 'red', 'issued', 2)
+        clock.advance(20)
+        stats.record('pool0', 'Tank', 'red', 'issued', 1)
+        stats.stopService()
+        before = stats.report()
+
+        clock.advance(5)
+        restored = IssuanceStats(
+            clock, bucket_seconds=10, buckets=6, state_path=state_path)
+        restored.startService()
+        # Rates still cover the time since the first bucket we loaded.
+        after = restored.report()
+        assert after['stats'][0]['issued'] == 3
+        assert after['stats'][0]['available'] == 5
+        assert after['stats'][0]['issue_rate'] == 0.12
+        assert before['stats'][0]['issue_rate'] == 0.15
+
+    def test_persistence_drops_old_buckets(self):
+        state_path = temp_path(self)
+        clock = mk_clock()
+        stats = IssuanceStats(
+            clock, bucket_seconds=10, buckets=6, state_path=state_path)
+        stats.record('pool0', 'Tank', 'red', 'issued', 2)
+        stats.save()
+
+        clock.advance(600)
+        restored = IssuanceStats(
+            clock, bucket_seconds=10, buckets=6, state_path=state_path)
+        restored.startService()
+        [result] = restored.report()['stats']
+        assert result['issued'] == 0
+
+    def test_bad_state_file(self):
+        state_path = temp_path(self)
+        with open(state_path, 'w') as f:
+            f.write('not json')
+        stats = IssuanceStats(mk_clock(), state_path=state_path)
+        stats.startService()
+        [err] = self.flushLoggedErrors(ValueError)
+        assert stats.report()['stats'] == []
+
+        # Stopping replaces the bad file.
+        stats.stopService()
+        with open(state_path) as f:
+            assert json.load(f) == []
@@ -0,0 +1,54 @@
+import json
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from airtime_service.log_writer import LogWriter
+
+from .helpers import temp_path
+
+
+class TestLogWriter(TestCase):
+    def setUp(self):
+        self.log_path = temp_path(self)
+
+    def read_entries(self):
+        with open(self.log_path) as f:
+            return [json.loads(line) for line in f]
+
+    @inlineCallbacks
+    def test_write(self):
+        writer = LogWriter(self.log_path)
+        writer.start()
+        writer.write({'n': 0})
+        writer.write({'n': 1})
+        yield writer.stop()
+        assert self.read_entries() == [{'n': 0}, {'n': 1}]
+
+    @inlineCallbacks
+    def test_full_queue_drops_entries(self):
+        # We don't start the writer, so nothing is taken off the queue.
+        writer = LogWriter(self.log_path, max_queued=2)
+        for i in range(5):
+            writer.write({'n': i})
+        assert writer.dropped == 3
+
+        writer.start()
+        yield writer.stop()
+        assert self.read_entries() == [{'n': 0}, {'n': 1}]
+
+    def test_stop_doesnt_block(self):
+        writer = LogWriter(self.log_path)
+        writer.start()
+        thread = writer._thread
+        d = writer.stop()
+        # The writer is stopped in another thread, so we don't wait for it
+        # here.
+        assert not d.called
+        return d.addCallback(lambda _: self.assertFalse(thread.is_alive()))
+
+    def test_thread_name(self):
+        writer = LogWriter(self.log_path, name='test-log')
+        writer.start()
+        self.addCleanup(writer.stop)
+        assert writer._thread.name == 'test-log'
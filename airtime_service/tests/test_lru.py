@@ -0,0 +1,67 @@
+from twisted.trial.unittest import TestCase
+
+from airtime_service.lru import LRUCache
+
+
+class TestLRUCache(TestCase):
+    def test_get_and_put(self):
+        cache = LRUCache(2)
+        assert cache.get('a') is None
+        assert cache.get('a', 'default') == 'default'
+        cache.put('a', 1)
+        assert cache.get('a') == 1
+        assert 'a' in cache
+        assert 'b' not in cache
+
+    def test_put_existing(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('a', 2)
+        assert cache.get('a') == 2
+        assert len(cache) == 1
+
+    def test_iteritems(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        assert sorted(cache.iteritems()) == [('a', 1), ('b', 2)]
+        # Iterating doesn't count as a use.
+        cache.put('c', 3)
+        assert sorted(cache) == ['b', 'c']
+
+    def test_oldest_entries_evicted(self):
+        cache = LRUCache(2)
+        for i, key in enumerate('abc'):
+            cache.put(key, i)
+        assert sorted(cache) == ['b', 'c']
+
+    def test_used_entries_kept(self):
+        cache = LRUCache(2)
+        cache.put('a', 0)
+        cache.put('b', 1)
+        cache.get('a')
+        cache.put('c', 2)
+        assert sorted(cache) == ['a', 'c']
+        # 'a' has had its second chance, so it goes next unless it's used
+        # again.
+        cache.put('d', 3)
+        assert sorted(cache) == ['c', 'd']
+
+    def test_all_entries_used(self):
+        cache = LRUCache(2)
+        cache.put('a', 0)
+        cache.put('b', 1)
+        cache.get('a')
+        cache.get('b')
+        cache.put('c', 2)
+        assert len(cache) == 2
+        assert 'c' in cache
+
+    def test_clear(self):
+        cache = LRUCache(2)
+        cache.put('a', 0)
+        cache.clear()
+        assert len(cache) == 0
+        cache.put('b', 1)
+        cache.put('c', 2)
+        assert sorted(cache) == ['b', 'c']
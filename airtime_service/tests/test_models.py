@@ -1,39 +1,45 @@
 from datetime import datetime, timedelta
 import os
+import sqlite3
 
 from aludel.database import get_engine, MetaData
 from aludel.tests.doubles import FakeReactorThreads
-from twisted.trial.unittest import TestCase
-
+from sqlalchemy import (
+    inspect, Table, Column, Integer, String, DateTime, Boolean, Index,
+)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql import select
+from sqlalchemy.schema import DropTable, DropIndex, CreateTable, CreateIndex
+from twisted.internet.defer import fail
+from twisted.internet.task import Clock
+from twisted.trial.unittest import SkipTest, TestCase
+
+from airtime_service import migrations, models, shared
+from airtime_service.issuance_stats import IssuanceStats
+from airtime_service.lru import LRUCache
+from airtime_service.memory import MemoryEngine, MemoryVoucherPool
 from airtime_service.models import (
     VoucherPool, NoVoucherAvailable, NoVoucherPool, AuditMismatch,
+    IncompleteImport, UnknownExportPage,
 )
+from airtime_service.shared import SharedVoucherPool
 
 from .helpers import populate_pool, mk_audit_params, sorted_dicts, voucher_dict
 
 
-class TestVoucherPool(TestCase):
-    timeout = 5
+class VoucherPoolTestsMixin(object):
+    """
+    Tests for behaviour that all VoucherPool implementations share.
 
-    def setUp(self):
-        connection_string = os.environ.get(
-            "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
-        self._using_mysql = connection_string.startswith('mysql')
-        self.engine = get_engine(
-            connection_string, reactor=FakeReactorThreads())
-        self._drop_tables()
-        self.conn = self.successResultOf(self.engine.connect())
+    Subclasses must set ``pool_class`` and connect ``self.conn`` in
+    ``setUp()``.
+    """
 
-    def tearDown(self):
-        self.successResultOf(self.conn.close())
-        self._drop_tables()
-        assert self.successResultOf(self.engine.table_names()) == []
+    timeout = 5
+    _using_mysql = False
 
-    def _drop_tables(self):
-        # NOTE: This is a blocking operation!
-        md = MetaData(bind=self.engine._engine)
-        md.reflect()
-        md.drop_all()
+    def mk_pool(self, name):
+        return self.pool_class(name, self.conn)
 
     def before(self):
         """
@@ -58,7 +64,7 @@ class TestVoucherPool(TestCase):
         assert sorted(tuple(r) for r in rows) == sorted(expected_rows)
 
     def test_import_fails_for_missing_pool(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         f = self.failureResultOf(pool.count_vouchers(), NoVoucherPool)
         assert f.value.args == ('testpool',)
         f = self.failureResultOf(
@@ -66,13 +72,13 @@ class TestVoucherPool(TestCase):
         assert f.value.args == ('testpool',)
 
     def test_exists(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         assert not self.successResultOf(pool.exists())
         self.successResultOf(pool.create_tables())
         assert self.successResultOf(pool.exists())
 
     def test_import_vouchers(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         self.successResultOf(pool.create_tables())
 
         self.successResultOf(pool.import_vouchers('req-0', 'md5-0', [
@@ -93,7 +99,7 @@ class TestVoucherPool(TestCase):
         ])
 
     def test_import_vouchers_idempotence(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         self.successResultOf(pool.create_tables())
 
         vouchers = [
@@ -127,8 +133,125 @@ class TestVoucherPool(TestCase):
             AuditMismatch)
         self.assert_voucher_counts(pool, expected_vouchers)
 
+    def test_import_vouchers_updates_catalog(self):
+        pool = self.mk_pool('testpool')
+        self.successResultOf(pool.create_tables())
+        assert self.successResultOf(pool.list_catalog()) == []
+
+        populate_pool(pool, ['Tank'], ['red', 'blue'], [0, 1])
+        assert self.successResultOf(pool.list_catalog()) == [
+            ('Tank', 'blue'), ('Tank', 'red')]
+
+        # Pairs we already know about aren't added again.
+        populate_pool(pool, ['Tank', 'Link'], ['red'], [2])
+        assert self.successResultOf(pool.list_catalog()) == [
+            ('Link', 'red'), ('Tank', 'blue'), ('Tank', 'red')]
+
+    def mk_vouchers(self, count, prefix='T'):
+        return [{
+            'operator': 'Tank',
+            'denomination': ['red', 'blue'][i % 2],
+            'voucher': '%s%s' % (prefix, i),
+        } for i in range(count)]
+
+    def stage_chunks(self, pool, request_id, content_md5, vouchers,
+                     chunk_size):
+        return [self.successResultOf(pool.stage_import_chunk(
+            request_id, content_md5, chunk_size, chunk,
+            vouchers[i:i + chunk_size]))
+            for chunk, i in enumerate(range(0, len(vouchers), chunk_size))]
+
+    def test_chunked_import(self):
+        pool = self.mk_pool('testpool')
+        self.successResultOf(pool.create_tables())
+        vouchers = self.mk_vouchers(5)
+
+        assert not self.successResultOf(
+            pool.prepare_import('req-0', 'md5-0', 2, vouchers))
+        assert self.stage_chunks(pool, 'req-0', 'md5-0', vouchers, 2) == [
+            True, True, True]
+        # Chunks that are already staged aren't staged again.
+        assert not self.successResultOf(pool.stage_import_chunk(
+            'req-0', 'md5-0', 2, 1, vouchers[2:4]))
+        # Nothing is in the pool until the import is finished.
+        self.assert_voucher_counts(pool, [])
+
+        self.successResultOf(pool.finish_import('req-0', 'md5-0', 3, vouchers))
+        expected_counts = [
+            ('Tank', 'blue', False, 2),
+            ('Tank', 'red', False, 3),
+        ]
+        self.assert_voucher_counts(pool, expected_counts)
+        assert self.successResultOf(pool.list_catalog()) == [
+            ('Tank', 'blue'), ('Tank', 'red')]
+        voucher = self.successResultOf(
+            pool.issue_voucher('Tank', 'blue', mk_audit_params('req-1')))
+        assert voucher['voucher'] in ['T1', 'T3']
+
+        # The import has been done now.
+        assert self.successResultOf(
+            pool.prepare_import('req-0', 'md5-0', 2, vouchers))
+        self.failureResultOf(
+            pool.prepare_import('req-0', 'md5-1', 2, vouchers), AuditMismatch)
+        self.successResultOf(pool.finish_import('req-0', 'md5-0', 3, vouchers))
+        self.assert_voucher_counts(pool, [
+            ('Tank', 'blue', False, 1),
+            ('Tank', 'blue', True, 1),
+            ('Tank', 'red', False, 3),
+        ])
+        # A chunked import and a normal one are the same import.
+        self.successResultOf(pool.import_vouchers('req-0', 'md5-0', vouchers))
+        self.failureResultOf(
+            pool.import_vouchers('req-0', 'md5-1', vouchers), AuditMismatch)
+
+    def test_chunked_import_incomplete(self):
+        pool = self.mk_pool('testpool')
+        self.successResultOf(pool.create_tables())
+        vouchers = self.mk_vouchers(4)
+
+        self.successResultOf(
+            pool.prepare_import('req-0', 'md5-0', 2, vouchers))
+        self.successResultOf(pool.stage_import_chunk(
+            'req-0', 'md5-0', 2, 0, vouchers[:2]))
+        self.failureResultOf(
+            pool.finish_import('req-0', 'md5-0', 2, vouchers),
+            IncompleteImport)
+        self.assert_voucher_counts(pool, [])
+
+        # Retrying the import only stages what's missing.
+        self.successResultOf(
+            pool.prepare_import('req-0', 'md5-0', 2, vouchers))
+        assert self.stage_chunks(pool, 'req-0', 'md5-0', vouchers, 2) == [
+            False, True]
+        self.successResultOf(pool.finish_import('req-0', 'md5-0', 2, vouchers))
+        self.assert_voucher_counts(pool, [
+            ('Tank', 'blue', False, 2),
+            ('Tank', 'red', False, 2),
+        ])
+
+    def test_chunked_import_restaged_for_new_content(self):
+        pool = self.mk_pool('testpool')
+        self.successResultOf(pool.create_tables())
+        old_vouchers = self.mk_vouchers(4, 'old')
+        vouchers = self.mk_vouchers(3)
+
+        self.successResultOf(
+            pool.prepare_import('req-0', 'md5-0', 2, old_vouchers))
+        self.stage_chunks(pool, 'req-0', 'md5-0', old_vouchers[:2], 2)
+
+        # Chunks staged for other content are thrown away.
+        self.successResultOf(
+            pool.prepare_import('req-0', 'md5-1', 2, vouchers))
+        assert self.stage_chunks(pool, 'req-0', 'md5-1', vouchers, 2) == [
+            True, True]
+        self.successResultOf(pool.finish_import('req-0', 'md5-1', 2, vouchers))
+        self.assert_voucher_counts(pool, [
+            ('Tank', 'blue', False, 1),
+            ('Tank', 'red', False, 2),
+        ])
+
     def test_issue_voucher(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         self.successResultOf(pool.create_tables())
         populate_pool(pool, ['Tank'], ['red'], [0])
         self.assert_voucher_counts(pool, [('Tank', 'red', False, 1)])
@@ -141,7 +264,7 @@ class TestVoucherPool(TestCase):
         self.assert_voucher_counts(pool, [('Tank', 'red', True, 1)])
 
     def test_issue_voucher_not_available(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         self.successResultOf(pool.create_tables())
         self.assert_voucher_counts(pool, [])
         self.failureResultOf(
@@ -149,7 +272,7 @@ class TestVoucherPool(TestCase):
             NoVoucherAvailable)
 
     def test_issue_voucher_idempotent(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         self.successResultOf(pool.create_tables())
         populate_pool(pool, ['Tank'], ['red'], [0])
         self.assert_voucher_counts(pool, [('Tank', 'red', False, 1)])
@@ -178,7 +301,7 @@ class TestVoucherPool(TestCase):
             pool.issue_voucher('Tank', 'red', audit_params_2), AuditMismatch)
 
     def test_issue_voucher_idempotent_not_available(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         self.successResultOf(pool.create_tables())
         self.assert_voucher_counts(pool, [])
 
@@ -199,7 +322,7 @@ class TestVoucherPool(TestCase):
         self.assert_voucher_counts(pool, [('Tank', 'red', False, 1)])
 
     def test_query_by_request_id(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         self.successResultOf(pool.create_tables())
 
         audit_params = mk_audit_params('req-0')
@@ -228,7 +351,7 @@ class TestVoucherPool(TestCase):
         }]
 
     def test_query_by_transaction_id(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         self.successResultOf(pool.create_tables())
 
         audit_params_0 = mk_audit_params('req-0', 'transaction-0')
@@ -271,7 +394,7 @@ class TestVoucherPool(TestCase):
         }]
 
     def test_query_by_user_id(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         self.successResultOf(pool.create_tables())
 
         audit_params_0 = mk_audit_params('req-0', 'transaction-0', 'user-0')
@@ -311,8 +434,66 @@ class TestVoucherPool(TestCase):
             'created_at': created_1,
         }]
 
+    def test_audit_version(self):
+        pool = self.mk_pool('testpool')
+        self.successResultOf(pool.create_tables())
+
+        assert self.successResultOf(
+            pool.audit_version('user_id', 'user-0')) == (0, 0)
+
+        self.successResultOf(pool._audit_request(
+            mk_audit_params('req-0', 'transaction-0', 'user-0'), 'a', 'b'))
+        version_0 = self.successResultOf(
+            pool.audit_version('user_id', 'user-0'))
+        assert version_0[0] == 1
+        assert self.successResultOf(
+            pool.audit_version('request_id', 'req-0')) == version_0
+
+        self.successResultOf(pool._audit_request(
+            mk_audit_params('req-1', 'transaction-1', 'user-1'), 'a', 'b'))
+        assert self.successResultOf(
+            pool.audit_version('user_id', 'user-0')) == version_0
+
+        self.successResultOf(pool._audit_request(
+            mk_audit_params('req-2', 'transaction-0', 'user-0'), 'a', 'b'))
+        count, latest_id = self.successResultOf(
+            pool.audit_version('user_id', 'user-0'))
+        assert count == 2
+        assert latest_id > version_0[1]
+        assert self.successResultOf(
+            pool.audit_version('transaction_id', 'transaction-0')) == (
+                count, latest_id)
+
+    def test_issuance_stats(self):
+        pool = self.mk_pool('testpool')
+        pool.issuance_stats = IssuanceStats(Clock())
+        self.successResultOf(pool.create_tables())
+        self.successResultOf(
+            populate_pool(pool, ['Tank', 'Link'], ['red'], [0, 1, 2]))
+
+        audit_params = mk_audit_params('req-0')
+        self.successResultOf(pool.issue_voucher('Tank', 'red', audit_params))
+        # Replayed requests aren't counted again.
+        self.successResultOf(pool.issue_voucher('Tank', 'red', audit_params))
+        self.successResultOf(
+            pool.export_vouchers('req-1', 2, ['Tank'], ['red']))
+        self.failureResultOf(pool.issue_voucher(
+            'Tank', 'red', mk_audit_params('req-2')), NoVoucherAvailable)
+        self.successResultOf(
+            pool.export_vouchers('req-1', 2, ['Tank'], ['red']))
+
+        stats = dict(
+            ((s['operator'], s['denomination']), s)
+            for s in pool.issuance_stats.report('testpool')['stats'])
+        assert stats[('Tank', 'red')]['imported'] == 3
+        assert stats[('Tank', 'red')]['issued'] == 1
+        assert stats[('Tank', 'red')]['exported'] == 2
+        assert stats[('Tank', 'red')]['no_voucher'] == 1
+        assert stats[('Link', 'red')]['imported'] == 3
+        assert stats[('Link', 'red')]['issued'] == 0
+
     def test_export_all_vouchers(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         self.successResultOf(pool.create_tables())
         populate_pool(pool, ['Tank', 'Link'], ['red', 'blue'], [0, 1])
         self.assert_voucher_counts(pool, [
@@ -344,7 +525,7 @@ class TestVoucherPool(TestCase):
         ])
 
     def test_export_some_vouchers(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         self.successResultOf(pool.create_tables())
         # We give all vouchers of the same type the same voucher code to avoid
         # having to check all the permutations.
@@ -394,7 +575,7 @@ class TestVoucherPool(TestCase):
         ])
 
     def test_export_too_many_vouchers(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         self.successResultOf(pool.create_tables())
         # We give all vouchers of the same type the same voucher code to avoid
         # having to check all the permutations.
@@ -452,8 +633,45 @@ class TestVoucherPool(TestCase):
             voucher_dict('Link', 'blue', 'Link-blue-0'),
         ])
 
+    def test_export_only_existing_voucher_types(self):
+        pool = self.mk_pool('testpool')
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0])
+        populate_pool(pool, ['Link'], ['blue'], [0])
+
+        # Pairs that were never imported aren't visited, so there are no
+        # warnings about them.
+        response = self.successResultOf(
+            pool.export_vouchers('req-0', 1, None, None))
+        assert response['warnings'] == []
+        assert sorted_dicts(response['vouchers']) == sorted_dicts([
+            voucher_dict('Tank', 'red', 'Tank-red-0'),
+            voucher_dict('Link', 'blue', 'Link-blue-0'),
+        ])
+
+    def test_export_filters_catalog(self):
+        pool = self.mk_pool('testpool')
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank', 'Link'], ['red', 'blue'], [0])
+
+        response = self.successResultOf(
+            pool.export_vouchers('req-0', 1, ['Tank'], None))
+        assert sorted_dicts(response['vouchers']) == sorted_dicts([
+            voucher_dict('Tank', 'red', 'Tank-red-0'),
+            voucher_dict('Tank', 'blue', 'Tank-blue-0'),
+        ])
+
+        response = self.successResultOf(
+            pool.export_vouchers('req-1', 1, None, ['red']))
+        assert response['warnings'] == [
+            "Insufficient vouchers available for 'Tank' 'red'.",
+        ]
+        assert sorted_dicts(response['vouchers']) == sorted_dicts([
+            voucher_dict('Link', 'red', 'Link-red-0'),
+        ])
+
     def test_export_idempotent(self):
-        pool = VoucherPool('testpool', self.conn)
+        pool = self.mk_pool('testpool')
         self.successResultOf(pool.create_tables())
         # We give all vouchers of the same type the same voucher code to avoid
         # having to check all the permutations.
@@ -504,3 +722,1000 @@ class TestVoucherPool(TestCase):
             ('Tank', 'red', False, 2),
             ('Tank', 'red', True, 1),
         ])
+
+    def test_export_in_pages(self):
+        pool = self.mk_pool('testpool')
+        self.successResultOf(pool.create_tables())
+        # We give all vouchers of the same type the same voucher code to avoid
+        # having to check all the permutations.
+        populate_pool(pool, ['Tank', 'Link'], ['red', 'blue'], [0, 0, 0])
+
+        # Voucher types are exported in catalog order, and a page can span
+        # several of them.
+        page0 = self.successResultOf(
+            pool.export_page('req-0', 2, None, None, 3, 0))
+        assert page0['warnings'] == []
+        assert page0['next_page'] == 1
+        assert sorted_dicts(page0['vouchers']) == sorted_dicts([
+            voucher_dict('Link', 'blue', 'Link-blue-0'),
+            voucher_dict('Link', 'blue', 'Link-blue-0'),
+            voucher_dict('Link', 'red', 'Link-red-0'),
+        ])
+        self.assert_voucher_counts(pool, [
+            ('Link', 'blue', False, 1),
+            ('Link', 'red', False, 2),
+            ('Tank', 'blue', False, 3),
+            ('Tank', 'red', False, 3),
+            ('Link', 'blue', True, 2),
+            ('Link', 'red', True, 1),
+        ])
+
+        page1 = self.successResultOf(
+            pool.export_page('req-0', 2, None, None, 3, 1))
+        assert page1['next_page'] == 2
+        assert sorted_dicts(page1['vouchers']) == sorted_dicts([
+            voucher_dict('Link', 'red', 'Link-red-0'),
+            voucher_dict('Tank', 'blue', 'Tank-blue-0'),
+            voucher_dict('Tank', 'blue', 'Tank-blue-0'),
+        ])
+
+        page2 = self.successResultOf(
+            pool.export_page('req-0', 2, None, None, 3, 2))
+        assert page2['next_page'] is None
+        assert sorted_dicts(page2['vouchers']) == sorted_dicts([
+            voucher_dict('Tank', 'red', 'Tank-red-0'),
+            voucher_dict('Tank', 'red', 'Tank-red-0'),
+        ])
+        self.assert_voucher_counts(pool, [
+            ('Link', 'blue', False, 1),
+            ('Link', 'red', False, 1),
+            ('Tank', 'blue', False, 1),
+            ('Tank', 'red', False, 1),
+            ('Link', 'blue', True, 2),
+            ('Link', 'red', True, 2),
+            ('Tank', 'blue', True, 2),
+            ('Tank', 'red', True, 2),
+        ])
+
+    def test_export_page_replayed(self):
+        pool = self.mk_pool('testpool')
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0, 1, 2, 3])
+
+        page0 = self.successResultOf(
+            pool.export_page('req-0', None, ['Tank'], ['red'], 2, 0))
+        page1 = self.successResultOf(
+            pool.export_page('req-0', None, ['Tank'], ['red'], 2, 1))
+        assert len(page0['vouchers']) == 2
+        assert len(page1['vouchers']) == 2
+        self.assert_voucher_counts(pool, [('Tank', 'red', True, 4)])
+
+        # Replaying any page gets the same vouchers, and claims no more.
+        for page, response in [(0, page0), (1, page1)]:
+            replayed = self.successResultOf(
+                pool.export_page('req-0', None, ['Tank'], ['red'], 2, page))
+            assert sorted_dicts(replayed['vouchers']) == sorted_dicts(
+                response['vouchers'])
+            assert replayed['next_page'] == response['next_page']
+
+        # We can't tell that there's nothing left until we look.
+        page2 = self.successResultOf(
+            pool.export_page('req-0', None, ['Tank'], ['red'], 2, 2))
+        assert page2 == {'vouchers': [], 'warnings': [], 'next_page': None}
+        self.assert_voucher_counts(pool, [('Tank', 'red', True, 4)])
+
+    def test_export_page_warnings(self):
+        pool = self.mk_pool('testpool')
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0, 0, 0])
+
+        page0 = self.successResultOf(
+            pool.export_page('req-0', 4, ['Tank'], ['red'], 2, 0))
+        assert page0['warnings'] == []
+        page1 = self.successResultOf(
+            pool.export_page('req-0', 4, ['Tank'], ['red'], 2, 1))
+        assert page1 == {
+            'vouchers': [voucher_dict('Tank', 'red', 'Tank-red-0')],
+            'warnings': ["Insufficient vouchers available for 'Tank' 'red'."],
+            'next_page': None,
+        }
+
+    def test_export_page_unknown(self):
+        pool = self.mk_pool('testpool')
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0, 1, 2])
+
+        # Pages can't be skipped, or fetched after the last one.
+        self.failureResultOf(
+            pool.export_page('req-0', 3, ['Tank'], ['red'], 2, 1),
+            UnknownExportPage)
+        self.successResultOf(
+            pool.export_page('req-0', 3, ['Tank'], ['red'], 2, 0))
+        self.failureResultOf(
+            pool.export_page('req-0', 3, ['Tank'], ['red'], 2, 2),
+            UnknownExportPage)
+        self.successResultOf(
+            pool.export_page('req-0', 3, ['Tank'], ['red'], 2, 1))
+        self.failureResultOf(
+            pool.export_page('req-0', 3, ['Tank'], ['red'], 2, 2),
+            UnknownExportPage)
+        self.assert_voucher_counts(pool, [('Tank', 'red', True, 3)])
+
+    def test_export_page_mismatch(self):
+        pool = self.mk_pool('testpool')
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0, 1, 2])
+
+        self.successResultOf(
+            pool.export_page('req-0', 3, ['Tank'], ['red'], 2, 0))
+        self.failureResultOf(
+            pool.export_page('req-0', 3, ['Tank'], ['red'], 1, 1),
+            AuditMismatch)
+        self.failureResultOf(
+            pool.export_vouchers('req-0', 3, ['Tank'], ['red']),
+            AuditMismatch)
+        self.successResultOf(
+            pool.export_vouchers('req-1', 3, ['Tank'], ['red']))
+        self.failureResultOf(
+            pool.export_page('req-1', 3, ['Tank'], ['red'], 2, 0),
+            AuditMismatch)
+        self.assert_voucher_counts(pool, [('Tank', 'red', True, 3)])
+
+
+class DatabaseTestsMixin(object):
+    """
+    Connects ``self.conn`` to a test database and cleans up afterwards.
+    """
+
+    def setUp(self):
+        connection_string = os.environ.get(
+            "ALUDEL_TEST_CONNECTION_STRING", "sqlite://")
+        self._using_mysql = connection_string.startswith('mysql')
+        self.engine = get_engine(
+            connection_string, reactor=FakeReactorThreads())
+        self._drop_tables()
+        self.conn = self.successResultOf(self.engine.connect())
+
+    def tearDown(self):
+        self.successResultOf(self.conn.close())
+        self._drop_tables()
+        assert self.successResultOf(self.engine.table_names()) == []
+
+    def _drop_tables(self):
+        # NOTE: This is a blocking operation!
+        md = MetaData(bind=self.engine._engine)
+        md.reflect()
+        md.drop_all()
+
+    def get_column_names(self, table):
+        # NOTE: This is a blocking operation!
+        columns = inspect(self.engine._engine).get_columns(table.name)
+        return [column['name'] for column in columns]
+
+    def get_index_names(self, table):
+        # NOTE: This is a blocking operation!
+        indexes = inspect(self.engine._engine).get_indexes(table.name)
+        return sorted(index['name'] for index in indexes)
+
+
+class TestVoucherPool(DatabaseTestsMixin, VoucherPoolTestsMixin, TestCase):
+    pool_class = VoucherPool
+
+    def test_create_tables_creates_indexes(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        assert self.get_index_names(pool.audit) == [
+            'ix_VoucherPool_testpool_audit_request_id',
+            'ix_VoucherPool_testpool_audit_transaction_id',
+            'ix_VoucherPool_testpool_audit_user_created',
+        ]
+        assert self.get_index_names(pool.vouchers) == [
+            'ix_VoucherPool_testpool_vouchers_unused',
+            'ix_VoucherPool_testpool_vouchers_voucher',
+        ]
+        [request_id_index] = [
+            index for index in inspect(self.engine._engine).get_indexes(
+                pool.audit.name)
+            if index['column_names'] == ['request_id']]
+        assert request_id_index['unique']
+
+    def replace_with_legacy_table(self, table, rows):
+        """
+        Replace a vouchers table with one that stores operator and
+        denomination names, like older versions did.
+        """
+        self.successResultOf(self.conn.execute(DropTable(table)))
+        legacy = Table(
+            table.name, MetaData(),
+            Column("id", Integer(), primary_key=True),
+            Column("operator", String(255), nullable=False, index=True),
+            Column("denomination", String(255), nullable=False, index=True),
+            Column("voucher", String(255), nullable=False, index=True),
+            Column("used", Boolean(), default=False, index=True),
+            Column("created_at", DateTime(timezone=False)),
+            Column("modified_at", DateTime(timezone=False)),
+            Column("reason", String(255), default=None),
+        )
+        self.successResultOf(self.conn.execute(CreateTable(legacy)))
+        for index in legacy.indexes:
+            self.successResultOf(self.conn.execute(CreateIndex(index)))
+        self.successResultOf(self.conn.execute(legacy.insert(), rows))
+
+    def forget_schema_version(self):
+        """
+        Pretend the pool's tables were created before schema versions were
+        recorded.
+        """
+        self.successResultOf(
+            self.conn.execute(migrations.schema_versions.delete()))
+
+    def test_upgrade_tables(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.forget_schema_version()
+        # Pretend this pool was created before the catalog existed.
+        self.successResultOf(self.conn.execute(DropTable(pool.catalog)))
+        [index] = [i for i in pool.audit.indexes
+                   if i.name.endswith('request_id')]
+        self.successResultOf(self.conn.execute(DropIndex(index)))
+        # Or the operator and denomination dimension tables.
+        self.successResultOf(self.conn.execute(DropTable(pool.operators)))
+        self.successResultOf(self.conn.execute(DropTable(pool.denominations)))
+        self.replace_with_legacy_table(pool.vouchers_used, [
+            {'id': 1, 'operator': 'Tank', 'denomination': 'red',
+             'voucher': 'Tr0', 'used': True},
+        ])
+        self.replace_with_legacy_table(pool.vouchers, [
+            {'id': 2, 'operator': 'Tank', 'denomination': 'red',
+             'voucher': 'Tr1', 'used': False},
+            {'id': 3, 'operator': 'Link', 'denomination': 'blue',
+             'voucher': 'Lb0', 'used': False},
+            {'id': 4, 'operator': 'Tank', 'denomination': 'red',
+             'voucher': 'Tr2', 'used': True},
+        ])
+
+        self.successResultOf(pool.upgrade_tables())
+        assert self.successResultOf(pool.list_catalog()) == [
+            ('Link', 'blue'), ('Tank', 'red')]
+        assert 'ix_VoucherPool_testpool_audit_request_id' in (
+            self.get_index_names(pool.audit))
+        assert self.get_index_names(pool.vouchers) == [
+            'ix_VoucherPool_testpool_vouchers_unused',
+            'ix_VoucherPool_testpool_vouchers_voucher',
+        ]
+        assert 'operator_id' in self.get_column_names(pool.vouchers_used)
+        self.assert_voucher_counts(pool, [
+            ('Link', 'blue', False, 1),
+            ('Tank', 'red', False, 1),
+            ('Tank', 'red', True, 2),
+        ])
+
+        # Upgrading again changes nothing.
+        self.successResultOf(pool.upgrade_tables())
+        assert self.successResultOf(pool.list_catalog()) == [
+            ('Link', 'blue'), ('Tank', 'red')]
+        self.assert_voucher_counts(pool, [
+            ('Link', 'blue', False, 1),
+            ('Tank', 'red', False, 1),
+            ('Tank', 'red', True, 2),
+        ])
+
+        # The migrated vouchers can be issued, and new ones don't reuse ids.
+        voucher = self.successResultOf(
+            pool.issue_voucher('Tank', 'red', mk_audit_params('req-0')))
+        assert voucher['id'] == 2
+        assert voucher['voucher'] == 'Tr1'
+        populate_pool(pool, ['Tank'], ['red'], [3])
+        rows = self.successResultOf(pool.execute_fetchall(
+            select([pool.vouchers.c.id])))
+        assert sorted(r['id'] for r in rows) == [2, 3, 4, 5]
+
+    def test_create_tables_records_schema_version(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        assert self.successResultOf(
+            migrations.get_schema_version(pool)) == migrations.SCHEMA_VERSION
+        assert self.successResultOf(pool.upgrade_tables()) == []
+
+    def test_upgrade_tables_applies_pending_migrations(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.forget_schema_version()
+        assert self.successResultOf(
+            migrations.get_schema_version(pool)) == 0
+        assert self.successResultOf(pool.upgrade_tables()) == [
+            version for version, _ in migrations.MIGRATIONS]
+        assert self.successResultOf(
+            migrations.get_schema_version(pool)) == migrations.SCHEMA_VERSION
+
+    def test_check_schema_version(self):
+        pool = VoucherPool('testpool', self.conn)
+        # Pools that don't exist yet will be created at the current version.
+        self.successResultOf(pool.check_schema_version())
+        self.successResultOf(pool.create_tables())
+        self.successResultOf(pool.check_schema_version())
+
+        self.forget_schema_version()
+        self.failureResultOf(
+            pool.check_schema_version(), migrations.SchemaOutOfDate)
+        self.successResultOf(pool.upgrade_tables())
+        self.successResultOf(pool.check_schema_version())
+
+    def test_upgrade_tables_online(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.forget_schema_version()
+        # Pools that already use dimension ids don't need to be idle.
+        assert self.successResultOf(pool.upgrade_tables(online=True)) == [
+            version for version, _ in migrations.MIGRATIONS]
+
+    def test_upgrade_tables_online_refuses_legacy_rebuild(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.forget_schema_version()
+        self.replace_with_legacy_table(pool.vouchers, [
+            {'id': 1, 'operator': 'Tank', 'denomination': 'red',
+             'voucher': 'Tr0', 'used': False},
+        ])
+        self.failureResultOf(
+            pool.upgrade_tables(online=True),
+            migrations.OfflineMigrationRequired)
+        # Nothing was renamed, and the migrations before the rebuild were
+        # still applied.
+        assert 'operator' in self.get_column_names(pool.vouchers)
+        assert self.successResultOf(
+            migrations.get_schema_version(pool)) == 1
+
+        self.successResultOf(pool.upgrade_tables())
+        assert 'operator_id' in self.get_column_names(pool.vouchers)
+        self.assert_voucher_counts(pool, [('Tank', 'red', False, 1)])
+
+    def add_dimension_ids(self, pool, batch_size):
+        if (self.engine._engine.dialect.name == 'sqlite' and
+                sqlite3.sqlite_version_info < (3, 35, 0)):
+            raise SkipTest("SQLite can't drop columns before 3.35.")
+        for table in [pool.vouchers, pool.vouchers_used]:
+            self.successResultOf(
+                migrations._add_dimension_ids(pool, table, batch_size))
+
+    def test_add_dimension_ids(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.replace_with_legacy_table(pool.vouchers_used, [
+            {'id': 1, 'operator': 'Tank', 'denomination': 'red',
+             'voucher': 'Tr0', 'used': True},
+        ])
+        self.replace_with_legacy_table(pool.vouchers, [
+            {'id': 2, 'operator': 'Tank', 'denomination': 'red',
+             'voucher': 'Tr1', 'used': False},
+            {'id': 3, 'operator': 'Link', 'denomination': 'blue',
+             'voucher': 'Lb0', 'used': False},
+            {'id': 4, 'operator': 'Tank', 'denomination': 'red',
+             'voucher': 'Tr2', 'used': True},
+        ])
+
+        self.add_dimension_ids(pool, 2)
+        for table in [pool.vouchers, pool.vouchers_used]:
+            assert self.get_column_names(table) == [
+                'id', 'voucher', 'used', 'created_at', 'modified_at',
+                'reason', 'operator_id', 'denomination_id']
+        assert self.get_index_names(pool.vouchers) == [
+            'ix_VoucherPool_testpool_vouchers_voucher']
+        self.assert_voucher_counts(pool, [
+            ('Link', 'blue', False, 1),
+            ('Tank', 'red', False, 1),
+            ('Tank', 'red', True, 2),
+        ])
+
+        # Doing it again changes nothing.
+        self.add_dimension_ids(pool, 2)
+        self.assert_voucher_counts(pool, [
+            ('Link', 'blue', False, 1),
+            ('Tank', 'red', False, 1),
+            ('Tank', 'red', True, 2),
+        ])
+
+        voucher = self.successResultOf(
+            pool.issue_voucher('Tank', 'red', mk_audit_params('req-0')))
+        assert voucher['voucher'] == 'Tr1'
+
+    def test_add_dimension_ids_resumes(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.replace_with_legacy_table(pool.vouchers, [
+            {'id': 1, 'operator': 'Tank', 'denomination': 'red',
+             'voucher': 'Tr0', 'used': False},
+            {'id': 2, 'operator': 'Link', 'denomination': 'blue',
+             'voucher': 'Lb0', 'used': False},
+        ])
+        # Pretend we were interrupted after the first batch.
+        for column in ['operator_id', 'denomination_id']:
+            self.successResultOf(self.conn.execute(
+                'ALTER TABLE %s ADD COLUMN %s INTEGER' % (
+                    migrations._quote(pool, pool.vouchers.name), column)))
+        [operator_id] = self.successResultOf(
+            pool._get_dimension_ids(pool.operators, ['Tank'])).values()
+        [denomination_id] = self.successResultOf(
+            pool._get_dimension_ids(pool.denominations, ['red'])).values()
+        vouchers = migrations._named_vouchers(pool.vouchers)
+        self.successResultOf(self.conn.execute(vouchers.update().where(
+            vouchers.c.id == 1).values(
+                operator_id=operator_id, denomination_id=denomination_id)))
+
+        self.add_dimension_ids(pool, 1)
+        assert 'operator' not in self.get_column_names(pool.vouchers)
+        self.assert_voucher_counts(pool, [
+            ('Link', 'blue', False, 1),
+            ('Tank', 'red', False, 1),
+        ])
+
+    def test_upgrade_tables_in_batches(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.forget_schema_version()
+        self.replace_with_legacy_table(pool.vouchers, [
+            {'id': i, 'operator': 'Tank', 'denomination': 'red',
+             'voucher': 'Tr%s' % (i,), 'used': False}
+            for i in range(1, 6)])
+
+        self.successResultOf(pool.upgrade_tables(batch_size=2))
+        self.assert_voucher_counts(pool, [('Tank', 'red', False, 5)])
+        assert 'VoucherPool_testpool_vouchers_legacy' not in (
+            self.successResultOf(self.engine.table_names()))
+
+    def test_fill_catalog_in_batches(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank', 'Link'], ['red', 'blue'], [0, 1])
+        self.successResultOf(self.conn.execute(pool.catalog.delete()))
+
+        fill_catalog_batch = migrations._fill_catalog_batch
+        batches = []
+
+        def record_batch(pool, last_id, batch_size):
+            batches.append(last_id)
+            return fill_catalog_batch(pool, last_id, batch_size)
+
+        self.patch(migrations, '_fill_catalog_batch', record_batch)
+        self.successResultOf(migrations.fill_catalog(pool, 3))
+        assert batches == [0, 3, 6]
+        assert self.successResultOf(pool.list_catalog()) == [
+            ('Link', 'blue'), ('Link', 'red'),
+            ('Tank', 'blue'), ('Tank', 'red')]
+
+    def test_upgrade_tables_resumes_interrupted_rebuild(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.forget_schema_version()
+        self.replace_with_legacy_table(pool.vouchers, [
+            {'id': i, 'operator': 'Tank', 'denomination': 'red',
+             'voucher': 'Tr%s' % (i,), 'used': False}
+            for i in range(1, 6)])
+
+        copy_legacy_batch = migrations._copy_legacy_batch
+        batches = []
+
+        def interrupted_copy(*args):
+            batches.append(args)
+            if len(batches) > 1:
+                return fail(Exception("Interrupted."))
+            return copy_legacy_batch(*args)
+
+        self.patch(migrations, '_copy_legacy_batch', interrupted_copy)
+        self.failureResultOf(pool.upgrade_tables(batch_size=2), Exception)
+        assert self.successResultOf(
+            migrations.get_schema_version(pool)) == 1
+        self.assert_voucher_counts(pool, [('Tank', 'red', False, 2)])
+
+        self.patch(migrations, '_copy_legacy_batch', copy_legacy_batch)
+        self.successResultOf(pool.upgrade_tables(batch_size=2))
+        self.assert_voucher_counts(pool, [('Tank', 'red', False, 5)])
+        rows = self.successResultOf(pool.execute_fetchall(
+            select([pool.vouchers.c.id])))
+        assert sorted(r['id'] for r in rows) == [1, 2, 3, 4, 5]
+
+    def test_upgrade_tables_replaces_obsolete_indexes(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        for index in list(pool.vouchers.indexes) + list(pool.audit.indexes):
+            if index.name.endswith(('unused', 'user_created')):
+                self.successResultOf(self.conn.execute(DropIndex(index)))
+        self.successResultOf(self.conn.execute(CreateIndex(Index(
+            'ix_VoucherPool_testpool_vouchers_stock',
+            pool.vouchers.c.operator_id, pool.vouchers.c.denomination_id,
+            pool.vouchers.c.used, pool.vouchers.c.id))))
+        self.successResultOf(self.conn.execute(CreateIndex(Index(
+            'ix_VoucherPool_testpool_audit_user_id', pool.audit.c.user_id))))
+        self.successResultOf(migrations.set_schema_version(pool, 3))
+
+        assert self.successResultOf(pool.upgrade_tables()) == [4, 5, 6]
+        assert self.get_index_names(pool.vouchers) == [
+            'ix_VoucherPool_testpool_vouchers_unused',
+            'ix_VoucherPool_testpool_vouchers_voucher',
+        ]
+        assert self.get_index_names(pool.audit) == [
+            'ix_VoucherPool_testpool_audit_request_id',
+            'ix_VoucherPool_testpool_audit_transaction_id',
+            'ix_VoucherPool_testpool_audit_user_created',
+        ]
+
+    def test_upgrade_tables_creates_import_staging(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.successResultOf(self.conn.execute(DropTable(pool.import_chunks)))
+        self.successResultOf(
+            self.conn.execute(DropTable(pool.staged_vouchers)))
+        self.successResultOf(migrations.set_schema_version(pool, 4))
+
+        assert self.successResultOf(pool.upgrade_tables()) == [5, 6]
+        assert self.get_index_names(pool.staged_vouchers) == [
+            'ix_VoucherPool_testpool_staged_vouchers_request_id',
+        ]
+        vouchers = self.mk_vouchers(2)
+        self.successResultOf(
+            pool.prepare_import('req-0', 'md5-0', 1, vouchers))
+        self.stage_chunks(pool, 'req-0', 'md5-0', vouchers, 1)
+        self.successResultOf(pool.finish_import('req-0', 'md5-0', 2, vouchers))
+        self.assert_voucher_counts(pool, [
+            ('Tank', 'blue', False, 1),
+            ('Tank', 'red', False, 1),
+        ])
+
+    def test_concurrent_imports_add_same_operator(self):
+        pool = VoucherPool('testpool', self.conn)
+        other = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+
+        # Another import adds the new operator after we've looked for it,
+        # but before we've added it.
+        insert_missing = pool._insert_missing
+
+        def add_operator_first(table, rows):
+            if table is pool.operators:
+                self.successResultOf(
+                    other._get_dimension_ids(other.operators, ['Tank']))
+            return insert_missing(table, rows)
+        self.patch(pool, '_insert_missing', add_operator_first)
+
+        self.successResultOf(pool.import_vouchers('req-0', 'md5-0', [
+            voucher_dict('Tank', 'red', 'Tr0'),
+            voucher_dict('Tank', 'red', 'Tr1'),
+        ]))
+        self.assert_voucher_counts(pool, [('Tank', 'red', False, 2)])
+        rows = self.successResultOf(
+            pool.execute_fetchall(pool.operators.select()))
+        assert [row['name'] for row in rows] == ['Tank']
+
+    def test_concurrent_imports_add_same_voucher_type(self):
+        pool = VoucherPool('testpool', self.conn)
+        other = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+
+        # Another import adds the new pair to the catalog after we've looked
+        # for it, but before we've added it.
+        list_catalog = pool._list_catalog
+
+        def add_voucher_type_after(*args):
+            d = list_catalog(*args)
+            self.successResultOf(other._update_catalog(
+                [voucher_dict('Tank', 'red', 'Tr9')]))
+            return d
+        self.patch(pool, '_list_catalog', add_voucher_type_after)
+
+        self.successResultOf(pool.import_vouchers('req-0', 'md5-0', [
+            voucher_dict('Tank', 'red', 'Tr0'),
+            voucher_dict('Tank', 'blue', 'Tb0'),
+        ]))
+        assert self.successResultOf(pool.list_catalog()) == [
+            ('Tank', 'blue'), ('Tank', 'red')]
+        self.assert_voucher_counts(pool, [
+            ('Tank', 'blue', False, 1),
+            ('Tank', 'red', False, 1),
+        ])
+
+    def test_upgrade_tables_adds_export_pages(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        self.successResultOf(self.conn.execute(DropTable(pool.export_pages)))
+        # Exported vouchers didn't record their page.
+        self.successResultOf(
+            self.conn.execute(DropTable(pool.exported_vouchers)))
+        self.successResultOf(self.conn.execute(CreateTable(Table(
+            pool.exported_vouchers.name, MetaData(),
+            Column("id", Integer(), primary_key=True),
+            Column("request_id", String(255), nullable=False),
+            Column("voucher_id", Integer(), nullable=False),
+            Column("created_at", DateTime(timezone=False)),
+        ))))
+        self.successResultOf(migrations.set_schema_version(pool, 5))
+
+        assert self.successResultOf(pool.upgrade_tables()) == [6]
+        assert 'page' in self.get_column_names(pool.exported_vouchers)
+        populate_pool(pool, ['Tank'], ['red'], [0, 1])
+        page0 = self.successResultOf(
+            pool.export_page('req-0', None, ['Tank'], ['red'], 2, 0))
+        replayed = self.successResultOf(
+            pool.export_page('req-0', None, ['Tank'], ['red'], 2, 0))
+        assert len(replayed['vouchers']) == 2
+        assert sorted_dicts(replayed['vouchers']) == sorted_dicts(
+            page0['vouchers'])
+
+        # Running the migration again changes nothing.
+        self.successResultOf(migrations.set_schema_version(pool, 5))
+        assert self.successResultOf(pool.upgrade_tables()) == [6]
+
+    def test_table_metadata_reused(self):
+        pool0 = VoucherPool('testpool', self.conn)
+        pool1 = VoucherPool('testpool', self.conn)
+        other = VoucherPool('otherpool', self.conn)
+        assert pool0.vouchers is pool1.vouchers
+        assert pool0.audit is pool1.audit
+        assert pool0.vouchers is not other.vouchers
+        assert pool1.vouchers.name == 'VoucherPool_testpool_vouchers'
+
+        self.successResultOf(pool1.create_tables())
+        assert self.successResultOf(pool0.exists())
+        assert not self.successResultOf(other.exists())
+
+    def test_issue_voucher_uses_statement_cache(self):
+        models.clear_statement_cache()
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0, 1])
+
+        self.successResultOf(
+            pool.issue_voucher('Tank', 'red', mk_audit_params('req-0')))
+        cached = set(models._compiled_statements)
+        shapes = set(key[-1][0] for key in cached)
+        assert set(['get_voucher', 'update_voucher', 'audit_insert']).issubset(
+            shapes)
+        assert all(key[0] == 'testpool' for key in cached)
+
+        # A new pool object for the same pool reuses the cached statements.
+        pool = VoucherPool('testpool', self.conn)
+        voucher = self.successResultOf(
+            pool.issue_voucher('Tank', 'red', mk_audit_params('req-1')))
+        assert voucher['voucher'] in ['Tank-red-0', 'Tank-red-1']
+        assert set(models._compiled_statements) == cached
+        self.assert_voucher_counts(pool, [('Tank', 'red', True, 2)])
+
+    def test_statement_cache_per_pool(self):
+        models.clear_statement_cache()
+        pool0 = VoucherPool('pool0', self.conn)
+        pool1 = VoucherPool('pool1', self.conn)
+        self.successResultOf(pool0.create_tables())
+        self.successResultOf(pool1.create_tables())
+        populate_pool(pool0, ['Tank'], ['red'], [0])
+        populate_pool(pool1, ['Tank'], ['red'], [1])
+
+        voucher0 = self.successResultOf(
+            pool0.issue_voucher('Tank', 'red', mk_audit_params('req-0')))
+        voucher1 = self.successResultOf(
+            pool1.issue_voucher('Tank', 'red', mk_audit_params('req-0')))
+        assert voucher0['voucher'] == 'Tank-red-0'
+        assert voucher1['voucher'] == 'Tank-red-1'
+        assert set(key[0] for key in models._compiled_statements) == set([
+            'pool0', 'pool1'])
+
+    def test_caches_bounded(self):
+        self.patch(models, '_pool_tables', LRUCache(1))
+        self.patch(models, '_compiled_statements', LRUCache(3))
+        pool0 = VoucherPool('pool0', self.conn)
+        self.successResultOf(pool0.create_tables())
+        populate_pool(pool0, ['Tank'], ['red'], [0, 1])
+        pool1 = VoucherPool('pool1', self.conn)
+        self.successResultOf(pool1.create_tables())
+        populate_pool(pool1, ['Tank'], ['red'], [0])
+        self.successResultOf(
+            pool1.issue_voucher('Tank', 'red', mk_audit_params('req-0')))
+        assert list(models._pool_tables) == ['pool1']
+        assert len(models._compiled_statements) == 3
+
+        # Pools whose tables were forgotten still work.
+        pool0 = VoucherPool('pool0', self.conn)
+        voucher = self.successResultOf(
+            pool0.issue_voucher('Tank', 'red', mk_audit_params('req-0')))
+        assert voucher['voucher'] in ['Tank-red-0', 'Tank-red-1']
+        assert list(models._pool_tables) == ['pool0']
+        assert len(models._compiled_statements) == 3
+
+    def test_issue_voucher_replay_releases_claim(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0, 1])
+        audit_params = mk_audit_params('req-0')
+
+        voucher = self.successResultOf(
+            pool.issue_voucher('Tank', 'red', audit_params))
+        self.assert_voucher_counts(pool, [
+            ('Tank', 'red', False, 1), ('Tank', 'red', True, 1)])
+
+        # The replay claims a voucher before its audit insert conflicts,
+        # and gives it back when it rolls back.
+        claims = []
+        issue = pool._issue_voucher
+
+        def recorded_issue(*args):
+            d = issue(*args)
+            return d.addCallback(lambda v: claims.append(v) or v)
+        self.patch(pool, '_issue_voucher', recorded_issue)
+        replayed = self.successResultOf(
+            pool.issue_voucher('Tank', 'red', audit_params))
+        assert replayed == voucher
+        assert len(claims) == 1 and claims[0] != voucher
+        self.assert_voucher_counts(pool, [
+            ('Tank', 'red', False, 1), ('Tank', 'red', True, 1)])
+
+    def test_issue_voucher_statements(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0])
+        queries = []
+        execute_query = pool._execute_query
+
+        def recorded_execute_query(query, *args, **kw):
+            queries.append(str(query).split()[0])
+            return execute_query(query, *args, **kw)
+        self.patch(pool, '_execute_query', recorded_execute_query)
+        self.successResultOf(
+            pool.issue_voucher('Tank', 'red', mk_audit_params('req-0')))
+        # The claim and one audit insert, with nothing written twice.
+        assert queries == ['SELECT', 'UPDATE', 'INSERT']
+
+    def test_issue_voucher_other_integrity_errors_not_replayed(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0])
+
+        def broken_claim(*args):
+            return fail(IntegrityError('UPDATE ...', {}, Exception('oops')))
+        self.patch(pool, '_issue_voucher', broken_claim)
+        self.failureResultOf(
+            pool.issue_voucher('Tank', 'red', mk_audit_params('req-0')),
+            IntegrityError)
+        # Nothing was audited, and the error wasn't treated as a replay.
+        assert self.successResultOf(pool.query_by_request_id('req-0')) == []
+        self.assert_voucher_counts(pool, [('Tank', 'red', False, 1)])
+
+    def test_issue_voucher_error_rolls_back(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0])
+
+        def broken_audit(*args, **kw):
+            return fail(ValueError('oops'))
+        pool._audit_request = broken_audit
+        self.failureResultOf(
+            pool.issue_voucher('Tank', 'red', mk_audit_params('req-0')),
+            ValueError)
+        self.assert_voucher_counts(pool, [('Tank', 'red', False, 1)])
+
+    def issue_vouchers(self, pool, count):
+        for i in range(count):
+            self.successResultOf(pool.issue_voucher(
+                'Tank', 'red', mk_audit_params('req-%s' % (i,))))
+
+    def test_archive_used_vouchers(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0, 1, 2, 3, 4])
+        self.issue_vouchers(pool, 3)
+
+        assert self.successResultOf(pool.archive_used_vouchers(2)) == 2
+        assert self.successResultOf(pool.archive_used_vouchers(2)) == 1
+        assert self.successResultOf(pool.archive_used_vouchers(2)) == 0
+
+        live = self.successResultOf(
+            pool.execute_fetchall(pool.vouchers.select()))
+        assert [v['used'] for v in live] == [False, False]
+        archived = self.successResultOf(
+            pool.execute_fetchall(pool.vouchers_used.select()))
+        assert len(archived) == 3
+        # Counts include archived vouchers.
+        self.assert_voucher_counts(pool, [
+            ('Tank', 'red', False, 2),
+            ('Tank', 'red', True, 3),
+        ])
+
+    def test_archive_keeps_highest_id(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0, 1])
+        self.issue_vouchers(pool, 2)
+
+        # If we archived the newest voucher, its id could be reused.
+        assert self.successResultOf(pool.archive_used_vouchers(10)) == 1
+        populate_pool(pool, ['Tank'], ['red'], [2])
+        rows = self.successResultOf(pool.execute_fetchall(
+            select([pool.vouchers.c.id])))
+        archived_rows = self.successResultOf(pool.execute_fetchall(
+            select([pool.vouchers_used.c.id])))
+        assert set(r['id'] for r in rows).isdisjoint(
+            r['id'] for r in archived_rows)
+
+    def test_export_idempotent_after_archive(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0, 1, 2])
+
+        response = self.successResultOf(
+            pool.export_vouchers('req-0', 2, ['Tank'], ['red']))
+        assert self.successResultOf(pool.archive_used_vouchers(10)) == 2
+
+        replayed = self.successResultOf(
+            pool.export_vouchers('req-0', 2, ['Tank'], ['red']))
+        assert sorted_dicts(replayed['vouchers']) == sorted_dicts(
+            response['vouchers'])
+        assert len(replayed['vouchers']) == 2
+
+    def test_export_replay_partly_archived(self):
+        pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(pool.create_tables())
+        populate_pool(pool, ['Tank'], ['red'], [0, 1, 2, 3])
+
+        response = self.successResultOf(
+            pool.export_vouchers('req-0', 3, ['Tank'], ['red']))
+        assert self.successResultOf(pool.archive_used_vouchers(1)) == 1
+
+        # Vouchers from both tables come back in the order they had.
+        replayed = self.successResultOf(
+            pool.export_vouchers('req-0', 3, ['Tank'], ['red']))
+        assert replayed['vouchers'] == sorted(
+            response['vouchers'], key=lambda v: v['voucher'])
+        assert len(replayed['vouchers']) == 3
+
+
+class TestSharedVoucherPool(
+        DatabaseTestsMixin, VoucherPoolTestsMixin, TestCase):
+    pool_class = SharedVoucherPool
+
+    def test_pools_share_tables(self):
+        pool0 = SharedVoucherPool('pool0', self.conn)
+        pool1 = SharedVoucherPool('pool1', self.conn)
+        self.successResultOf(pool0.create_tables())
+        table_names = self.successResultOf(self.engine.table_names())
+        self.successResultOf(pool1.create_tables())
+        assert self.successResultOf(self.engine.table_names()) == table_names
+        assert self.get_index_names(pool0.vouchers) == [
+            'ix_SharedVoucherPool_vouchers_unused',
+            'ix_SharedVoucherPool_vouchers_voucher',
+        ]
+        assert self.successResultOf(
+            SharedVoucherPool.list_pool_names(self.conn)) == ['pool0', 'pool1']
+
+    def test_pools_are_separate(self):
+        pool0 = SharedVoucherPool('pool0', self.conn)
+        pool1 = SharedVoucherPool('pool1', self.conn)
+        self.successResultOf(pool0.create_tables())
+        self.successResultOf(pool1.create_tables())
+        populate_pool(pool0, ['Tank'], ['red'], [0, 1])
+        populate_pool(pool1, ['Tank'], ['red', 'blue'], [0])
+
+        # Request ids only need to be unique within a pool.
+        voucher0 = self.successResultOf(
+            pool0.issue_voucher('Tank', 'red', mk_audit_params('req-0')))
+        voucher1 = self.successResultOf(
+            pool1.issue_voucher('Tank', 'red', mk_audit_params('req-0')))
+        assert voucher0['id'] != voucher1['id']
+
+        self.assert_voucher_counts(pool0, [
+            ('Tank', 'red', False, 1),
+            ('Tank', 'red', True, 1),
+        ])
+        self.assert_voucher_counts(pool1, [
+            ('Tank', 'blue', False, 1),
+            ('Tank', 'red', True, 1),
+        ])
+        assert self.successResultOf(pool0.list_catalog()) == [('Tank', 'red')]
+        assert len(self.successResultOf(
+            pool1.query_by_request_id('req-0'))) == 1
+        self.failureResultOf(
+            pool0.issue_voucher('Tank', 'blue', mk_audit_params('req-1')),
+            NoVoucherAvailable)
+
+    def test_migrate_pools(self):
+        old_pool = VoucherPool('pool0', self.conn)
+        self.successResultOf(old_pool.create_tables({'campaign': 'tank'}))
+        populate_pool(old_pool, ['Tank'], ['red'], [0, 1, 2, 3])
+        self.successResultOf(
+            old_pool.issue_voucher('Tank', 'red', mk_audit_params('req-0')))
+        exported = self.successResultOf(
+            old_pool.export_vouchers('req-1', 1, ['Tank'], ['red']))
+        self.successResultOf(old_pool.archive_used_vouchers(10))
+        # Another pool is already using the shared tables.
+        other_pool = SharedVoucherPool('pool1', self.conn)
+        self.successResultOf(other_pool.create_tables())
+        populate_pool(other_pool, ['Tank'], ['red'], [0])
+
+        assert self.successResultOf(
+            shared.migrate_pools(self.conn)) == ['pool0']
+        # Pools that have already been migrated are skipped.
+        assert self.successResultOf(shared.migrate_pools(self.conn)) == []
+
+        pool = SharedVoucherPool('pool0', self.conn)
+        assert self.successResultOf(pool.get_metadata()) == {
+            'campaign': 'tank'}
+        self.assert_voucher_counts(pool, [
+            ('Tank', 'red', False, 2),
+            ('Tank', 'red', True, 2),
+        ])
+        self.assert_voucher_counts(other_pool, [('Tank', 'red', False, 1)])
+        assert self.successResultOf(pool.list_catalog()) == [('Tank', 'red')]
+
+        # Audited requests are replayed.
+        self.failureResultOf(pool.issue_voucher(
+            'Tank', 'red', mk_audit_params('req-0', 'tx-other')),
+            AuditMismatch)
+        replayed = self.successResultOf(
+            pool.export_vouchers('req-1', 1, ['Tank'], ['red']))
+        assert replayed == exported
+
+        # New vouchers don't clash with the copied ones.
+        populate_pool(pool, ['Tank'], ['red'], [4])
+        self.successResultOf(pool.export_vouchers('req-2', 3, None, None))
+        self.assert_voucher_counts(pool, [('Tank', 'red', True, 5)])
+
+    def test_migrate_missing_pool(self):
+        self.failureResultOf(
+            shared.migrate_pools(self.conn, ['pool0']), NoVoucherPool)
+
+
+class TestMemoryVoucherPool(VoucherPoolTestsMixin, TestCase):
+    pool_class = MemoryVoucherPool
+
+    def setUp(self):
+        self.conn = self.successResultOf(MemoryEngine().connect())
+
+    def tearDown(self):
+        self.successResultOf(self.conn.close())
+
+
+class FakeCursor(object):
+    """
+    Cursor that records statements and returns ``valid`` rows in turn for
+    index validity checks.
+    """
+
+    def __init__(self, *valid):
+        self.valid = list(valid)
+        self.statements = []
+
+    def execute(self, sql, params=None):
+        self.statements.append(sql if params is None else (sql, params))
+
+    def fetchone(self):
+        valid = self.valid.pop(0)
+        return None if valid is None else (valid,)
+
+
+class TestBuildIndexConcurrently(TestCase):
+    check = (migrations.PG_INDEX_VALID_SQL, ('ix_foo',))
+
+    def build(self, cursor):
+        migrations._build_index_concurrently(
+            cursor, 'ix_foo', '"ix_foo"', 'CREATE INDEX CONCURRENTLY ix_foo')
+
+    def test_new_index(self):
+        cursor = FakeCursor(None, True)
+        self.build(cursor)
+        assert cursor.statements == [
+            self.check, 'CREATE INDEX CONCURRENTLY ix_foo', self.check]
+
+    def test_valid_index_kept(self):
+        cursor = FakeCursor(True)
+        self.build(cursor)
+        assert cursor.statements == [self.check]
+
+    def test_invalid_index_rebuilt(self):
+        cursor = FakeCursor(False, True)
+        self.build(cursor)
+        assert cursor.statements == [
+            self.check,
+            'DROP INDEX CONCURRENTLY "ix_foo"',
+            'CREATE INDEX CONCURRENTLY ix_foo',
+            self.check,
+        ]
+
+    def test_build_left_invalid_index(self):
+        cursor = FakeCursor(None, False)
+        self.assertRaises(migrations.InvalidIndex, self.build, cursor)
@@ -0,0 +1,107 @@
+import marshal
+import pstats
+import threading
+
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from airtime_service.profiler import (
+    Profiler, ProfilerBusy, StackSampler, format_stats, dump_stats,
+    format_collapsed,
+)
+
+
+def busy_work():
+    return sum(range(100))
+
+
+class TestStackSampler(TestCase):
+    def test_sample(self):
+        sampler = StackSampler()
+        sampler.sample()
+        [stack] = [s for s in sampler.counts if 'test_sample' in s]
+        frames = stack.split(';')
+        assert frames[0] == threading.current_thread().name
+        assert frames[-1].startswith('sample (')
+        assert sampler.counts[stack] == 1
+        sampler.sample()
+        assert sampler.counts[stack] == 2
+
+    def test_start_stop(self):
+        sampler = StackSampler(interval=0.001)
+        sampler.start()
+        counts = sampler.stop()
+        assert counts is sampler.counts
+        assert not [s for s in counts if 'stack-sampler' in s]
+
+
+    def test_stop_when_wait_returns_none(self):
+        # Event.wait() returns None whether or not it was set before
+        # Python 2.7.
+        sampler = StackSampler(interval=0.001)
+        wait = sampler._stopped.wait
+        self.patch(
+            sampler._stopped, 'wait', lambda timeout: wait(timeout) and None)
+        samples = []
+        self.patch(sampler, 'sample', lambda: samples.append(
+            sampler._stopped.is_set()))
+        sampler.start()
+        sampler.stop()
+        assert not sampler._thread.is_alive()
+        assert True not in samples
+
+
+class TestFormatting(TestCase):
+    def test_format_collapsed(self):
+        output = format_collapsed({'main;b': 2, 'main;a': 5})
+        assert output == 'main;a 5\nmain;b 2\n'
+
+    def test_format_stats(self):
+        profiler = Profiler(Clock())
+        stats = self.profile(profiler)
+        assert 'function calls' in format_stats(stats)
+        assert 'busy_work' in format_stats(stats)
+
+    def test_dump_stats(self):
+        stats = self.profile(Profiler(Clock()))
+        assert marshal.loads(dump_stats(stats)) == stats.stats
+
+    def profile(self, profiler):
+        d = profiler.profile(1)
+        busy_work()
+        profiler.clock.advance(1)
+        return self.successResultOf(d)
+
+
+class TestProfiler(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.profiler = Profiler(self.clock)
+
+    def test_profile(self):
+        d = self.profiler.profile(2)
+        assert self.profiler.running
+        busy_work()
+        self.clock.advance(1)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        stats = self.successResultOf(d)
+        assert isinstance(stats, pstats.Stats)
+        assert [f for f in stats.stats if f[2] == 'busy_work']
+        assert not self.profiler.running
+
+    def test_sample(self):
+        d = self.profiler.sample(1)
+        assert self.profiler.running
+        self.clock.advance(1)
+        assert isinstance(self.successResultOf(d), dict)
+        assert not self.profiler.running
+
+    def test_busy(self):
+        self.profiler.sample(1)
+        self.assertRaises(ProfilerBusy, self.profiler.profile, 1)
+        self.assertRaises(ProfilerBusy, self.profiler.sample, 1)
+        self.clock.advance(1)
+        d = self.profiler.profile(1)
+        self.clock.advance(1)
+        self.successResultOf(d)
@@ -0,0 +1,98 @@
+from twisted.internet.address import IPv4Address
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from airtime_service.rate_limit import (
+    RateLimiter, RateLimited, source_address,
+)
+
+
+def mk_request(address, forwarded_for=()):
+    request = DummyRequest([''])
+    request.client = IPv4Address('TCP', address, 1234)
+    for header in forwarded_for:
+        request.requestHeaders.addRawHeader('X-Forwarded-For', header)
+    return request
+
+
+class TestSourceAddress(TestCase):
+    def test_direct(self):
+        request = mk_request('10.0.0.1', ['192.168.0.1'])
+        assert source_address(request) == '10.0.0.1'
+        assert source_address(request, ['10.0.0.2']) == '10.0.0.1'
+
+    def test_trusted_proxy(self):
+        request = mk_request('10.0.0.1', ['192.168.0.1'])
+        assert source_address(request, ['10.0.0.1']) == '192.168.0.1'
+
+    def test_spoofed_addresses_ignored(self):
+        # The client added the first address itself.
+        request = mk_request('10.0.0.1', ['1.2.3.4, 192.168.0.1'])
+        assert source_address(request, ['10.0.0.1']) == '192.168.0.1'
+
+    def test_chained_proxies(self):
+        request = mk_request('10.0.0.1', ['192.168.0.1', '10.0.0.2'])
+        assert source_address(
+            request, ['10.0.0.1', '10.0.0.2']) == '192.168.0.1'
+
+    def test_no_forwarded_for(self):
+        request = mk_request('10.0.0.1')
+        assert source_address(request, ['10.0.0.1']) == '10.0.0.1'
+
+
+class TestRateLimiter(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_burst(self):
+        limiter = RateLimiter(self.clock, rate=1, burst=3)
+        for _ in range(3):
+            limiter.check('user-0')
+        f = self.assertRaises(RateLimited, limiter.check, 'user-0')
+        assert f.retry_after == 1
+        assert limiter.rejected == 1
+
+        # Other keys have their own buckets.
+        limiter.check('user-1')
+
+    def test_default_burst(self):
+        assert RateLimiter(self.clock, rate=2.5).burst == 3
+        assert RateLimiter(self.clock, rate=0.1).burst == 1
+
+    def test_refill(self):
+        limiter = RateLimiter(self.clock, rate=2, burst=2)
+        limiter.check('user-0')
+        limiter.check('user-0')
+        self.assertRaises(RateLimited, limiter.check, 'user-0')
+        self.clock.advance(0.5)
+        limiter.check('user-0')
+        self.assertRaises(RateLimited, limiter.check, 'user-0')
+
+        # Buckets never hold more than the burst.
+        self.clock.advance(100)
+        limiter.check('user-0')
+        limiter.check('user-0')
+        self.assertRaises(RateLimited, limiter.check, 'user-0')
+
+    def test_retry_after(self):
+        limiter = RateLimiter(self.clock, rate=0.1, burst=1)
+        limiter.check('user-0')
+        self.clock.advance(2.5)
+        f = self.assertRaises(RateLimited, limiter.check, 'user-0')
+        assert f.retry_after == 8
+
+    def test_idle_buckets_evicted(self):
+        limiter = RateLimiter(self.clock, rate=1, burst=2)
+        limiter.check('user-0')
+        self.clock.advance(1)
+        limiter.check('user-1')
+        assert len(limiter) == 2
+
+        # user-0's bucket has refilled, so it's forgotten.
+        self.clock.advance(1)
+        limiter.check('user-2')
+        assert len(limiter) == 2
+        self.clock.advance(2)
+        limiter.check('user-2')
+        assert len(limiter) == 1
@@ -0,0 +1,86 @@
+from aludel.database import get_engine
+from aludel.tests.doubles import FakeReactorThreads
+from twisted.internet.defer import fail
+from twisted.trial.unittest import TestCase
+
+from airtime_service.replicas import ReplicaRouter, query_lag
+
+
+class BrokenEngine(object):
+    def __init__(self, engine):
+        self.dialect = engine.dialect
+
+    def connect(self):
+        return fail(Exception("Connection refused."))
+
+    def execute(self, *args, **kw):
+        return fail(Exception("Connection refused."))
+
+
+class TestReplicaRouter(TestCase):
+    timeout = 5
+
+    def setUp(self):
+        self.primary = self.mk_engine()
+
+    def mk_engine(self):
+        return get_engine('sqlite://', reactor=FakeReactorThreads())
+
+    def connected_engine(self, router):
+        conn = self.successResultOf(router.connect())
+        self.addCleanup(conn.close)
+        return conn._engine
+
+    def test_no_replicas(self):
+        router = ReplicaRouter(self.primary, [])
+        assert self.connected_engine(router) is self.primary
+
+    def test_round_robin(self):
+        replicas = [self.mk_engine(), self.mk_engine()]
+        router = ReplicaRouter(self.primary, replicas)
+        assert [self.connected_engine(router) for _ in range(4)] == [
+            replicas[0], replicas[1], replicas[0], replicas[1]]
+
+    def test_unhealthy_replica_skipped(self):
+        replicas = [self.mk_engine(), self.mk_engine()]
+        router = ReplicaRouter(self.primary, replicas)
+        router.replicas[0].healthy = False
+        assert [self.connected_engine(router) for _ in range(3)] == [
+            replicas[1], replicas[1], replicas[1]]
+
+    def test_lagging_replica_skipped(self):
+        replicas = [self.mk_engine(), self.mk_engine()]
+        router = ReplicaRouter(self.primary, replicas, max_lag=1.0)
+        router.replicas[1].lag = 1.5
+        assert [self.connected_engine(router) for _ in range(3)] == [
+            replicas[0], replicas[0], replicas[0]]
+
+    def test_fallback_to_primary(self):
+        router = ReplicaRouter(self.primary, [self.mk_engine()], max_lag=1.0)
+        router.replicas[0].lag = 1.5
+        assert self.connected_engine(router) is self.primary
+
+    def test_connection_failure_falls_back(self):
+        broken = BrokenEngine(self.primary)
+        router = ReplicaRouter(self.primary, [broken])
+        assert self.connected_engine(router) is self.primary
+        assert len(self.flushLoggedErrors()) == 1
+        assert not router.replicas[0].healthy
+
+    def test_check_health(self):
+        replica = self.mk_engine()
+        router = ReplicaRouter(self.primary, [replica])
+        router.replicas[0].healthy = False
+        router.replicas[0].lag = 10.0
+        self.successResultOf(router.check_health())
+        assert router.replicas[0].healthy
+        assert router.replicas[0].lag == 0.0
+
+    def test_check_health_failure(self):
+        router = ReplicaRouter(self.primary, [BrokenEngine(self.primary)])
+        self.successResultOf(router.check_health())
+        assert not router.replicas[0].healthy
+        assert len(self.flushLoggedErrors()) == 1
+
+    def test_query_lag_sqlite(self):
+        assert self.successResultOf(query_lag(self.mk_engine())) == 0.0
@@ -0,0 +1,136 @@
+from sqlalchemy.exc import OperationalError
+from twisted.internet.defer import fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from airtime_service.retry import TransactionRetrier, is_retryable
+
+
+class FakeDialect(object):
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeEngine(object):
+    def __init__(self, dialect_name):
+        self.dialect = FakeDialect(dialect_name)
+
+
+class FakePgError(Exception):
+    def __init__(self, pgcode):
+        super(FakePgError, self).__init__(pgcode)
+        self.pgcode = pgcode
+
+
+def db_error(orig):
+    return OperationalError('UPDATE vouchers ...', {}, orig)
+
+
+SQLITE_LOCKED = db_error(Exception('database is locked'))
+
+
+class Work(object):
+    """
+    Fails with each of ``errors`` in turn, then succeeds.
+    """
+
+    def __init__(self, *errors):
+        self.errors = list(errors)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.errors:
+            return fail(self.errors.pop(0))
+        return succeed('done')
+
+
+class TestIsRetryable(TestCase):
+    def test_postgresql(self):
+        engine = FakeEngine('postgresql')
+        assert is_retryable(engine, db_error(FakePgError('40001')))
+        assert is_retryable(engine, db_error(FakePgError('40P01')))
+        assert not is_retryable(engine, db_error(FakePgError('23505')))
+
+    def test_mysql(self):
+        engine = FakeEngine('mysql')
+        assert is_retryable(engine, db_error(Exception(1213, 'Deadlock')))
+        assert is_retryable(engine, db_error(Exception(1205, 'Timeout')))
+        assert not is_retryable(engine, db_error(Exception(1062, 'Dup')))
+
+    def test_sqlite(self):
+        engine = FakeEngine('sqlite')
+        assert is_retryable(engine, SQLITE_LOCKED)
+        assert not is_retryable(engine, db_error(Exception('no such table')))
+
+    def test_other_errors(self):
+        engine = FakeEngine('postgresql')
+        assert not is_retryable(engine, ValueError('40001'))
+        assert not is_retryable(
+            FakeEngine('oracle'), db_error(FakePgError('40001')))
+
+
+class TestTransactionRetrier(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def mk_retrier(self, **kw):
+        # Always use the longest delay so the tests are predictable.
+        kw.setdefault('random', lambda: 1.0)
+        return TransactionRetrier(self.clock, FakeEngine('sqlite'), **kw)
+
+    def test_success(self):
+        retrier = self.mk_retrier()
+        work = Work()
+        assert self.successResultOf(retrier.run('issue', work)) == 'done'
+        assert work.calls == 1
+        assert retrier.stats() == {
+            'deadline': 1.0, 'retries': {}, 'exhausted': {}}
+
+    def test_retries_with_backoff(self):
+        retrier = self.mk_retrier(base_delay=0.1, max_delay=0.3)
+        work = Work(SQLITE_LOCKED, SQLITE_LOCKED, SQLITE_LOCKED)
+        d = retrier.run('issue', work)
+        assert work.calls == 1
+        self.clock.advance(0.1)
+        assert work.calls == 2
+        self.clock.advance(0.2)
+        assert work.calls == 3
+        # The delay stops growing at max_delay.
+        self.clock.advance(0.29)
+        assert work.calls == 3
+        self.clock.advance(0.01)
+        assert self.successResultOf(d) == 'done'
+        assert work.calls == 4
+        assert retrier.retries == {'issue': 3}
+
+    def test_jitter(self):
+        retrier = self.mk_retrier(base_delay=0.1, random=lambda: 0.5)
+        work = Work(SQLITE_LOCKED)
+        d = retrier.run('issue', work)
+        self.clock.advance(0.05)
+        assert self.successResultOf(d) == 'done'
+
+    def test_no_retry_for_other_errors(self):
+        retrier = self.mk_retrier()
+        work = Work(db_error(Exception('no such table')))
+        self.failureResultOf(retrier.run('issue', work), OperationalError)
+        assert work.calls == 1
+        assert retrier.retries == {}
+
+    def test_gives_up_at_deadline(self):
+        retrier = self.mk_retrier(
+            deadline=0.5, base_delay=0.1, max_delay=1.0)
+        work = Work(*[SQLITE_LOCKED] * 5)
+        d = retrier.run('import', work)
+        self.clock.advance(0.1)
+        self.clock.advance(0.2)
+        # The next delay would take us past the deadline.
+        f = self.failureResultOf(d, OperationalError)
+        assert f.value is SQLITE_LOCKED
+        assert work.calls == 3
+        assert retrier.stats() == {
+            'deadline': 0.5,
+            'retries': {'import': 2},
+            'exhausted': {'import': 1},
+        }
@@ -1,39 +1,452 @@
+from twisted.application.internet import TimerService
+from twisted.internet.defer import (
+    Deferred, fail, succeed, inlineCallbacks, returnValue,
+)
+from twisted.internet.task import Clock
 from twisted.python.usage import UsageError
 from twisted.trial.unittest import TestCase
 
 from airtime_service import service
+from airtime_service.concurrency import DatabaseThreads
+from airtime_service.memory import MemoryVoucherPool
+from airtime_service.models import VoucherPool
+from airtime_service.shared import SharedVoucherPool
+
+
+OPTION_KEYS = set([
+    'port', 'database-connection-string', 'replica-connection-string',
+    'replica-max-lag', 'replica-check-interval', 'db-thread-pool-size',
+    'pool-concurrency-limit', 'max-in-flight', 'endpoint-limit',
+    'max-queued', 'queue-timeout', 'retry-after', 'warmup-connections',
+    'warmup-pool', 'server-timing', 'log-timing', 'admin-port',
+    'slow-query-threshold', 'slow-query-log', 'slow-query-explain-after',
+    'enable-profiler', 'profile-max-seconds', 'archive-interval',
+    'archive-batch-size', 'shared-tables', 'transaction-retry-deadline',
+    'shutdown-timeout', 'access-log', 'access-log-sample-rate',
+    'access-log-max-queued', 'user-rate-limit', 'user-rate-burst',
+    'source-rate-limit', 'source-rate-burst', 'issuance-stats-file',
+    'import-chunk-size', 'import-concurrency', 'max-export-page-size',
+    'trusted-proxy',
+])
+
+
+def mk_options(*args):
+    opts = service.Options()
+    opts.parseOptions(list(args))
+    return opts
+
+
+def get_timers(svc):
+    # Timers run under the drain service, so they stop before the database
+    # threads do.
+    [drain] = [s for s in svc if isinstance(s, service.DrainService)]
+    assert not [s for s in svc if isinstance(s, TimerService)]
+    return [s for s in drain if isinstance(s, TimerService)]
 
 
 class TestService(TestCase):
     def test_make_service(self):
-        svc = service.makeService({
-            'database-connection-string': 'sqlite://',
-            'port': '0',
-        })
+        svc = service.makeService(mk_options('-p', '0', '-d', 'sqlite://'))
         assert not svc.running
 
     def test_make_service_bad_db_conn_str(self):
-        self.assertRaises(Exception, service.makeService, {
-            'database-connection-string': 'the cloud',
-            'port': '0',
-        })
+        self.assertRaises(
+            Exception, service.makeService,
+            mk_options('-p', '0', '-d', 'the cloud'))
+
+    def test_make_service_no_replicas(self):
+        svc = service.makeService(mk_options('-p', '0', '-d', 'sqlite://'))
+        assert not get_timers(svc)
+
+    def test_make_service_with_replicas(self):
+        svc = service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://',
+            '--replica-connection-string', 'sqlite://',
+            '--replica-check-interval', '5'))
+        [timer] = get_timers(svc)
+        assert timer.step == 5.0
 
     def test_happy_options(self):
         opts = service.Options()
         opts.parseOptions(['-p', '1234', '-d', 'sqlite://'])
-        assert set(opts.keys()) == set([
-            'port', 'database-connection-string'])
+        assert set(opts.keys()) == OPTION_KEYS
         assert opts['database-connection-string'] == 'sqlite://'
         assert opts['port'] == '1234'
 
     def test_default_port(self):
         opts = service.Options()
         opts.parseOptions(['-d', 'sqlite://'])
-        assert set(opts.keys()) == set([
-            'port', 'database-connection-string'])
+        assert set(opts.keys()) == OPTION_KEYS
         assert opts['database-connection-string'] == 'sqlite://'
         assert opts['port'] == '8080'
 
+    def test_replica_options(self):
+        opts = service.Options()
+        opts.parseOptions([
+            '-d', 'sqlite://',
+            '--replica-connection-string', 'sqlite:///replica-0.db',
+            '--replica-connection-string', 'sqlite:///replica-1.db',
+            '--replica-max-lag', '2.5'])
+        assert opts['replica-connection-string'] == [
+            'sqlite:///replica-0.db', 'sqlite:///replica-1.db']
+        assert opts['replica-max-lag'] == 2.5
+
+    def test_replica_defaults(self):
+        opts = service.Options()
+        opts.parseOptions(['-d', 'sqlite://'])
+        assert opts['replica-connection-string'] == []
+        assert opts['replica-max-lag'] == service.DEFAULT_MAX_LAG
+        assert opts['replica-check-interval'] == (
+            service.DEFAULT_REPLICA_CHECK_INTERVAL)
+
+    def test_concurrency_options(self):
+        opts = service.Options()
+        opts.parseOptions([
+            '-d', 'sqlite://', '--db-thread-pool-size', '8',
+            '--pool-concurrency-limit', '4'])
+        assert opts['db-thread-pool-size'] == 8
+        assert opts['pool-concurrency-limit'] == 4
+
+    def test_make_service_default_thread_pool(self):
+        svc = service.makeService(mk_options('-p', '0', '-d', 'sqlite://'))
+        assert not [s for s in svc if isinstance(s, DatabaseThreads)]
+
+    def test_make_service_dedicated_thread_pool(self):
+        svc = service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://', '--db-thread-pool-size', '3'))
+        # The threads are stopped after requests are drained.
+        [drain] = [s for s in svc if isinstance(s, service.DrainService)]
+        [db_threads] = [s for s in drain if isinstance(s, DatabaseThreads)]
+        assert db_threads.getThreadPool().max == 3
+
+    @inlineCallbacks
+    def test_stop_drains_with_dedicated_thread_pool(self):
+        apps = self.record_apps()
+        svc = service.makeService(mk_options(
+            '-p', 'tcp:0:interface=127.0.0.1', '-d', 'sqlite://',
+            '--db-thread-pool-size', '1'))
+        [app] = apps
+        svc.startService()
+
+        @inlineCallbacks
+        def query():
+            conn = yield app.engine.connect()
+            try:
+                result = yield conn.execute('SELECT 1')
+                rows = yield result.fetchall()
+            finally:
+                yield conn.close()
+            returnValue(rows)
+
+        # This request's queries must still run while we're stopping.
+        d = app.drainer.run(query)
+        stopped = svc.stopService()
+        rows = yield d
+        assert [tuple(row) for row in rows] == [(1,)]
+        yield stopped
+        assert not svc.running
+
+    # Without the fix this hangs, so don't wait long.
+    test_stop_drains_with_dedicated_thread_pool.timeout = 5
+
+    def test_admission_options(self):
+        opts = service.Options()
+        opts.parseOptions([
+            '-d', 'sqlite://', '--max-in-flight', '100',
+            '--endpoint-limit', 'export_vouchers=2',
+            '--endpoint-limit', 'import_vouchers=1',
+            '--max-queued', '50', '--queue-timeout', '0.5',
+            '--retry-after', '3'])
+        assert opts['max-in-flight'] == 100
+        assert opts['endpoint-limit'] == {
+            'export_vouchers': 2, 'import_vouchers': 1}
+        assert opts['max-queued'] == 50
+        assert opts['queue-timeout'] == 0.5
+        assert opts['retry-after'] == 3
+
+    def test_bad_endpoint_limit(self):
+        opts = service.Options()
+        self.assertRaises(UsageError, opts.parseOptions, [
+            '-d', 'sqlite://', '--endpoint-limit', 'export_vouchers'])
+        self.assertRaises(UsageError, opts.parseOptions, [
+            '-d', 'sqlite://', '--endpoint-limit', 'export_vouchers=many'])
+
+    def record_apps(self):
+        apps = []
+        app_class = service.AirtimeServiceApp
+
+        def make_app(*args, **kw):
+            apps.append(app_class(*args, **kw))
+            return apps[-1]
+        self.patch(service, 'AirtimeServiceApp', make_app)
+        return apps
+
+    def test_make_service_admission(self):
+        apps = self.record_apps()
+        service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://', '--max-in-flight', '10',
+            '--endpoint-limit', 'issue_voucher=5'))
+        [app] = apps
+        assert app.admission.max_in_flight == 10
+        assert app.admission.endpoint_limits == {'issue_voucher': 5}
+
+    def test_warmup_options(self):
+        opts = service.Options()
+        opts.parseOptions([
+            '-d', 'sqlite://', '--warmup-connections', '4',
+            '--warmup-pool', 'pool0', '--warmup-pool', 'pool1'])
+        assert opts['warmup-connections'] == 4
+        assert opts['warmup-pool'] == ['pool0', 'pool1']
+
+    def test_warmup_defaults(self):
+        opts = service.Options()
+        opts.parseOptions(['-d', 'sqlite://'])
+        assert opts['warmup-connections'] == service.DEFAULT_WARMUP_CONNECTIONS
+        assert opts['warmup-pool'] == []
+
+    def test_make_service_warm_up(self):
+        svc = service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://', '--warmup-pool', 'pool0'))
+        [warm_up] = [s for s in svc if isinstance(s, service.WarmUpService)]
+        assert warm_up.pools == ['pool0']
+        assert warm_up.connections == 1
+
+    def test_make_service_access_log(self):
+        apps = self.record_apps()
+        svc = service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://', '--access-log', 'access.log',
+            '--access-log-sample-rate', '0.1'))
+        [app] = apps
+        assert app.access_log.log_path == 'access.log'
+        assert app.access_log.success_sample_rate == 0.1
+        # The access log is stopped after requests are drained.
+        [drain] = [s for s in svc if isinstance(s, service.DrainService)]
+        assert list(drain) == [app.access_log, app.issuance_stats]
+
+    def test_make_service_no_access_log(self):
+        apps = self.record_apps()
+        service.makeService(mk_options('-p', '0', '-d', 'sqlite://'))
+        [app] = apps
+        assert app.access_log is None
+
+    def test_make_service_rate_limits(self):
+        apps = self.record_apps()
+        service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://', '--user-rate-limit', '0.5',
+            '--user-rate-burst', '3', '--source-rate-limit', '100'))
+        [app] = apps
+        assert app.user_rate_limiter.rate == 0.5
+        assert app.user_rate_limiter.burst == 3
+        assert app.source_rate_limiter.rate == 100
+        assert app.source_rate_limiter.burst == 100
+        assert app.trusted_proxies == []
+
+    def test_make_service_trusted_proxies(self):
+        apps = self.record_apps()
+        service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://', '--source-rate-limit', '100',
+            '--trusted-proxy', '10.0.0.1', '--trusted-proxy', '10.0.0.2'))
+        [app] = apps
+        assert app.trusted_proxies == ['10.0.0.1', '10.0.0.2']
+
+    def test_make_service_no_rate_limits(self):
+        apps = self.record_apps()
+        service.makeService(mk_options('-p', '0', '-d', 'sqlite://'))
+        [app] = apps
+        assert app.user_rate_limiter is None
+        assert app.source_rate_limiter is None
+
+    def test_make_service_issuance_stats(self):
+        apps = self.record_apps()
+        svc = service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://', '--issuance-stats-file',
+            'stats.json'))
+        [app] = apps
+        assert app.issuance_stats.state_path == 'stats.json'
+        # The stats are saved after requests are drained.
+        [drain] = [s for s in svc if isinstance(s, service.DrainService)]
+        assert list(drain) == [app.issuance_stats]
+
+    def test_make_service_drain(self):
+        svc = service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://', '--shutdown-timeout', '30'))
+        [drain] = [s for s in svc if isinstance(s, service.DrainService)]
+        assert drain.timeout == 30
+
+    def test_timing_options(self):
+        opts = service.Options()
+        opts.parseOptions(['-d', 'sqlite://'])
+        assert not opts['server-timing']
+        assert not opts['log-timing']
+        opts = service.Options()
+        opts.parseOptions([
+            '-d', 'sqlite://', '--server-timing', '--log-timing'])
+        assert opts['server-timing']
+        assert opts['log-timing']
+
+    def test_make_service_timing(self):
+        apps = self.record_apps()
+        service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://', '--server-timing'))
+        [app] = apps
+        assert app.server_timing
+        assert not app.log_timing
+
+    def test_make_service_slow_query_log(self):
+        apps = self.record_apps()
+        svc = service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://', '--slow-query-threshold', '0.5',
+            '--slow-query-explain-after', '3'))
+        [app] = apps
+        assert app.slow_query_log.threshold == 0.5
+        assert app.slow_query_log.explain_after == 3
+        # The slow query log is closed after requests are drained.
+        [drain] = [s for s in svc if isinstance(s, service.DrainService)]
+        assert list(drain) == [app.slow_query_log, app.issuance_stats]
+
+    def test_make_service_transaction_retry_deadline(self):
+        apps = self.record_apps()
+        service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://',
+            '--transaction-retry-deadline', '2.5'))
+        [app] = apps
+        assert app.retrier.deadline == 2.5
+
+    def test_make_service_no_slow_query_log(self):
+        apps = self.record_apps()
+        service.makeService(mk_options('-p', '0', '-d', 'sqlite://'))
+        [app] = apps
+        assert app.slow_query_log is None
+
+    def test_make_service_admin_port(self):
+        svc = service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://', '--admin-port', '0'))
+        ports = [s for s in svc if hasattr(s, 'endpoint')]
+        assert len(ports) == 2
+
+    def test_make_service_no_admin_port(self):
+        svc = service.makeService(mk_options('-p', '0', '-d', 'sqlite://'))
+        ports = [s for s in svc if hasattr(s, 'endpoint')]
+        assert len(ports) == 1
+
+    def test_profiler_options(self):
+        opts = mk_options('-d', 'sqlite://')
+        assert not opts['enable-profiler']
+        assert opts['profile-max-seconds'] == service.DEFAULT_MAX_DURATION
+        opts = mk_options(
+            '-d', 'sqlite://', '--admin-port', '0', '--enable-profiler',
+            '--profile-max-seconds', '30')
+        assert opts['enable-profiler']
+        assert opts['profile-max-seconds'] == 30.0
+
+    def test_profiler_requires_admin_port(self):
+        self.assertRaises(
+            UsageError, mk_options, '-d', 'sqlite://', '--enable-profiler')
+
+    def test_archive_options(self):
+        opts = mk_options('-d', 'sqlite://')
+        assert opts['archive-interval'] is None
+        assert opts['archive-batch-size'] == service.DEFAULT_BATCH_SIZE
+        opts = mk_options(
+            '-d', 'sqlite://', '--archive-interval', '60',
+            '--archive-batch-size', '100')
+        assert opts['archive-interval'] == 60.0
+        assert opts['archive-batch-size'] == 100
+
+    def test_make_service_archiver(self):
+        svc = service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://', '--archive-interval', '60',
+            '--archive-batch-size', '100'))
+        [timer] = get_timers(svc)
+        assert timer.step == 60.0
+        [drain] = [s for s in svc if isinstance(s, service.DrainService)]
+        assert list(drain)[-1] is timer
+        assert timer.call[0].im_self.batch_size == 100
+        assert timer.call[0].im_self.voucher_pool_class is VoucherPool
+
+    def test_make_service_shared_tables(self):
+        apps = self.record_apps()
+        svc = service.makeService(mk_options(
+            '-p', '0', '-d', 'sqlite://', '--shared-tables',
+            '--archive-interval', '60'))
+        [app] = apps
+        assert app.voucher_pool_class is SharedVoucherPool
+        [timer] = get_timers(svc)
+        assert timer.call[0].im_self.voucher_pool_class is SharedVoucherPool
+
+    def test_make_service_memory(self):
+        apps = self.record_apps()
+        service.makeService(mk_options('-p', '0', '-d', 'memory://'))
+        [app] = apps
+        assert app.voucher_pool_class is MemoryVoucherPool
+
+    def test_memory_unsupported_options(self):
+        self.assertRaises(
+            UsageError, mk_options, '-d', 'memory://',
+            '--replica-connection-string', 'memory://')
+        self.assertRaises(
+            UsageError, mk_options, '-d', 'memory://',
+            '--archive-interval', '60')
+        self.assertRaises(
+            UsageError, mk_options, '-d', 'memory://', '--shared-tables')
+
     def test_db_conn_str_required(self):
         opts = service.Options()
         self.assertRaises(UsageError, opts.parseOptions, [])
+
+
+class FakeApp(object):
+    def __init__(self, results):
+        self.results = results
+        self.calls = []
+        self.shutdowns = []
+
+    def warm_up(self, connections, pools):
+        self.calls.append((connections, pools))
+        return self.results.pop(0)
+
+    def shutdown(self, timeout):
+        d = Deferred()
+        self.shutdowns.append((timeout, d))
+        return d
+
+
+class TestWarmUpService(TestCase):
+    def test_warm_up_on_start(self):
+        app = FakeApp([succeed(None)])
+        svc = service.WarmUpService(app, Clock(), 3, ['pool0'])
+        svc.startService()
+        assert app.calls == [(3, ['pool0'])]
+
+    def test_warm_up_retries(self):
+        clock = Clock()
+        app = FakeApp([fail(Exception('no db')), succeed(None)])
+        svc = service.WarmUpService(app, clock, 1, [])
+        svc.startService()
+        assert len(app.calls) == 1
+        assert len(self.flushLoggedErrors()) == 1
+        clock.advance(service.WARMUP_RETRY_DELAY)
+        assert len(app.calls) == 2
+        assert clock.getDelayedCalls() == []
+
+    def test_stop_cancels_retry(self):
+        clock = Clock()
+        app = FakeApp([fail(Exception('no db'))])
+        svc = service.WarmUpService(app, clock, 1, [])
+        svc.startService()
+        self.flushLoggedErrors()
+        svc.stopService()
+        assert clock.getDelayedCalls() == []
+
+
+class TestDrainService(TestCase):
+    def test_stop_waits_for_shutdown(self):
+        app = FakeApp([])
+        svc = service.DrainService(app, 7)
+        svc.startService()
+        d = svc.stopService()
+        [(timeout, shutdown_d)] = app.shutdowns
+        assert timeout == 7
+        self.assertNoResult(d)
+        shutdown_d.callback(None)
+        self.successResultOf(d)
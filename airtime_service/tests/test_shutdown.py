@@ -0,0 +1,59 @@
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from airtime_service.shutdown import RequestDrainer, ShuttingDown
+
+
+class TestRequestDrainer(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.drainer = RequestDrainer(self.clock)
+
+    def test_run(self):
+        work = Deferred()
+        d = self.drainer.run(lambda x: work, 'x')
+        assert self.drainer.in_flight == 1
+        work.callback('done')
+        assert self.successResultOf(d) == 'done'
+        assert self.drainer.in_flight == 0
+
+    def test_run_failure(self):
+        d = self.drainer.run(lambda: 1 / 0)
+        self.failureResultOf(d, ZeroDivisionError)
+        assert self.drainer.in_flight == 0
+
+    def test_drain_idle(self):
+        assert self.successResultOf(self.drainer.drain(5)) == 0
+        assert self.drainer.draining
+
+    def test_drain_waits_for_requests(self):
+        work = [Deferred(), Deferred()]
+        ds = [self.drainer.run(lambda w=w: w) for w in work]
+        drained = self.drainer.drain(5)
+        self.assertNoResult(drained)
+
+        # New requests are refused while we wait.
+        self.failureResultOf(self.drainer.run(lambda: 'new'), ShuttingDown)
+        assert self.drainer.in_flight == 2
+
+        work[0].callback('zero')
+        assert self.successResultOf(ds[0]) == 'zero'
+        self.assertNoResult(drained)
+        work[1].callback('one')
+        assert self.successResultOf(drained) == 0
+        assert not self.clock.getDelayedCalls()
+
+    def test_drain_timeout(self):
+        work = Deferred()
+        d = self.drainer.run(lambda: work)
+        drained = self.drainer.drain(5)
+        self.clock.advance(4.9)
+        self.assertNoResult(drained)
+        self.clock.advance(0.1)
+        assert self.successResultOf(drained) == 1
+
+        # The request can still finish after we stop waiting.
+        work.callback('late')
+        assert self.successResultOf(d) == 'late'
+        assert self.drainer.in_flight == 0
@@ -0,0 +1,63 @@
+from twisted.internet.defer import Deferred
+from twisted.trial.unittest import TestCase
+
+from airtime_service.models import AuditMismatch
+from airtime_service.singleflight import SingleFlight
+
+
+class Work(object):
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, *args):
+        d = Deferred()
+        self.calls.append((args, d))
+        return d
+
+
+class TestSingleFlight(TestCase):
+    def setUp(self):
+        self.single_flight = SingleFlight()
+        self.work = Work()
+
+    def test_duplicates_share_result(self):
+        d0 = self.single_flight.run('req-0', {'a': 1}, self.work, 'x')
+        d1 = self.single_flight.run('req-0', {'a': 1}, self.work, 'x')
+        assert len(self.work.calls) == 1
+        assert len(self.single_flight) == 1
+        assert self.single_flight.waiting('req-0') == 1
+        assert self.single_flight.waiting('req-1') == 0
+        self.assertNoResult(d1)
+
+        [(args, d)] = self.work.calls
+        assert args == ('x',)
+        d.callback('done')
+        assert self.successResultOf(d0) == 'done'
+        assert self.successResultOf(d1) == 'done'
+        assert len(self.single_flight) == 0
+
+    def test_duplicates_share_failure(self):
+        d0 = self.single_flight.run('req-0', {}, self.work)
+        d1 = self.single_flight.run('req-0', {}, self.work)
+        [(_, d)] = self.work.calls
+        d.errback(ValueError('boom'))
+        self.failureResultOf(d0, ValueError)
+        self.failureResultOf(d1, ValueError)
+
+    def test_different_keys(self):
+        self.single_flight.run('req-0', {}, self.work)
+        self.single_flight.run('req-1', {}, self.work)
+        assert len(self.work.calls) == 2
+
+    def test_mismatched_params(self):
+        d0 = self.single_flight.run('req-0', {'a': 1}, self.work)
+        d1 = self.single_flight.run('req-0', {'a': 2}, self.work)
+        self.failureResultOf(d1, AuditMismatch)
+        assert len(self.work.calls) == 1
+        self.assertNoResult(d0)
+
+    def test_finished_calls_run_again(self):
+        d0 = self.single_flight.run('req-0', {}, lambda: 'first')
+        assert self.successResultOf(d0) == 'first'
+        d1 = self.single_flight.run('req-0', {}, lambda: 'second')
+        assert self.successResultOf(d1) == 'second'
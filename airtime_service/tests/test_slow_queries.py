@@ -0,0 +1,139 @@
+import json
+
+from aludel.database import get_engine, MetaData
+from aludel.tests.doubles import FakeReactorThreads
+from sqlalchemy.exc import OperationalError
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from airtime_service.models import VoucherPool
+from airtime_service.slow_queries import SlowQueryLog, redact_params
+
+from .helpers import populate_pool, mk_audit_params, temp_path
+
+
+class TestRedactParams(TestCase):
+    def test_redact_dict(self):
+        assert redact_params({'b_operator': 'Tank', 'count': 3}) == {
+            'b_operator': '<str>', 'count': '<int>'}
+
+    def test_redact_rows(self):
+        assert redact_params([{'voucher': 'a'}, {'voucher': 'b'}]) == (
+            '<2 rows>')
+
+
+class TestSlowQueryLog(TestCase):
+    timeout = 5
+
+    def setUp(self):
+        self.engine = get_engine('sqlite://', reactor=FakeReactorThreads())
+        self.conn = self.successResultOf(self.engine.connect())
+        self.pool = VoucherPool('testpool', self.conn)
+        self.successResultOf(self.pool.create_tables())
+
+    def tearDown(self):
+        self.successResultOf(self.conn.close())
+        md = MetaData(bind=self.engine._engine)
+        md.reflect()
+        md.drop_all()
+
+    def mk_log(self, threshold=0, **kw):
+        slow_query_log = SlowQueryLog(threshold, **kw)
+        slow_query_log.startService()
+        self.addCleanup(self.stop, slow_query_log)
+        self.pool.slow_query_log = slow_query_log
+        return slow_query_log
+
+    def stop(self, slow_query_log):
+        if slow_query_log.running:
+            return slow_query_log.stopService()
+
+    def issue(self, request_id):
+        return self.successResultOf(self.pool.issue_voucher(
+            'Tank', 'red', mk_audit_params(request_id)))
+
+    def test_fast_queries_ignored(self):
+        slow_query_log = self.mk_log(threshold=60)
+        populate_pool(self.pool, ['Tank'], ['red'], [0])
+        self.issue('req-0')
+        assert list(slow_query_log.entries) == []
+
+    def test_slow_queries_recorded(self):
+        slow_query_log = self.mk_log()
+        populate_pool(self.pool, ['Tank'], ['red'], [0])
+        self.issue('req-0')
+
+        entries = list(slow_query_log.entries)
+        assert all(e['pool'] == 'testpool' for e in entries)
+        [get_voucher] = [e for e in entries
+                         if e['sql'].startswith('SELECT')
+                         and 'vouchers' in e['sql']]
+        assert get_voucher['params']['b_operator'] == '<str>'
+        assert get_voucher['params']['b_denomination'] == '<str>'
+        assert 'Tank' not in json.dumps(entries)
+        [import_insert] = [e for e in entries
+                           if e['sql'].startswith('INSERT')
+                           and 'vouchers' in e['sql']
+                           and isinstance(e['params'], basestring)]
+        assert import_insert['params'] == '<1 rows>'
+        assert not any(e['failed'] for e in entries)
+
+    def test_failed_queries_recorded(self):
+        slow_query_log = self.mk_log()
+        f = self.failureResultOf(
+            self.pool.execute_query('SELECT no_such_function()'),
+            OperationalError)
+        assert 'no_such_function' in str(f.value)
+        [entry] = slow_query_log.entries
+        assert entry['sql'] == 'SELECT no_such_function()'
+        assert entry['failed']
+
+    def test_max_entries(self):
+        slow_query_log = self.mk_log(max_entries=3)
+        populate_pool(self.pool, ['Tank'], ['red'], [0, 1])
+        self.issue('req-0')
+        self.issue('req-1')
+        assert len(slow_query_log.entries) == 3
+
+    def test_max_shapes(self):
+        slow_query_log = self.mk_log(explain_after=1, max_shapes=2)
+        for i in range(3):
+            self.successResultOf(
+                self.pool.execute_query('SELECT %s' % (i,)))
+        assert len(slow_query_log._shape_counts) == 2
+        populate_pool(self.pool, ['Tank'], ['red'], [0, 1])
+        self.issue('req-0')
+        self.issue('req-1')
+        assert len(slow_query_log._shape_counts) == 2
+        assert len(slow_query_log.plans) <= 2
+
+    def test_explain_repeat_offenders(self):
+        slow_query_log = self.mk_log(explain_after=2)
+        populate_pool(self.pool, ['Tank'], ['red'], [0, 1, 2])
+        self.issue('req-0')
+        assert [p for p in slow_query_log.report()['plans']
+                if 'LIMIT' in p['sql']] == []
+
+        self.issue('req-1')
+        plans = slow_query_log.report()['plans']
+        [get_voucher] = [p for p in plans if 'LIMIT' in p['sql']]
+        assert get_voucher['plan']
+        # Inserts aren't explained.
+        assert not [p for p in plans if p['sql'].startswith('INSERT')]
+
+        # Each statement is only explained once.
+        calls = []
+        self.patch(slow_query_log, '_explain', lambda *a: calls.append(a))
+        self.issue('req-2')
+        assert calls == []
+
+    @inlineCallbacks
+    def test_log_file(self):
+        path = temp_path(self)
+        slow_query_log = self.mk_log(log_path=path)
+        populate_pool(self.pool, ['Tank'], ['red'], [0])
+        yield slow_query_log.stopService()
+        with open(path) as f:
+            lines = [json.loads(line) for line in f]
+        assert len(lines) == len(slow_query_log.entries)
+        assert lines[0]['pool'] == 'testpool'
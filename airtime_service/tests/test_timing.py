@@ -0,0 +1,89 @@
+from twisted.internet.defer import Deferred, fail, succeed
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+from twisted.web.test.requesthelper import DummyRequest
+
+from airtime_service import timing
+from airtime_service.timing import (
+    RequestTimer, NULL_TIMER, get_timer, set_timer, timed)
+
+
+class FakeApp(object):
+    def __init__(self, server_timing=False, log_timing=False):
+        self.server_timing = server_timing
+        self.log_timing = log_timing
+        self.timers = []
+
+    @timed
+    def handler(self, request, result):
+        self.timers.append(get_timer(request))
+        return result
+
+
+class TestRequestTimer(TestCase):
+    def test_measure(self):
+        clock = Clock()
+        timer = RequestTimer(now=clock.seconds)
+        d0 = Deferred()
+        timer.measure('connect', d0)
+        clock.advance(0.25)
+        d0.callback('conn')
+        assert self.successResultOf(d0) == 'conn'
+
+        d1 = timer.measure('lookup', Deferred())
+        clock.advance(0.5)
+        d1.errback(ValueError('oops'))
+        self.failureResultOf(d1, ValueError)
+
+        assert timer.phases == [('connect', 0.25), ('lookup', 0.5)]
+        assert timer.total() == 0.75
+        assert timer.server_timing() == (
+            'connect;dur=250.000, lookup;dur=500.000, total;dur=750.000')
+
+    def test_null_timer(self):
+        d = succeed('foo')
+        assert NULL_TIMER.measure('connect', d) is d
+
+    def test_get_timer(self):
+        request = DummyRequest([''])
+        assert get_timer(request) is NULL_TIMER
+        timer = RequestTimer()
+        set_timer(request, timer)
+        assert get_timer(request) is timer
+
+
+class TestTimed(TestCase):
+    def test_disabled(self):
+        app = FakeApp()
+        request = DummyRequest([''])
+        d = succeed('ok')
+        assert app.handler(request, d) is d
+        assert app.timers == [NULL_TIMER]
+        assert request.responseHeaders.getRawHeaders('Server-Timing') is None
+
+    def test_server_timing_header(self):
+        app = FakeApp(server_timing=True)
+        request = DummyRequest([''])
+        d = app.handler(request, succeed('ok'))
+        assert self.successResultOf(d) == 'ok'
+        [timer] = app.timers
+        assert isinstance(timer, RequestTimer)
+        [value] = request.responseHeaders.getRawHeaders('Server-Timing')
+        assert value.startswith('total;dur=')
+
+    def test_server_timing_header_on_failure(self):
+        app = FakeApp(server_timing=True)
+        request = DummyRequest([''])
+        self.failureResultOf(
+            app.handler(request, fail(ValueError('oops'))), ValueError)
+        assert request.responseHeaders.getRawHeaders('Server-Timing')
+
+    def test_log_timing(self):
+        app = FakeApp(log_timing=True)
+        request = DummyRequest([''])
+        logs = []
+        self.patch(timing.log, 'msg', logs.append)
+        self.successResultOf(app.handler(request, succeed('ok')))
+        [msg] = logs
+        assert 'total;dur=' in msg
+        assert request.responseHeaders.getRawHeaders('Server-Timing') is None
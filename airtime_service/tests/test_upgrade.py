@@ -0,0 +1,71 @@
+from aludel.database import get_engine, MetaData
+from aludel.tests.doubles import FakeReactorThreads
+from sqlalchemy.schema import DropTable
+from twisted.trial.unittest import TestCase
+
+from airtime_service import migrations
+from airtime_service.models import VoucherPool
+from airtime_service.shared import SharedVoucherPool
+from airtime_service.upgrade import upgrade_pools
+
+
+class TestUpgradePools(TestCase):
+    def setUp(self):
+        self.engine = get_engine('sqlite://', reactor=FakeReactorThreads())
+        self.conn = self.successResultOf(self.engine.connect())
+
+    def tearDown(self):
+        self.successResultOf(self.conn.close())
+        md = MetaData(bind=self.engine._engine)
+        md.reflect()
+        md.drop_all()
+
+    def mk_old_pool(self, name):
+        """
+        Create a pool that looks like it was created before the catalog
+        existed, and before schema versions were recorded.
+        """
+        pool = VoucherPool(name, self.conn)
+        self.successResultOf(pool.create_tables())
+        self.successResultOf(self.conn.execute(DropTable(pool.catalog)))
+        self.successResultOf(self.conn.execute(
+            migrations.schema_versions.delete().where(
+                migrations.schema_versions.c.name == pool.schema_name())))
+        return pool
+
+    def assert_version(self, pool, version):
+        assert self.successResultOf(
+            migrations.get_schema_version(pool)) == version
+
+    def test_upgrade_all_pools(self):
+        pool0 = self.mk_old_pool('pool0')
+        pool1 = self.mk_old_pool('pool1')
+        current = VoucherPool('pool2', self.conn)
+        self.successResultOf(current.create_tables())
+        shared = SharedVoucherPool('pool3', self.conn)
+        self.successResultOf(shared.create_tables())
+
+        all_versions = [version for version, _ in migrations.MIGRATIONS]
+        assert self.successResultOf(upgrade_pools(self.conn)) == [
+            ('pool0', all_versions),
+            ('pool1', all_versions),
+        ]
+        self.assert_version(pool0, migrations.SCHEMA_VERSION)
+        self.assert_version(pool1, migrations.SCHEMA_VERSION)
+        assert self.successResultOf(pool0.list_catalog()) == []
+
+        # Upgrading again changes nothing.
+        assert self.successResultOf(upgrade_pools(self.conn)) == []
+
+    def test_upgrade_some_pools(self):
+        pool0 = self.mk_old_pool('pool0')
+        pool1 = self.mk_old_pool('pool1')
+
+        assert self.successResultOf(upgrade_pools(self.conn, ['pool1'])) == [
+            ('pool1', [version for version, _ in migrations.MIGRATIONS]),
+        ]
+        self.assert_version(pool0, 0)
+        self.assert_version(pool1, migrations.SCHEMA_VERSION)
+
+    def test_upgrade_no_pools(self):
+        assert self.successResultOf(upgrade_pools(self.conn)) == []
@@ -0,0 +1,90 @@
+from functools import wraps
+import time
+
+from twisted.python import log
+
+
+class NullTimer(object):
+    """
+    Timer that records nothing, used when timing is disabled.
+    """
+
+    def measure(self, name, d):
+        return d
+
+
+NULL_TIMER = NullTimer()
+
+
+class RequestTimer(object):
+    """
+    Records how long each phase of a request takes.
+    """
+
+    def __init__(self, now=time.time):
+        self._now = now
+        self.started = now()
+        self.phases = []
+
+    def _record(self, result, name, start):
+        self.phases.append((name, self._now() - start))
+        return result
+
+    def measure(self, name, d):
+        """
+        Record the time until the Deferred ``d`` fires as phase ``name``.
+        """
+        return d.addBoth(self._record, name, self._now())
+
+    def total(self):
+        return self._now() - self.started
+
+    def server_timing(self):
+        """
+        Format the phases (and the total) as a ``Server-Timing`` header value.
+        """
+        phases = self.phases + [('total', self.total())]
+        return ', '.join(
+            '%s;dur=%.3f' % (name, duration * 1000)
+            for name, duration in phases)
+
+
+def set_timer(request, timer):
+    # We name-mangle the attr because `request` isn't our object.
+    request.__timer = timer
+
+
+def get_timer(request):
+    try:
+        return request.__timer
+    except AttributeError:
+        return NULL_TIMER
+
+
+def _finish_timing(result, request, timer, header, log_timing):
+    value = timer.server_timing()
+    if header:
+        request.setHeader('Server-Timing', value)
+    if log_timing:
+        log.msg("Timing for %s %s: %s" % (request.method, request.uri, value))
+    return result
+
+
+def timed(func):
+    """
+    Decorator for handlers that records per-phase timing for the request.
+
+    This does nothing unless ``server_timing`` or ``log_timing`` is set on
+    the app. Handler code gets the request's timer with :func:`get_timer`.
+    """
+    @wraps(func)
+    def wrapper(self, request, *args, **kw):
+        if not (self.server_timing or self.log_timing):
+            return func(self, request, *args, **kw)
+        timer = RequestTimer()
+        set_timer(request, timer)
+        d = func(self, request, *args, **kw)
+        return d.addBoth(
+            _finish_timing, request, timer, self.server_timing,
+            self.log_timing)
+    return wrapper
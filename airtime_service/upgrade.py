@@ -0,0 +1,57 @@
+"""
+Offline schema upgrades for every voucher pool in a database.
+
+Usage: python -m airtime_service.upgrade <database> [pool ...]
+
+The service must be stopped while this runs, because some migrations
+rebuild tables that requests use.
+"""
+
+import sys
+
+from aludel.database import get_engine
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import react
+
+from .models import VoucherPool
+from .shared import SharedVoucherPool
+
+
+@inlineCallbacks
+def upgrade_pools(conn, pool_names=None):
+    """
+    Apply every pending migration, including ones that need the pool to be
+    idle, to pools in both per-pool and shared tables.
+
+    If ``pool_names`` isn't given, all pools are upgraded. Pools that aren't
+    in a set of tables are skipped.
+
+    Returns a Deferred that fires with ``(pool name, versions applied)``
+    pairs for the pools that were changed.
+    """
+    upgraded = []
+    for pool_class in [VoucherPool, SharedVoucherPool]:
+        names = yield pool_class.list_pool_names(conn)
+        if pool_names is not None:
+            names = [name for name in names if name in pool_names]
+        for pool_name in names:
+            applied = yield pool_class(pool_name, conn).upgrade_tables()
+            if applied:
+                upgraded.append((pool_name, applied))
+    returnValue(upgraded)
+
+
+@inlineCallbacks
+def main(reactor, conn_str, *pool_names):
+    conn = yield get_engine(conn_str, reactor).connect()
+    try:
+        upgraded = yield upgrade_pools(conn, pool_names or None)
+    finally:
+        yield conn.close()
+    for pool_name, applied in upgraded:
+        sys.stdout.write("Upgraded pool %r to schema version %s.\n" % (
+            pool_name, applied[-1]))
+
+
+if __name__ == '__main__':
+    react(main, sys.argv[1:])